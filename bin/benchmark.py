@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+"""Benchmark the data pipeline's hot paths against the implementations they replaced."""
+
+from __future__ import print_function
+import argparse
+import time
+
+import numpy
+import osmium
+import shapely.wkb as wkblib
+from osgeo import gdal
+from src.openstreetmap_labels import WayExtracter
+from src.rasterize import rasterize_segments
+from src.training_data import NAIP_PIXEL_BUFFER, read_naip
+
+
+def read_naip_per_band(file_path, bands_to_use):
+    """Read a NAIP the old way: one ReadAsArray per band, then dstack them into a copy."""
+    raster_dataset = gdal.Open(file_path, gdal.GA_ReadOnly)
+    bands_data = []
+    for b in range(1, raster_dataset.RasterCount + 1):
+        if bands_to_use[b - 1] == 1:
+            bands_data.append(raster_dataset.GetRasterBand(b).ReadAsArray())
+    return raster_dataset, numpy.dstack(bands_data)
+
+
+def benchmark_read_naip(args):
+    """Time reading each NAIP per band and dstacking, against reading into a reused buffer."""
+    t0 = time.time()
+    for path in args.naip_paths:
+        read_naip_per_band(path, args.bands)
+    per_band = time.time() - t0
+
+    t0 = time.time()
+    bands_data = None
+    for path in args.naip_paths:
+        raster_dataset, bands_data = read_naip(path, args.bands, buf=bands_data)
+    single_read = time.time() - t0
+
+    print("READ {} NAIPs with bands {}".format(len(args.naip_paths), args.bands))
+    print("per band ReadAsArray + dstack: {0:.2f}s".format(per_band))
+    print("per band reads into a reused buffer: {0:.2f}s".format(single_read))
+
+
+def add_pixels_between(start_pixel, end_pixel, cols, rows, way_bitmap, pixels_to_fatten_roads):
+    """Draw a segment the old way: cols interpolation steps, each fattened a pixel at a time."""
+    if end_pixel[0] - start_pixel[0] == 0:
+        for y in range(min(end_pixel[1], start_pixel[1]), max(end_pixel[1], start_pixel[1])):
+            safe_add_pixel(end_pixel[0], y, way_bitmap)
+            for x in range(1, pixels_to_fatten_roads + 1):
+                safe_add_pixel(end_pixel[0] - x, y, way_bitmap)
+                safe_add_pixel(end_pixel[0] + x, y, way_bitmap)
+        return
+
+    slope = (end_pixel[1] - start_pixel[1]) / float(end_pixel[0] - start_pixel[0])
+    offset = end_pixel[1] - slope * end_pixel[0]
+
+    i = 0
+    while i < cols:
+        floatx = start_pixel[0] + (end_pixel[0] - start_pixel[0]) * i / float(cols)
+        p = (int(floatx), int(offset + slope * floatx))
+        safe_add_pixel(p[0], p[1], way_bitmap)
+        i += 1
+        for x in range(1, pixels_to_fatten_roads + 1):
+            safe_add_pixel(p[0], p[1] - x, way_bitmap)
+            safe_add_pixel(p[0], p[1] + x, way_bitmap)
+            safe_add_pixel(p[0] - x, p[1], way_bitmap)
+            safe_add_pixel(p[0] + x, p[1], way_bitmap)
+
+
+def safe_add_pixel(x, y, way_bitmap):
+    """Turn on a pixel in way_bitmap if its in bounds."""
+    if x < NAIP_PIXEL_BUFFER or x >= len(way_bitmap[0]) - NAIP_PIXEL_BUFFER or \
+       y < NAIP_PIXEL_BUFFER or y >= len(way_bitmap) - NAIP_PIXEL_BUFFER:
+        return
+    way_bitmap[y][x] = 1
+
+
+def synthetic_road_network(rows, cols, way_count, points_per_way, random_state):
+    """Return (N, 4) x0, y0, x1, y1 pixel segments of random walks, like ways crossing a NAIP."""
+    segments = []
+    for _ in range(way_count):
+        start = numpy.array([random_state.randint(cols), random_state.randint(rows)])
+        steps = random_state.randint(-150, 151, size=(points_per_way - 1, 2))
+        points = numpy.clip(start + numpy.cumsum(steps, axis=0), 0, [cols - 1, rows - 1])
+        points = numpy.vstack((start, points))
+        segments.append(numpy.hstack((points[:-1], points[1:])))
+    return numpy.vstack(segments)
+
+
+def within_one_pixel(bitmap, other):
+    """Return the fraction of bitmap's set pixels that are within one pixel of one of other's."""
+    padded = numpy.pad(other, 1, 'constant')
+    near = numpy.zeros_like(other)
+    for dy in range(3):
+        for dx in range(3):
+            near |= padded[dy:dy + other.shape[0], dx:dx + other.shape[1]]
+    return near[bitmap != 0].mean() if bitmap.any() else 1.0
+
+
+def benchmark_rasterize(args):
+    """Time drawing a synthetic road network per pixel, against one vectorized pass."""
+    segments = synthetic_road_network(args.rows, args.cols, args.ways, args.points_per_way,
+                                      numpy.random.RandomState(args.seed))
+
+    t0 = time.time()
+    per_pixel = numpy.zeros((args.rows, args.cols), dtype=numpy.uint8)
+    for x0, y0, x1, y1 in segments:
+        add_pixels_between((x0, y0), (x1, y1), args.cols, args.rows, per_pixel,
+                           args.pixels_to_fatten_roads)
+    per_pixel_time = time.time() - t0
+
+    t0 = time.time()
+    vectorized = numpy.zeros((args.rows, args.cols), dtype=numpy.uint8)
+    rasterize_segments(vectorized, segments[:, 0], segments[:, 1], segments[:, 2],
+                       segments[:, 3], args.pixels_to_fatten_roads, border=NAIP_PIXEL_BUFFER)
+    vectorized_time = time.time() - t0
+
+    print("RASTERIZED {} segments on a {}x{} bitmap".format(len(segments), args.rows, args.cols))
+    print("add_pixels_between: {0:.2f}s, {1} pixels".format(per_pixel_time, per_pixel.sum()))
+    print("rasterize_segments: {0:.2f}s, {1} pixels".format(vectorized_time, vectorized.sum()))
+    print("old pixels within 1px of new: {0:.2%}, new within 1px of old: {1:.2%}".format(
+        within_one_pixel(per_pixel, vectorized), within_one_pixel(vectorized, per_pixel)))
+
+
+class WKBWayExtracter(WayExtracter):
+    """A WayExtracter that gets way points the old way, via hex WKB parsed by shapely."""
+
+    wkbfab = osmium.geom.WKBFactory()
+
+    def add_linestring(self, w, way_dict):
+        """Append the way in way_dict, with the coords of its WKB linestring."""
+        try:
+            wkb = self.wkbfab.create_linestring(w)
+        except Exception:  # throws on single point ways
+            return
+        line = wkblib.loads(wkb, hex=True)
+        self.ways.append(way_dict['id'], way_dict.get('way_type'), list(line.coords),
+                         way_dict['tags'])
+
+
+def benchmark_extract(args):
+    """Time extracting ways from a PBF via WKB and shapely, against reading node locations."""
+    timings = []
+    extracted = []
+    for extracter in (WKBWayExtracter(args.extract_type), WayExtracter(args.extract_type)):
+        t0 = time.time()
+        extracter.apply_file(args.pbf_path, locations=True)
+        timings.append(time.time() - t0)
+        extracted.append(extracter.ways)
+
+    wkb_ways, ways = extracted
+    print("EXTRACTED {} {} ways from {}".format(len(ways), args.extract_type, args.pbf_path))
+    for name, elapsed in zip(("WKB + shapely", "node locations"), timings):
+        print("{0}: {1:.2f}s, {2:.0f} ways/s".format(name, elapsed, len(ways) / elapsed))
+    same = len(wkb_ways) == len(ways) and \
+        numpy.array_equal(wkb_ways.offsets, ways.offsets) and \
+        numpy.array_equal(wkb_ways.coords, ways.coords)
+    print("same way points: {}".format(same))
+
+
+def create_parser():
+    """Create the argparse parser."""
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+
+    read_parser = subparsers.add_parser("read-naip",
+                                        help="time reading NAIPs into memory")
+    read_parser.add_argument("naip_paths",
+                             nargs='+',
+                             help="local NAIP GeoTIFFs to read")
+    read_parser.add_argument("--bands",
+                             default=[1, 1, 1, 1],
+                             nargs=4,
+                             type=int,
+                             help="specify which bands to activate (R  G  B  IR)")
+    read_parser.set_defaults(run=benchmark_read_naip)
+
+    rasterize_parser = subparsers.add_parser("rasterize",
+                                             help="time drawing ways into a label bitmap")
+    rasterize_parser.add_argument("--rows", default=2000, type=int,
+                                  help="height of the synthetic NAIP, in pixels")
+    rasterize_parser.add_argument("--cols", default=2000, type=int,
+                                  help="width of the synthetic NAIP, in pixels")
+    rasterize_parser.add_argument("--ways", default=50, type=int,
+                                  help="number of random walk ways to draw")
+    rasterize_parser.add_argument("--points-per-way", default=10, type=int,
+                                  help="number of points on each way")
+    rasterize_parser.add_argument("--pixels-to-fatten-roads", default=3, type=int,
+                                  help="the number of px to fatten a road centerline")
+    rasterize_parser.add_argument("--seed", default=0, type=int,
+                                  help="random seed for the synthetic road network")
+    rasterize_parser.set_defaults(run=benchmark_rasterize)
+
+    extract_parser = subparsers.add_parser("extract",
+                                           help="time extracting ways from a PBF")
+    extract_parser.add_argument("pbf_path",
+                                help="a local OpenStreetMap PBF extract")
+    extract_parser.add_argument("--extract-type",
+                                default='highway',
+                                choices=['highway', 'tennis', 'footway', 'cycleway'],
+                                help="the type of way to extract")
+    extract_parser.set_defaults(run=benchmark_extract)
+    return parser
+
+
+def main():
+    """Run the benchmark named on the command line."""
+    args = create_parser().parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
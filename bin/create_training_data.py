@@ -3,6 +3,8 @@
 """Create training data from OpenStreetMap labels and NAIP images."""
 
 import argparse
+import json
+from src.label_rasters import LABEL_BITMAP, LABEL_FORMATS
 from src.training_data import download_and_serialize
 
 
@@ -25,6 +27,20 @@ def create_parser():
                         type=int,
                         help="the number of px to fatten a road centerline "
                              "(e.g. the default 3 makes roads 7px wide)")
+    parser.add_argument("--label-format",
+                        default=LABEL_BITMAP,
+                        choices=LABEL_FORMATS,
+                        help="label tiles with way bitmaps fattened by --pixels-to-fatten-roads, "
+                             "with each pixel's distance to the nearest way, which can be "
+                             "fattened to any width at training time, or with the class id of "
+                             "each way's way_type, from --way-classes")
+    parser.add_argument("--way-classes",
+                        default=None,
+                        type=str,
+                        help="a JSON file of {way_type: class id} to label ways with, for "
+                             "--label-format classes (defaults to src.label_rasters.WAY_CLASSES). "
+                             "ways of other way_types get the class of its \"other\" entry, "
+                             "and without one, are an error")
     parser.add_argument("--percent-for-training-data",
                         default=.90,
                         type=float,
@@ -65,6 +81,17 @@ def create_parser():
                         default='highway',
                         choices=['highway', 'tennis', 'footway', 'cycleway'],
                         help="the type of feature to identify")
+    parser.add_argument("--also-extract",
+                        default=[],
+                        nargs='+',
+                        choices=['highway', 'tennis', 'footway', 'cycleway'],
+                        help="more feature types to extract from the label data files in the "
+                             "same pass as --extract-type, and cache, so later runs for them "
+                             "don't parse the files again")
+    parser.add_argument("--workers",
+                        default=1,
+                        type=int,
+                        help="the number of processes to label and tile NAIPs with in parallel")
     parser.add_argument("--save-clippings",
                         action='store_true',
                         help="save the training data tiles to /data/naip")
@@ -75,6 +102,10 @@ def main():
     """Download and serialize training data."""
     args = create_parser().parse_args()
     naip_state, naip_year = args.naip_path
+    way_classes = None
+    if args.way_classes:
+        with open(args.way_classes) as infile:
+            way_classes = json.load(infile)
     download_and_serialize(args.number_of_naips,
                            args.randomize_naips,
                            naip_state,
@@ -85,7 +116,11 @@ def main():
                            args.tile_size,
                            args.pixels_to_fatten_roads,
                            args.label_data_files,
-                           args.tile_overlap)
+                           args.tile_overlap,
+                           args.workers,
+                           args.label_format,
+                           way_classes,
+                           args.also_extract)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""Convert a per-tile .lbl/.colors training cache into the sharded tile store."""
+
+from __future__ import print_function
+import argparse
+import itertools
+import os
+import time
+
+import numpy
+from src.config import IMAGE_CACHE_DIR, LABEL_CACHE_DIR, TILE_STORE_DIR
+from src.tile_store import TileStoreWriter
+
+
+def create_parser():
+    """Create the argparse parser."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--label-cache-dir",
+                        default=LABEL_CACHE_DIR,
+                        help="directory of 0000000000000000.lbl label tiles")
+    parser.add_argument("--image-cache-dir",
+                        default=IMAGE_CACHE_DIR,
+                        help="directory of 0000000000000000.colors image tiles")
+    parser.add_argument("--tile-store-dir",
+                        default=TILE_STORE_DIR,
+                        help="directory to write the tile store to")
+    parser.add_argument("--tiles-per-shard",
+                        default=None,
+                        type=int,
+                        help="split each NAIP's tiles into shards of at most this many tiles")
+    parser.add_argument("--remove",
+                        action='store_true',
+                        help="delete the per-tile files once the tile store is written")
+    return parser
+
+
+def read_cached_tile(args, label_filename):
+    """Return the (image, label, (col, row), naip_path) saved for one tile of the old cache."""
+    label_path = os.path.join(args.label_cache_dir, label_filename)
+    label_tile, col, row, naip_path = numpy.load(label_path, allow_pickle=True)
+    file_suffix = os.path.splitext(label_filename)[0]
+    image_path = os.path.join(args.image_cache_dir, file_suffix + '.colors')
+    image_tile = numpy.load(image_path, allow_pickle=True)[0]
+    return image_tile, label_tile, (col, row), naip_path
+
+
+def main():
+    """Import every tile in the per-tile cache, one NAIP at a time, in tile index order."""
+    args = create_parser().parse_args()
+    t0 = time.time()
+    label_filenames = sorted(f for f in os.listdir(args.label_cache_dir) if f.endswith('.lbl'))
+    if not label_filenames:
+        print("NO TILES found in {}".format(args.label_cache_dir))
+        return
+
+    first_image, first_label, _, _ = read_cached_tile(args, label_filenames[0])
+    if not os.path.exists(args.tile_store_dir):
+        os.makedirs(args.tile_store_dir)
+    tile_store = TileStoreWriter(args.tile_store_dir, first_label.shape[0], first_image.shape[2],
+                                 args.tiles_per_shard)
+
+    # the old cache numbered each NAIP's tiles consecutively, so group runs of the same NAIP
+    tiles = (read_cached_tile(args, f) for f in label_filenames)
+    for naip_path, naip_tiles in itertools.groupby(tiles, key=lambda tile: tile[3]):
+        naip_tiles = [tile[0:3] for tile in naip_tiles]
+        tile_store.add_naip(naip_path, len(naip_tiles), naip_tiles)
+        print("IMPORTED {} tiles from {}".format(len(naip_tiles), naip_path))
+
+    tile_count = tile_store.close()
+    print("IMPORTED {0} tiles in {1:.1f}s".format(tile_count, time.time() - t0))
+
+    if args.remove:
+        for label_filename in label_filenames:
+            file_suffix = os.path.splitext(label_filename)[0]
+            os.remove(os.path.join(args.label_cache_dir, label_filename))
+            os.remove(os.path.join(args.image_cache_dir, file_suffix + '.colors'))
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,10 @@ def create_parser():
                         default=5,
                         type=int,
                         help="the number of epochs to batch the training data into")
+    parser.add_argument("--on-off-ratio",
+                        default=1.0,
+                        type=float,
+                        help="the number of tiles with roads to train on for each tile without")
     parser.add_argument("--render-results",
                         action='store_true',
                         help="output data/predictions to JPEG, in addition to normal JSON")
@@ -27,7 +31,7 @@ def main():
     """Use local data to train the neural net, probably made by bin/create_training_data.py."""
     parser = create_parser()
     args = parser.parse_args()
-    train_on_cached_data(args.neural_net, args.number_of_epochs)
+    train_on_cached_data(args.neural_net, args.number_of_epochs, args.on_off_ratio)
 
 
 if __name__ == "__main__":
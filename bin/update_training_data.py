@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+
+"""Update the training data's labels with OpenStreetMap change files, retiling only what changed."""
+
+import argparse
+from src.training_data import update_tiled_training_data
+
+
+def create_parser():
+    """Create the argparse parser."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("change_files",
+                        nargs='+',
+                        help="OSM change files (.osc or .osc.gz) made since the PBFs the training "
+                             "data was labelled from, or since its last update, oldest first")
+    parser.add_argument("--workers",
+                        default=1,
+                        type=int,
+                        help="the number of processes to label and tile NAIPs with in parallel")
+    return parser
+
+
+def main():
+    """Apply change files to the training data's labels."""
+    args = create_parser().parse_args()
+    update_tiled_training_data(args.change_files, args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,7 +20,7 @@ def main():
         model_info = pickle.load(infile)
 
     model = load_model(model_info['neural_net_type'], model_info['tile_size'],
-                       len(model_info['bands']))
+                       sum(model_info['bands']))
     post_findings_to_s3(raster_data_paths, model, training_info, model_info['bands'], False)
 
 
@@ -14,11 +14,21 @@ SRC_DATA_DIR = "/media/RED6/DATA/geos/imagery"
 # where training data gets cached/retrieved
 NAIP_DATA_DIR = os.path.join(SRC_DATA_DIR, "naip")
 CACHE_PATH = os.path.join(GEO_DATA_DIR, "generated")
+# listings of the aws-naip bucket, by state/year/resolution/spectrum, kept across runs
+NAIP_LISTING_DIR = os.path.join(GEO_DATA_DIR, "naip_listings")
+# how old a NAIP listing can get, in seconds, before the bucket is listed again
+NAIP_LISTING_TTL = int(os.environ.get("NAIP_LISTING_TTL", 7 * 24 * 60 * 60))
 RAW_LABEL_DATA_DIR = os.path.join(GEO_DATA_DIR, "openstreetmap")
-LABELS_DATA_DIR = os.path.join(CACHE_PATH, "way_bitmaps")
+# the way bitmap cache, outside CACHE_PATH so create_cache_directories doesn't wipe it
+LABELS_DATA_DIR = os.path.join(GEO_DATA_DIR, "way_bitmaps")
+# how much disk the way bitmap cache in LABELS_DATA_DIR can use, before evicting old bitmaps
+LABELS_CACHE_MAX_BYTES = int(os.environ.get("LABELS_CACHE_MAX_BYTES", 20 * 1024 ** 3))
 LABEL_CACHE_DIR = os.path.join(CACHE_PATH, "training_labels")
 IMAGE_CACHE_DIR = os.path.join(CACHE_PATH, "training_images")
+TILE_STORE_DIR = os.path.join(CACHE_PATH, "training_tiles")
 METADATA_FILE = os.path.join(CACHE_PATH, "training_metadata.pickle")
+# the ways the tile store's labels were last updated to, with OSM change files
+UPDATED_WAYS_DIR = os.path.join(CACHE_PATH, "updated_ways")
 RASTER_DATAPATHS_FILE = os.path.join(CACHE_PATH, "raster_data_paths.pickle")
 MODEL_METADATA_FILE = os.path.join(CACHE_PATH, "model_metadata.pickle")
 MODEL_FILE = os.path.join(CACHE_PATH, "model.pickle")
@@ -37,10 +47,6 @@ def create_cache_directories():
         shutil.rmtree(CACHE_PATH)
     except:
         pass
-    try:
-        shutil.rmtree(RAW_LABEL_DATA_DIR)
-    except:
-        pass
 
     try:
         os.mkdir(CACHE_PATH)
@@ -58,6 +64,10 @@ def create_cache_directories():
         os.mkdir(IMAGE_CACHE_DIR)
     except:
         pass
+    try:
+        os.mkdir(TILE_STORE_DIR)
+    except:
+        pass
     try:
         os.mkdir(RAW_LABEL_DATA_DIR)
     except:
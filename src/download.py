@@ -0,0 +1,217 @@
+"""Download large files, like state PBFs, resumably, in concurrent HTTP Range segments.
+
+A download goes to path + '.part', with how much of each segment has arrived in
+path + '.part.json', so an interrupted download picks up where it left off. Once it's whole,
+it's checked against the MD5 in url + '.md5', if the server publishes one (Geofabrik does), and
+only then renamed to path, so path only ever holds a complete file. The MD5 is kept beside it,
+in path + '.md5'.
+"""
+
+from __future__ import print_function
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+
+# how many ranges of a file to download at once
+DOWNLOAD_SEGMENTS = 4
+# files are only split into segments of at least this many bytes
+DOWNLOAD_MIN_SEGMENT_BYTES = 16 * 1024 ** 2
+# how much is read from a response, and written, at a time
+DOWNLOAD_CHUNK_BYTES = 1024 ** 2
+# seconds to wait to connect, or for data
+DOWNLOAD_TIMEOUT = 60
+
+
+def file_md5(path):
+    """Return the hex MD5 of the file at path."""
+    digest = hashlib.md5()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(DOWNLOAD_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def remote_md5(url, session=requests):
+    """Return the hex MD5 in url's .md5 sidecar, or None if it can't be fetched."""
+    try:
+        response = session.get(url + '.md5', timeout=DOWNLOAD_TIMEOUT)
+    except requests.RequestException:
+        return None
+    fields = response.text.split() if response.status_code == 200 else []
+    return fields[0].lower() if fields else None
+
+
+def write_md5(path, md5):
+    """Save md5 beside path, in path + '.md5', formatted like md5sum."""
+    with open(path + '.md5', 'w') as outfile:
+        outfile.write("{}  {}\n".format(md5, os.path.basename(path)))
+
+
+def plan_segments(size, segments, min_segment_bytes=DOWNLOAD_MIN_SEGMENT_BYTES):
+    """Return [start, end, received] lists for up to segments byte ranges covering size bytes.
+
+    A size of None, for a file that can't be fetched by range, is one segment with no end.
+    """
+    if size is None:
+        return [[0, None, 0]]
+    count = max(1, min(segments, size // max(min_segment_bytes, 1)))
+    bounds = [size * i // count for i in range(count + 1)]
+    return [[bounds[i], bounds[i + 1], 0] for i in range(count)]
+
+
+class Download:
+    """A download of url to path; see the module docstring."""
+
+    def __init__(self, url, path, segments=DOWNLOAD_SEGMENTS,
+                 min_segment_bytes=DOWNLOAD_MIN_SEGMENT_BYTES, session=None):
+        """Set up downloading url to path, in up to segments concurrent ranges."""
+        self.url = url
+        self.path = path
+        self.part_path = path + '.part'
+        self.progress_path = path + '.part.json'
+        self.segments = segments
+        self.min_segment_bytes = min_segment_bytes
+        self.session = session or requests.Session()
+        self.lock = threading.Lock()
+        self.progress = None
+        self.ranged = False
+
+    def run(self):
+        """Download the file, resuming a .part from before if it's of the same file.
+
+        Raises IOError if the download fails or doesn't match its MD5. A failed download's .part
+        is kept to resume, but not one that didn't match.
+        """
+        size, ranged, validator = self._remote_info()
+        progress = self._load_progress()
+        same_file = progress is not None and progress['url'] == self.url and \
+            progress['size'] == size and progress['validator'] == validator
+        if not (ranged and same_file):
+            progress = {'url': self.url, 'size': size, 'validator': validator,
+                        'segments': plan_segments(size if ranged else None, self.segments,
+                                                  self.min_segment_bytes)}
+            with open(self.part_path, 'wb') as outfile:
+                if size is not None:
+                    outfile.truncate(size)
+        self.progress = progress
+        self.ranged = ranged
+        self._save_progress()
+
+        errors = []
+
+        def fetch(segment):
+            try:
+                self._fetch_segment(segment)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=fetch, args=(segment,))
+                   for segment in progress['segments']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise IOError("downloading {} failed, rerun to resume: {}".format(self.url, errors[0]))
+
+        expected = remote_md5(self.url, self.session)
+        md5 = file_md5(self.part_path)
+        if expected is not None and md5 != expected:
+            os.remove(self.part_path)
+            os.remove(self.progress_path)
+            raise IOError("{} has MD5 {}, but {}.md5 is {}".format(self.url, md5, self.url,
+                                                                   expected))
+        os.rename(self.part_path, self.path)
+        write_md5(self.path, md5)
+        os.remove(self.progress_path)
+        return self.path
+
+    def _remote_info(self):
+        """Return (size, ranged, validator) for url, from a HEAD request.
+
+        size is None if the server doesn't say, ranged is whether it serves byte ranges, and
+        validator is its ETag or Last-Modified, to tell if a .part is of the same file.
+        """
+        response = self.session.head(self.url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+        headers = response.headers
+        size = int(headers['Content-Length']) if 'Content-Length' in headers else None
+        ranged = size is not None and headers.get('Accept-Ranges') == 'bytes'
+        return size, ranged, headers.get('ETag', headers.get('Last-Modified'))
+
+    def _load_progress(self):
+        """Return the progress saved by an earlier download to path, or None."""
+        if not (os.path.exists(self.part_path) and os.path.exists(self.progress_path)):
+            return None
+        try:
+            with open(self.progress_path) as infile:
+                return json.load(infile)
+        except ValueError:
+            return None
+
+    def _save_progress(self):
+        """Save self.progress to the .part.json file, atomically."""
+        temp_path = self.progress_path + '.tmp'
+        with open(temp_path, 'w') as outfile:
+            json.dump(self.progress, outfile)
+        os.rename(temp_path, self.progress_path)
+
+    def _fetch_segment(self, segment):
+        """Download the rest of a [start, end, received] segment into the .part file."""
+        start, end, received = segment
+        if end is not None and start + received >= end:
+            return
+        headers = {}
+        if self.ranged:
+            headers['Range'] = 'bytes={}-{}'.format(start + received, end - 1)
+        response = self.session.get(self.url, headers=headers, stream=True,
+                                    timeout=DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+        if self.ranged and response.status_code != 206:
+            raise IOError("server didn't return the range {}".format(headers['Range']))
+        with open(self.part_path, 'r+b') as outfile:
+            outfile.seek(start + received)
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+                outfile.write(chunk)
+                # only count bytes as received once they're written
+                outfile.flush()
+                with self.lock:
+                    segment[2] += len(chunk)
+                    self._save_progress()
+            if end is None:
+                outfile.truncate(segment[2])
+        if end is not None and start + segment[2] != end:
+            raise IOError("got {} of {} bytes of a segment".format(segment[2], end - start))
+
+
+def download(url, path, segments=DOWNLOAD_SEGMENTS, session=None):
+    """Download url to path, resumably and in concurrent ranges, and return path."""
+    t0 = time.time()
+    Download(url, path, segments, session=session).run()
+    print("DOWNLOADED {0} in {1:.1f}s".format(url, time.time() - t0))
+    return path
+
+
+def is_downloaded(url, path, session=requests):
+    """Return whether path holds a complete download of url.
+
+    Downloads made by Download are, since they're renamed into place, and have a .md5 beside
+    them. An older file without one is checked against url's .md5, if the server has one.
+    """
+    if not os.path.exists(path):
+        return False
+    if os.path.exists(path + '.md5'):
+        return True
+    expected = remote_md5(url, session)
+    if expected is None:
+        return True
+    md5 = file_md5(path)
+    if md5 != expected:
+        print("{} doesn't match {}.md5, so it's truncated or out of date".format(path, url))
+        return False
+    write_md5(path, md5)
+    return True
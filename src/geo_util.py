@@ -1,18 +1,50 @@
 """Methods for working with geo/raster data."""
 
+import numpy
 from osgeo import osr
 from pyproj import Proj, transform
 
+# transformations from lon/lat into each projection in use, by projection WKT
+_lon_lat_transformations = {}
+
+
+def lon_lat_transformation(projection_wkt):
+    """Return a CoordinateTransformation from lon/lat into projection_wkt, made once per WKT."""
+    if projection_wkt not in _lon_lat_transformations:
+        srs = osr.SpatialReference()
+        srs.ImportFromWkt(projection_wkt)
+        srs_lon_lat = srs.CloneGeogCS()
+        _lon_lat_transformations[projection_wkt] = osr.CoordinateTransformation(srs_lon_lat, srs)
+    return _lon_lat_transformations[projection_wkt]
+
+
+def project_lon_lats(projection_wkt, lon_lats):
+    """Project an (N, 2) array of lon/lats into projection_wkt, with one TransformPoints call."""
+    lon_lats = numpy.asarray(lon_lats, dtype=numpy.float64).reshape(-1, 2)
+    if not len(lon_lats):
+        return numpy.zeros((0, 2))
+    projected = lon_lat_transformation(projection_wkt).TransformPoints(lon_lats.tolist())
+    return numpy.array(projected, dtype=numpy.float64)[:, 0:2]
+
+
+def world_to_pixel(geotransform, points):
+    """Apply the inverse of a GDAL geotransform to (N, 2) projected points.
+
+    Returns an (N, 2) array of fractional (col, row) pixel coordinates.
+    """
+    gt = geotransform
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    x = points[:, 0] - gt[0]
+    y = points[:, 1] - gt[3]
+    det = gt[1] * gt[5] - gt[2] * gt[4]
+    return numpy.column_stack(((gt[5] * x - gt[2] * y) / det, (gt[1] * y - gt[4] * x) / det))
+
 
 def lon_lat_to_pixel(raster_dataset, location):
     """From zacharybears.com/using-python-to-translate-latlon-locations-to-pixels-on-a-geotiff/."""
     ds = raster_dataset
     gt = ds.GetGeoTransform()
-    srs = osr.SpatialReference()
-    srs.ImportFromWkt(ds.GetProjection())
-
-    srs_lon_lat = srs.CloneGeogCS()
-    ct = osr.CoordinateTransformation(srs_lon_lat, srs)
+    ct = lon_lat_transformation(ds.GetProjection())
     new_location = [None, None]
     # Change the point locations into the GeoTransform space
     (new_location[0], new_location[1], holder) = ct.TransformPoint(location[0], location[1])
@@ -0,0 +1,250 @@
+"""A disk cache for per-NAIP label rasters, keyed by everything the labels are made from.
+
+Each entry's key is a hash of the NAIP's digest, the digests of the PBFs its ways came from,
+the extract type, the fatten width, the label format, and LABEL_CACHE_VERSION, so changing any
+of them makes a new entry instead of serving stale labels.
+
+Entries are written to a temporary file and renamed into place, so a reader never sees a
+partial one. A JSON manifest records each entry's size and when it was last used, and once the
+cache is over its byte budget, the least recently used entries are evicted.
+"""
+
+from __future__ import print_function
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from src.config import LABELS_CACHE_MAX_BYTES, LABELS_DATA_DIR
+
+# bump this when the way labels are drawn differently, to stop using entries made before
+LABEL_CACHE_VERSION = 1
+
+MANIFEST_FILENAME = 'manifest.json'
+LOCK_FILENAME = 'manifest.lock'
+
+# how much of a file file_digest reads at a time
+DIGEST_CHUNK_BYTES = 1 << 20
+# file_digest saves a file's digest beside it, in its path plus this
+DIGEST_SUFFIX = '.sha1.json'
+
+
+# file_digest results, by path, size and mtime, so a file is only looked up once per process
+_file_digests = {}
+
+
+def file_digest(path):
+    """Return the hex SHA-1 of the file at path.
+
+    The digest is saved beside the file, in path + '.sha1.json', with the file's size and mtime,
+    and only worked out again once they change. So a big file, like a PBF or a NAIP, is hashed
+    once, by whichever run or worker process gets to it first, rather than once per process.
+    """
+    stat = os.stat(path)
+    digest_key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if digest_key not in _file_digests:
+        digest = saved_digest(path, stat)
+        if digest is None:
+            sha1 = hashlib.sha1()
+            with open(path, 'rb') as infile:
+                for chunk in iter(lambda: infile.read(DIGEST_CHUNK_BYTES), b''):
+                    sha1.update(chunk)
+            digest = sha1.hexdigest()
+            save_digest(path, stat, digest)
+        _file_digests[digest_key] = digest
+    return _file_digests[digest_key]
+
+
+def saved_digest(path, stat):
+    """Return the digest file_digest saved for path, or None if there isn't one for this stat."""
+    try:
+        with open(path + DIGEST_SUFFIX) as infile:
+            saved = json.load(infile)
+        if saved['size'] == stat.st_size and saved['mtime'] == stat.st_mtime:
+            return saved['sha1']
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def save_digest(path, stat, digest):
+    """Save the digest of path, as it is at stat, beside it, if its directory is writable."""
+    try:
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path) or '.')
+    except OSError:
+        return
+    with os.fdopen(fd, 'w') as outfile:
+        json.dump({'sha1': digest, 'size': stat.st_size, 'mtime': stat.st_mtime}, outfile)
+    os.rename(temp_path, path + DIGEST_SUFFIX)
+
+
+def label_params(label_data_paths, extract_type, pixels_to_fatten_roads, label_format,
+                 way_classes=None):
+    """Return the dict of everything, but the NAIP, that way labels are made from.
+
+    way_classes is the way_type to class id table for LABEL_CLASSES labels.
+    """
+    return {'label_data_digests': [file_digest(path) for path in label_data_paths],
+            'extract_type': extract_type,
+            'pixels_to_fatten_roads': pixels_to_fatten_roads,
+            'label_format': label_format,
+            'way_classes': way_classes}
+
+
+def way_bitmap_cache_key(raster_data_path, params):
+    """Return the cache key for the labels of a NAIP, made with label_params params.
+
+    The NAIP is keyed by its contents, so a NAIP downloaded again, or moved, keeps its labels.
+    """
+    keyed = {'naip': file_digest(raster_data_path), 'params': params,
+             'version': LABEL_CACHE_VERSION}
+    return hashlib.sha1(json.dumps(keyed, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class LabelCache:
+    """Label rasters in cache_dir, evicted least recently used first past max_bytes."""
+
+    def __init__(self, cache_dir=LABELS_DATA_DIR, max_bytes=LABELS_CACHE_MAX_BYTES):
+        """Use (and create, if need be) the cache in cache_dir."""
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+
+    def get(self, key):
+        """Return the path of the entry for key, marking it used, or None if there isn't one."""
+        found = []
+
+        def touch(manifest):
+            entry = manifest.get(key)
+            if entry is None:
+                return
+            path = os.path.join(self.cache_dir, entry['filename'])
+            if os.path.exists(path):
+                entry['accessed'] = time.time()
+                found.append(path)
+            else:
+                del manifest[key]
+
+        self._update_manifest(touch)
+        return found[0] if found else None
+
+    def put(self, key, suffix, write):
+        """Add an entry for key, written to a file object by write(outfile), and return its path.
+
+        Evicts least recently used entries, other than this one, to get back under max_bytes.
+        """
+        filename = key + suffix
+        path = os.path.join(self.cache_dir, filename)
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                write(outfile)
+            os.rename(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        def add(manifest):
+            manifest[key] = self._entry(filename)
+            self._evict(manifest, keep=key)
+
+        self._update_manifest(add)
+        return path
+
+    def link(self, key, new_key):
+        """Make the entry for key the entry for new_key too, and return its path, or None.
+
+        For labels made from different inputs that come out the same, like a NAIP none of an
+        OSM update's changes touch. The file is hard linked, so it only counts once against
+        max_bytes, or copied if it can't be, and evicts entries like put does.
+        """
+        path = self.get(key)
+        if path is None:
+            return None
+        filename = new_key + os.path.basename(path)[len(key):]
+        new_path = os.path.join(self.cache_dir, filename)
+        if not os.path.exists(new_path):
+            try:
+                os.link(path, new_path)
+            except OSError:
+                shutil.copyfile(path, new_path)
+
+        def add(manifest):
+            manifest[new_key] = self._entry(filename)
+            self._evict(manifest, keep=new_key)
+
+        self._update_manifest(add)
+        return new_path
+
+    def remove(self, key):
+        """Delete the entry for key, if there is one."""
+        def delete(manifest):
+            entry = manifest.pop(key, None)
+            if entry is not None:
+                self._delete_file(entry['filename'])
+
+        self._update_manifest(delete)
+
+    def _entry(self, filename):
+        """Return a new manifest entry for filename in the cache directory, used now."""
+        stat = os.stat(os.path.join(self.cache_dir, filename))
+        return {'filename': filename, 'size': stat.st_size, 'inode': stat.st_ino,
+                'accessed': time.time()}
+
+    def _evict(self, manifest, keep=None):
+        """Delete least recently used entries, but keep, until the cache is within max_bytes."""
+        if self.max_bytes is None:
+            return
+        # hard linked entries share a file, so count each file's bytes once, and only free them
+        # once its last entry is evicted
+        sizes, entry_counts = {}, {}
+        for key, entry in manifest.items():
+            file_id = entry.get('inode', key)
+            sizes[file_id] = entry['size']
+            entry_counts[file_id] = entry_counts.get(file_id, 0) + 1
+        total = sum(sizes.values())
+        by_age = sorted(manifest, key=lambda entry_key: manifest[entry_key]['accessed'])
+        for key in by_age:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            entry = manifest.pop(key)
+            self._delete_file(entry['filename'])
+            file_id = entry.get('inode', key)
+            entry_counts[file_id] -= 1
+            if not entry_counts[file_id]:
+                total -= sizes[file_id]
+            print("EVICTED {} from the label cache".format(entry['filename']))
+
+    def _delete_file(self, filename):
+        """Delete filename from the cache directory, if it's still there."""
+        try:
+            os.remove(os.path.join(self.cache_dir, filename))
+        except OSError:
+            pass
+
+    def _update_manifest(self, update):
+        """Call update(manifest) on the manifest dict, and save it, holding the cache's lock.
+
+        The lock is an flock, so tiling processes sharing a cache take turns.
+        """
+        with open(os.path.join(self.cache_dir, LOCK_FILENAME), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            manifest_path = os.path.join(self.cache_dir, MANIFEST_FILENAME)
+            manifest = {}
+            if os.path.exists(manifest_path):
+                with open(manifest_path) as infile:
+                    manifest = json.load(infile)
+            update(manifest)
+            fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+            with os.fdopen(fd, 'w') as outfile:
+                json.dump(manifest, outfile)
+            os.rename(temp_path, manifest_path)
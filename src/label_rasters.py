@@ -0,0 +1,154 @@
+"""Compact storage for the per-NAIP label rasters that training tiles are cut from.
+
+Way bitmaps are mostly empty, so on disk they are bit-packed along each row (1 bit per pixel,
+1/64th the size of an int64 array), and read back through a memory map a window at a time.
+
+Labels come in three formats: LABEL_BITMAP, a 0/1 mask of (fattened) way pixels;
+LABEL_DISTANCE, each pixel's distance to the nearest way centerline (see
+rasterize.distance_transform), from which label_mask makes a mask of any fatten width; and
+LABEL_CLASSES, the class id of the (fattened) way at each pixel, from a way_type to class id
+table like WAY_CLASSES, from which class_mask makes a mask of any subset of classes.
+
+Label tiles are also summarized when they are stored (way pixel count, and how close ways come
+to the tile center), so tiles can be classified without reading the labels again.
+"""
+
+import numpy
+
+# label raster formats
+LABEL_BITMAP = 'bitmap'
+LABEL_DISTANCE = 'distance'
+LABEL_CLASSES = 'classes'
+LABEL_FORMATS = (LABEL_BITMAP, LABEL_DISTANCE, LABEL_CLASSES)
+
+# a way_classes table's entry for the class of ways whose way_type isn't in the table, like
+# ways without a way_type (tennis courts, say) or highway values the table doesn't list
+OTHER_WAYS = 'other'
+
+# the default table of OSM highway way_types to LABEL_CLASSES class ids; 0 is no way, and
+# where ways of two classes overlap, the higher class id is drawn
+WAY_CLASSES = {OTHER_WAYS: 1,
+               'path': 1, 'footway': 1, 'cycleway': 1, 'bridleway': 1, 'steps': 1,
+               'pedestrian': 1, 'track': 1,
+               'service': 2, 'living_street': 2,
+               'residential': 3, 'unclassified': 3, 'road': 3,
+               'tertiary': 4, 'tertiary_link': 4,
+               'secondary': 5, 'secondary_link': 5,
+               'primary': 6, 'primary_link': 6,
+               'trunk': 7, 'trunk_link': 7,
+               'motorway': 8, 'motorway_link': 8}
+
+
+def way_class_ids(classes, way_types):
+    """Return the uint8 class id of each of way_types, from a way_type to class id table.
+
+    Way types not in the table get its OTHER_WAYS class. If there are any, and the table has no
+    OTHER_WAYS class, raises ValueError, rather than leaving those ways out of the labels.
+    """
+    other = classes.get(OTHER_WAYS)
+    unmapped = set(way_type for way_type in way_types if way_type not in classes)
+    if unmapped and other is None:
+        raise ValueError("way_classes has no class for way types {}, and no '{}' class".format(
+            sorted(unmapped), OTHER_WAYS))
+    return numpy.array([classes.get(way_type, other) for way_type in way_types],
+                       dtype=numpy.uint8)
+
+
+def save_packed_bitmap(path, bitmap):
+    """Save a rows x cols 0/1 bitmap to path as a rows x ceil(cols / 8) bit-packed .npy."""
+    numpy.save(path, numpy.packbits(numpy.asarray(bitmap) != 0, axis=1))
+
+
+class PackedBitmap:
+    """A bitmap saved by save_packed_bitmap, memory mapped and decoded one window at a time.
+
+    Slicing it like a 2-d array, e.g. bitmap[row:row + 64, col:col + 64], returns a uint8 array
+    of 0/1 pixels, only unpacking the bytes the window covers.
+    """
+
+    def __init__(self, path, cols=None):
+        """Open the bitmap at path; cols is its unpadded width, if known."""
+        self.packed = numpy.load(path, mmap_mode='r')
+        rows, packed_cols = self.packed.shape
+        self.shape = (rows, cols if cols is not None else packed_cols * 8)
+
+    def __len__(self):
+        """Return the number of rows in the bitmap."""
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        """Return the window for a [rows, cols] pair of slices, as a uint8 array."""
+        row_slice, col_slice = key
+        row_start, row_stop, _ = row_slice.indices(self.shape[0])
+        col_start, col_stop, _ = col_slice.indices(self.shape[1])
+        return self.window(row_start, col_start, row_stop - row_start, col_stop - col_start)
+
+    def window(self, row, col, height, width):
+        """Return the height x width window with its top left at (col, row), as 0/1 uint8."""
+        first_byte = col // 8
+        last_byte = (col + width + 7) // 8
+        bits = numpy.unpackbits(self.packed[row:row + height, first_byte:last_byte], axis=1)
+        start = col - first_byte * 8
+        return bits[:, start:start + width]
+
+    def to_array(self):
+        """Decode the whole bitmap, as a rows x cols uint8 array."""
+        return self.window(0, 0, self.shape[0], self.shape[1])
+
+
+def label_mask(labels, label_format=LABEL_BITMAP, pixels_to_fatten_roads=0):
+    """Return a uint8 0/1 way mask for labels of label_format.
+
+    Distance labels are fattened by pixels_to_fatten_roads; bitmap and class labels were
+    fattened when they were drawn, so any way pixel is 1.
+    """
+    labels = numpy.asarray(labels)
+    if label_format == LABEL_DISTANCE:
+        return (labels <= pixels_to_fatten_roads).astype(numpy.uint8)
+    return (labels != 0).astype(numpy.uint8)
+
+
+def class_mask(labels, class_ids):
+    """Return a uint8 0/1 mask of the pixels of LABEL_CLASSES labels in any of class_ids."""
+    lookup = numpy.zeros(256, dtype=numpy.uint8)
+    lookup[list(class_ids)] = 1
+    return lookup[numpy.asarray(labels, dtype=numpy.uint8)]
+
+
+# center_distances for a tile without any ways in it
+NO_WAYS_DISTANCE = numpy.iinfo(numpy.int16).max
+
+# how many tiles center_distances works on at once, to bound its temporary arrays
+SUMMARY_CHUNK_SIZE = 1024
+
+
+def center_window_reach(rows, cols):
+    """Return, for each pixel of a rows x cols tile, the smallest center window that covers it.
+
+    Like has_ways_in_center, the window for tolerance t spans center - t to center + t - 1.
+    """
+    def reach(size):
+        offsets = numpy.arange(size) - size // 2
+        return numpy.where(offsets < 0, -offsets, offsets + 1).astype(numpy.int16)
+    return numpy.maximum.outer(reach(rows), reach(cols))
+
+
+def center_distances(labels):
+    """Return the smallest tolerance has_ways_in_center is True at, for each of (N, T, T) labels.
+
+    Tiles with no ways get NO_WAYS_DISTANCE.
+    """
+    labels = numpy.asarray(labels)
+    reach = center_window_reach(labels.shape[1], labels.shape[2])
+    distances = numpy.empty(len(labels), dtype=numpy.int16)
+    for start in range(0, len(labels), SUMMARY_CHUNK_SIZE):
+        chunk = labels[start:start + SUMMARY_CHUNK_SIZE]
+        chunk_distances = numpy.where(chunk != 0, reach, NO_WAYS_DISTANCE)
+        distances[start:start + len(chunk)] = chunk_distances.min(axis=(1, 2))
+    return distances
+
+
+def road_pixel_counts(labels):
+    """Return the number of way pixels in each of (N, T, T) labels."""
+    labels = numpy.asarray(labels)
+    return (labels != 0).sum(axis=(1, 2))
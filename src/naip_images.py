@@ -2,21 +2,62 @@
 
 import boto3
 import os
-import subprocess
 import sys
+import tempfile
 import time
 from random import shuffle
-from src.config import cache_paths, create_cache_directories, NAIP_DATA_DIR, LABELS_DATA_DIR
+from src.config import cache_paths, create_cache_directories, NAIP_DATA_DIR, \
+    NAIP_LISTING_DIR, NAIP_LISTING_TTL
+
+NAIP_BUCKET = 'aws-naip'
+
+
+def list_bucket_keys(s3_client, bucket, prefix):
+    """Yield the keys under prefix in a RequesterPays bucket, as each page of them is listed."""
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, RequestPayer='requester'):
+        for s3_object in page.get('Contents', []):
+            yield s3_object['Key']
+
+
+def cached_keys(listing_path, ttl, list_keys):
+    """Yield the keys saved in listing_path, or if it's over ttl seconds old, from list_keys().
+
+    Listed keys are saved to listing_path, one per line, once they've all been listed.
+    """
+    if os.path.exists(listing_path) and time.time() - os.path.getmtime(listing_path) < ttl:
+        with open(listing_path) as infile:
+            for line in infile:
+                yield line.rstrip('\n')
+        return
+
+    listing_dir = os.path.dirname(listing_path)
+    if not os.path.exists(listing_dir):
+        os.makedirs(listing_dir)
+    fd, temp_path = tempfile.mkstemp(dir=listing_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as outfile:
+            for key in list_keys():
+                outfile.write(key + '\n')
+                yield key
+        os.rename(temp_path, listing_path)
+    finally:
+        # a listing that failed, or wasn't read to the end, isn't saved
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
 
 
 class NAIPDownloader:
     """Downloads NAIP images from S3, by state/year."""
 
-    def __init__(self, number_of_naips, should_randomize, state, year, extents=None):
+    def __init__(self, number_of_naips, should_randomize, state, year, extents=None,
+                 s3_client=None, listing_dir=NAIP_LISTING_DIR, listing_ttl=NAIP_LISTING_TTL):
         """
         Download some arbitrary NAIP images from the aws-naip S3 bucket.
         
         extent (optional) should be a 4-tuple of decimal degrees (x_left, y_bottom, x_right, y_top)
+        s3_client (optional) is the boto3 S3 client to use, instead of a default one
+        The bucket listing for the state/year is kept in listing_dir, for listing_ttl seconds.
         """
         self.number_of_naips = number_of_naips
         self.should_randomize = should_randomize
@@ -25,11 +66,14 @@ class NAIPDownloader:
         self.year = year
         self.resolution = '1m'
         self.spectrum = 'rgbir'
-        self.bucket_url = 's3://aws-naip/'
 
         self.extents = [extents] if isinstance(extents, tuple) else extents
 
-        self.url_base = '{}{}/{}/{}/{}/'.format(self.bucket_url, self.state, self.year, self.resolution, self.spectrum)
+        self.prefix = '{}/{}/{}/{}/'.format(self.state, self.year, self.resolution, self.spectrum)
+        self.s3_client = s3_client
+        self.listing_path = os.path.join(listing_dir, '{}-{}-{}-{}.txt'.format(
+            self.state, self.year, self.resolution, self.spectrum))
+        self.listing_ttl = listing_ttl
 
         self.make_directory(NAIP_DATA_DIR)
 
@@ -38,10 +82,15 @@ class NAIPDownloader:
         if not os.path.exists(new_dir):
             os.makedirs(new_dir)
 
+    def client(self):
+        """Return the S3 client, making a default one the first time it's needed."""
+        if self.s3_client is None:
+            self.s3_client = boto3.client('s3')
+        return self.s3_client
+
     def download_naips(self):
         """Download self.number_of_naips of the naips for a given state."""
         create_cache_directories()
-        self.configure_s3cmd()
         naip_filenames = self.list_naips()
         if self.should_randomize:
             shuffle(naip_filenames)
@@ -49,46 +98,25 @@ class NAIPDownloader:
         cache_paths(naip_local_paths)
         return naip_local_paths
 
-    def configure_s3cmd(self):
-        """Configure s3cmd with AWS credentials."""
-        file_path = os.environ.get("HOME") + '/.s3cfg'
-        f = open(file_path, 'r')
-        filedata = f.read()
-        f.close()
-        access = os.environ.get("AWS_ACCESS_KEY_ID")
-        secret = os.environ.get("AWS_SECRET_ACCESS_KEY")
-        newdata = filedata.replace("AWS_ACCESS_KEY", access)
-        newdata = newdata.replace("AWS_SECRET_KEY", secret)
-        f = open(file_path, 'w')
-        f.write(newdata)
-        f.close()
-
     def list_naips(self):
         """Make a list of NAIPs based on the init parameters for the class."""
-        # list the contents of the bucket directory
-        bash_command = "s3cmd ls --recursive --skip-existing {} --requester-pays".format(self.url_base)
-        process = subprocess.Popen(bash_command.split(" "), stdout=subprocess.PIPE)
-        output = process.communicate()[0]
         naip_filenames = []
-        # print(output)
-        for line in output.split('\n'):
-            parts = line.split(self.url_base)
+        keys = cached_keys(self.listing_path, self.listing_ttl,
+                           lambda: list_bucket_keys(self.client(), NAIP_BUCKET, self.prefix))
+        for key in keys:
+            naip_path = key[len(self.prefix):]
+            parts = naip_path.split('/')
             # there may be subdirectories for each state, where directories need to be made
-            if len(parts) == 2:
-                naip_path = parts[1]
-                if not self.naip_in_extent(naip_path.split('/')[1]):
-                    continue
-                print(parts)
-
-                naip_filenames.append(naip_path)
-                naip_subpath = os.path.join(NAIP_DATA_DIR, naip_path.split('/')[0])
-                self.make_directory(naip_subpath)
-                labels_subpath = os.path.join(LABELS_DATA_DIR, naip_path.split('/')[0])
-                self.make_directory(labels_subpath)
-            else:
-                pass
-                # skip non filename lines from response
+            if len(parts) != 2 or not parts[1]:
+                continue
+            if not self.naip_in_extent(parts[1]):
+                continue
+
+            naip_filenames.append(naip_path)
+            naip_subpath = os.path.join(NAIP_DATA_DIR, parts[0])
+            self.make_directory(naip_subpath)
 
+        print("LISTED {} NAIPs in s3://{}/{}".format(len(naip_filenames), NAIP_BUCKET, self.prefix))
         return naip_filenames
 
     def naip_in_extent(self, naip_fname):
@@ -131,7 +159,7 @@ class NAIPDownloader:
 
     def download_from_s3(self, naip_filenames):
         """Download the NAIPs and return a list of the file paths."""
-        s3_client = boto3.client('s3')
+        s3_client = self.client()
         naip_local_paths = []
         max_range = self.number_of_naips
         if max_range == -1:
@@ -147,9 +175,9 @@ class NAIPDownloader:
                 if not has_printed:
                     print("DOWNLOADING {} NAIPs...".format(max_range))
                     has_printed = True
-                url_without_prefix = self.url_base.split(self.bucket_url)[1]
-                s3_url = '{}{}'.format(url_without_prefix, filename)
-                s3_client.download_file('aws-naip', s3_url, full_path, {'RequestPayer': 'requester'})
+                s3_url = '{}{}'.format(self.prefix, filename)
+                s3_client.download_file(NAIP_BUCKET, s3_url, full_path,
+                                        {'RequestPayer': 'requester'})
             naip_local_paths.append(full_path)
         if time.time() - t0 > 0.01:
             print("downloads took {0:.1f}s".format(time.time() - t0))
@@ -1,134 +1,338 @@
 """Extract Ways from OSM PBF files."""
+import hashlib
+import json
+import multiprocessing
 import os
+import shutil
+import tempfile
 import time
+from array import array
 
+import numpy
 import osmium as o
-import requests
-import shapely.wkb as wkblib
 from src.config import RAW_LABEL_DATA_DIR
+from src.download import download, is_downloaded
+from src.label_cache import file_digest
+from src.ways import WAYS_STRINGS_FILENAME, Ways
 
-# http://docs.osmcode.org/pyosmium/latest/intro.html
-# A global factory that creates WKB from a osmium geometry
-wkbfab = o.geom.WKBFactory()
+# bump this when ways are extracted differently, to stop using extractions cached before
+EXTRACTION_CACHE_VERSION = 2
+# each cached extraction records what it was extracted from in this file
+EXTRACTION_KEY_FILENAME = 'extraction.json'
+# how many extractions of a PBF, with different extract types or extents, are kept next to it
+EXTRACTION_CACHE_KEEP = 8
+
+
+def way_lon_lats(w, coords, node_ids=None):
+    """Fill the array coords with the lon, lat of each node of way w, flattened.
+
+    Consecutive nodes at the same location are dropped, like osmium's geometry factories do.
+    Returns False, with coords meaningless, if a node has no location (it isn't in the PBF).
+    With node_ids, an array, it's filled with the id of each node kept.
+    """
+    del coords[:]
+    if node_ids is not None:
+        del node_ids[:]
+    for node in w.nodes:
+        location = node.location
+        if not location.valid():
+            return False
+        lon, lat = location.lon, location.lat
+        if coords and coords[-2] == lon and coords[-1] == lat:
+            continue
+        coords.append(lon)
+        coords.append(lat)
+        if node_ids is not None:
+            node_ids.append(node.ref)
+    return True
+
+
+def way_in_extents(coords, extents):
+    """Return whether the bounding box of flat lon, lat coords overlaps any of extents.
+
+    extents is an (N, 4) array of (x_left, y_bottom, x_right, y_top) boxes in decimal degrees.
+    """
+    lons, lats = coords[0::2], coords[1::2]
+    return bool(((min(lons) <= extents[:, 2]) & (max(lons) >= extents[:, 0]) &
+                 (min(lats) <= extents[:, 3]) & (max(lats) >= extents[:, 1])).any())
+
+
+def extraction_cache_key(file_path, extract_type, extents=None):
+    """Return the dict of everything the ways extracted from the PBF at file_path depend on.
+
+    The PBF is keyed by its file_digest, which is only hashed again once the PBF changes.
+    """
+    return {'digest': file_digest(file_path),
+            'extract_type': extract_type,
+            'extents': [list(map(float, extent)) for extent in extents]
+            if extents is not None else None,
+            'version': EXTRACTION_CACHE_VERSION}
+
+
+def extraction_cache_dir(file_path, extract_type, extents=None):
+    """Return the directory for the ways extracted from the PBF at file_path, next to it.
+
+    It's named for a hash of extraction_cache_key, so a changed PBF or filter gets its own
+    extraction.
+    """
+    keyed = extraction_cache_key(file_path, extract_type, extents)
+    key = hashlib.sha1(json.dumps(keyed, sort_keys=True).encode('utf-8')).hexdigest()
+    return os.path.join(file_path + '.ways', key)
+
+
+def load_extraction(cache_dir):
+    """Return the Ways cached in cache_dir, marking them used, or None if there aren't any."""
+    if not os.path.exists(os.path.join(cache_dir, WAYS_STRINGS_FILENAME)):
+        return None
+    os.utime(cache_dir, None)
+    return Ways.load(cache_dir)
 
 
 class WayMap():
     """Extract ways from OpenStreetMap PBF extracts."""
 
-    def __init__(self, extract_type='highway'):
-        """The extract_type can be highway, footway, cycleway, or tennis."""
-        self.extracter = WayExtracter(extract_type)
+    def __init__(self, extract_type='highway', extents=None, use_cache=True, also_extract=()):
+        """The extract_type can be highway, footway, cycleway, or tennis.
+
+        extents (optional) is a list of (x_left, y_bottom, x_right, y_top) boxes in decimal
+        degrees, like NAIP bounds, and ways that don't overlap any of them aren't extracted.
+        With use_cache, each PBF's ways are saved next to it, and loaded instead of parsing it
+        again, see extraction_cache_dir. also_extract lists more extract types to cache from the
+        same pass over each PBF, with extract_all_types, so WayMaps for them only load them.
+        """
+        self.extract_type = extract_type
+        self.extents = extents
+        self.use_cache = use_cache
+        self.also_extract = [other_type for other_type in also_extract
+                             if other_type != extract_type]
+        self.ways = Ways()
 
-    def extract_files(self, file_list):
-        """Extract ways from each PBF in file_list."""
-        for path in file_list:
-            self.run_extraction(path)
+    def extract_files(self, file_list, workers=1):
+        """Extract ways from each PBF in file_list, into self.ways.
+
+        With workers > 1, the PBFs are extracted in a pool of up to that many processes, one per
+        PBF. Either way, ways in more than one PBF are only kept once, see Ways.merge.
+        """
+        if workers > 1 and len(file_list) > 1:
+            pool = multiprocessing.Pool(min(workers, len(file_list)))
+            extracted = pool.map(extract_pbf, [(self, path) for path in file_list])
+            pool.close()
+            pool.join()
+            # cached extractions are loaded here, memory mapped, instead of sent back pickled
+            extracted = [ways if ways is not None else self.run_extraction(path)
+                         for ways, path in zip(extracted, file_list)]
+        else:
+            extracted = [self.run_extraction(path) for path in file_list]
+        self.ways = Ways.merge(extracted) if extracted else Ways()
 
     def run_extraction(self, file_path):
-        """Extract ways from a PBF file at file_path."""
+        """Return the Ways extracted from a PBF file at file_path, or cached from before."""
+        if self.use_cache and self.also_extract:
+            return extract_all_types(file_path, [self.extract_type] + self.also_extract,
+                                     self.extents)[self.extract_type]
+        cache_dir = extraction_cache_dir(file_path, self.extract_type, self.extents)
+        cached = load_extraction(cache_dir) if self.use_cache else None
+        if cached is not None:
+            print "LOADED cached ways extracted from pbf file {}".format(file_path)
+            return cached
+
         t0 = time.time()
-        self.extracter.apply_file(file_path, locations=True)
+        extracter = WayExtracter(self.extract_type, extents=self.extents)
+        extracter.apply_file(file_path, locations=True)
         t1 = time.time()
         elapsed = "{0:.1f}".format(t1 - t0)
         print "EXTRACTED WAYS with locations from pbf file {}, took {}s".format(file_path, elapsed)
+        if self.use_cache:
+            save_extraction(extracter.ways, cache_dir,
+                            extraction_cache_key(file_path, self.extract_type, self.extents))
+        return extracter.ways
+
+
+def save_extraction(ways, cache_dir, keyed):
+    """Save ways to an extraction_cache_dir, so it's never seen half written.
+
+    keyed is its extraction_cache_key, saved with it so prune_extractions can tell if it's stale.
+    """
+    # save beside the cache directory and rename it in
+    if not os.path.isdir(os.path.dirname(cache_dir)):
+        os.makedirs(os.path.dirname(cache_dir))
+    temp_dir = tempfile.mkdtemp(dir=os.path.dirname(cache_dir))
+    ways.save(temp_dir)
+    with open(os.path.join(temp_dir, EXTRACTION_KEY_FILENAME), 'w') as outfile:
+        json.dump(keyed, outfile)
+    try:
+        os.rename(temp_dir, cache_dir)
+    except OSError:
+        # another run cached it first
+        shutil.rmtree(temp_dir)
+    prune_extractions(os.path.dirname(cache_dir), keyed, keep=cache_dir)
+
+
+def prune_extractions(ways_dir, keyed, keep=None, max_count=None):
+    """Delete the extractions in a PBF's .ways directory that aren't worth keeping.
+
+    Those are extractions of an older version of the PBF, or made by an older
+    EXTRACTION_CACHE_VERSION, than keyed says, and past the max_count (by default
+    EXTRACTION_CACHE_KEEP) most recently used of the rest, but never keep.
+    """
+    max_count = max_count or EXTRACTION_CACHE_KEEP
+    current = []
+    for name in os.listdir(ways_dir):
+        path = os.path.join(ways_dir, name)
+        # skip temporary directories of extractions being saved
+        if len(name) != 40 or not os.path.isdir(path):
+            continue
+        try:
+            with open(os.path.join(path, EXTRACTION_KEY_FILENAME)) as infile:
+                saved = json.load(infile)
+        except (IOError, ValueError):
+            saved = {}
+        if path == keep or (saved.get('digest') == keyed['digest'] and
+                            saved.get('version') == keyed['version']):
+            current.append(path)
+        else:
+            shutil.rmtree(path, ignore_errors=True)
+    current.sort(key=lambda path: (path == keep, os.path.getmtime(path)), reverse=True)
+    for path in current[max_count:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def extract_all_types(file_path, extract_types, extents=None):
+    """Extract ways of each of extract_types from a PBF in one pass, into the extraction cache.
+
+    Returns a dict of Ways by extract type. Types already in the cache are loaded instead, and
+    the PBF is only parsed if some aren't, so WayMaps for these types just load them later.
+    """
+    extracted = {}
+    cache_dirs = dict((extract_type, extraction_cache_dir(file_path, extract_type, extents))
+                      for extract_type in extract_types)
+    for extract_type, cache_dir in cache_dirs.items():
+        cached = load_extraction(cache_dir)
+        if cached is not None:
+            extracted[extract_type] = cached
+    missing = [extract_type for extract_type in extract_types if extract_type not in extracted]
+    if missing:
+        t0 = time.time()
+        extracter = MultiWayExtracter(missing, extents=extents)
+        extracter.apply_file(file_path, locations=True)
+        elapsed = "{0:.1f}".format(time.time() - t0)
+        print "EXTRACTED {} WAYS with locations from pbf file {}, took {}s".format(
+            ', '.join(missing), file_path, elapsed)
+        for extract_type in missing:
+            save_extraction(extracter.ways[extract_type], cache_dirs[extract_type],
+                            extraction_cache_key(file_path, extract_type, extents))
+            extracted[extract_type] = extracter.ways[extract_type]
+    return extracted
+
+
+def extract_pbf(job):
+    """Extract the ways from a PBF in a pool worker, from a (waymap, file_path) job.
+
+    Returns the Ways, or None if waymap caches extractions, since they're in the cache.
+    """
+    waymap, file_path = job
+    ways = waymap.run_extraction(file_path)
+    return None if waymap.use_cache else ways
+
+
+def match_extract_type(extract_type, tags):
+    """Return (matches, way_type) for a way with a list of (key, value) tags, by extract_type.
+
+    tennis matches ways tagged sport=tennis, with no way_type. highway, footway and cycleway
+    match ways with that tag, and its value is the way_type, but for roads analysis, highway
+    doesn't match ways that don't allow vehicle access (motor_vehicle=no).
+    """
+    if extract_type == 'tennis':
+        return ('sport', 'tennis') in tags, None
+    way_type = None
+    for key, value in tags:
+        if key == extract_type:
+            way_type = value
+        if extract_type == 'highway' and key == 'motor_vehicle' and value == 'no':
+            return False, None
+    return way_type is not None, way_type
 
 
 class WayExtracter(o.SimpleHandler):
     """Subclass of osmium SimpleHandler to extract ways from OpenStreetMap PBF files."""
 
-    def __init__(self, extract_type='highway'):
-        """Extract ways from OpenStreetMap PBF files."""
+    def __init__(self, extract_type='highway', keep_tags=True, extents=None):
+        """Extract ways from OpenStreetMap PBF files, into a Ways column store.
+
+        With extents, only ways whose bounding boxes overlap one of them are extracted.
+        """
         o.SimpleHandler.__init__(self)
-        self.ways = []
-        self.way_dict = {}
+        self.ways = Ways(keep_tags)
+        self.extents = None
+        if extents is not None:
+            self.extents = numpy.array(extents, dtype=numpy.float64).reshape(-1, 4)
+        # reused for each way's points and node ids, instead of new lists per way
+        self.coords = array('d')
+        self.node_ids = array('l')
         self.types = []
         self.extract_type = extract_type
 
     def way(self, w):
         """Fire this callback when osmium parses a way in the PBF file."""
-        if self.extract_type == 'tennis':
-            self.extract_if_tennis_court(w)
-        else:
-            self.extract_way_type(w)
-
-    def extract_if_tennis_court(self, w):
-        """Extract the way of it has a 'sport' tag with value 'tennis'."""
-        is_tennis = False
-        for tag in w.tags:
-            if tag.k == 'sport' and 'tennis' == tag.v:
-                is_tennis = True
-
-        if not is_tennis:
-            return
-
-        way_dict = {'uid': w.uid,
-                    'ends_have_same_id': w.ends_have_same_id(),
-                    'id': w.id,
-                    'tags': []}
-
-        for tag in w.tags:
-            way_dict['tags'].append((tag.k, tag.v))
-        self.add_linestring(w, way_dict)
-
-    def extract_way_type(self, w):
-        """Extract the way (w) if its type matches extract_type (highway, footway, or cycleway)."""
-        should_extract = False
-        way_type = None
-        for tag in w.tags:
-            if tag.k == self.extract_type:
-                way_type = tag.v
-                should_extract = True
-            # for roads analysis, don't extract ways that don't allow vehicle access
-            if self.extract_type == 'highway' and tag.k == 'motor_vehicle' and tag.v == 'no':
-                return
-
-        if not should_extract:
+        tags = [(tag.k, tag.v) for tag in w.tags]
+        matches, way_type = match_extract_type(self.extract_type, tags)
+        if not matches:
             return
-
-        if way_type not in self.types:
+        if way_type is not None and way_type not in self.types:
             self.types.append(way_type)
+        self.add_linestring(w, {'id': w.id, 'way_type': way_type, 'tags': tags})
 
-        way_dict = {'visible': w.visible,
-                    'deleted': w.deleted,
-                    'uid': w.uid,
-                    'way_type': way_type,
-                    'ends_have_same_id': w.ends_have_same_id(),
-                    'id': w.id,
-                    'tags': []}
+    def read_line(self, w):
+        """Read w's points into self.coords and self.node_ids, and return if it's a line to extract.
 
-        for tag in w.tags:
-            way_dict['tags'].append((tag.k, tag.v))
-        self.add_linestring(w, way_dict)
+        It isn't if a node has no location, it's a single point, or it's outside the extents.
+        """
+        if not way_lon_lats(w, self.coords, self.node_ids):
+            return False
+        if len(self.coords) < 4:
+            return False
+        return self.extents is None or way_in_extents(self.coords, self.extents)
 
     def add_linestring(self, w, way_dict):
-        """Append the way_dict, with coords normalized to (lat,lon) instead of (lon,lat) pairs."""
-        try:
-            wkb = wkbfab.create_linestring(w)
-        except:  # throws on single point ways
-            return
-        line = wkblib.loads(wkb, hex=True)
-        way_dict['linestring'] = list(line.coords)
-        self.ways.append(way_dict)
+        """Append the way in way_dict to self.ways, with the (lon, lat) points of w's nodes."""
+        if self.read_line(w):
+            self.ways.append_coords(way_dict['id'], way_dict.get('way_type'), self.coords,
+                                    way_dict['tags'], self.node_ids)
 
 
-def download_and_extract(file_urls_to_download, extract_type='highway'):
-    """Download PBFs file_urls_to_download, and extract ways that match extract_type."""
-    file_paths = download_files(file_urls_to_download)
-    w = WayMap(extract_type=extract_type)
-    w.extract_files(file_paths)
-    return w
+class MultiWayExtracter(WayExtracter):
+    """A WayExtracter for several extract types at once, each into its own Ways.
+
+    self.ways is a dict of Ways by extract type, and each way is matched against every extract
+    type's rule (see match_extract_type), but its tags and points are only read once.
+    """
+
+    def __init__(self, extract_types, keep_tags=True, extents=None):
+        """Extract ways of each of extract_types from OpenStreetMap PBF files."""
+        WayExtracter.__init__(self, None, keep_tags, extents)
+        self.extract_types = list(extract_types)
+        self.ways = dict((extract_type, Ways(keep_tags)) for extract_type in self.extract_types)
+
+    def way(self, w):
+        """Fire this callback when osmium parses a way in the PBF file."""
+        tags = [(tag.k, tag.v) for tag in w.tags]
+        matched = []
+        for extract_type in self.extract_types:
+            matches, way_type = match_extract_type(extract_type, tags)
+            if matches:
+                matched.append((extract_type, way_type))
+        if not matched or not self.read_line(w):
+            return
+        for extract_type, way_type in matched:
+            self.ways[extract_type].append_coords(w.id, way_type, self.coords, tags,
+                                                  self.node_ids)
 
 
 def download_file(url):
-    """Download a large file in chunks and return its local path."""
+    """Download a large file, resumably and checked against its .md5, and return its local path."""
     local_filename = url.split('/')[-1]
     full_local_filename = os.path.join(RAW_LABEL_DATA_DIR, local_filename)
-    r = requests.get(url, stream=True)
-    with open(full_local_filename, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:  # filter out keep-alive new chunks
-                f.write(chunk)
-    return full_local_filename
+    return download(url, full_local_filename)
 
 
 def download_files(url_list):
@@ -139,7 +343,7 @@ def download_files(url_list):
     for url in url_list:
         local_filename = url.split('/')[-1]
         full_local_filename = os.path.join(RAW_LABEL_DATA_DIR, local_filename)
-        if not os.path.exists(full_local_filename):
+        if not is_downloaded(url, full_local_filename):
             paths.append(download_file(url))
         else:
             paths.append(full_local_filename)
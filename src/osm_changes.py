@@ -0,0 +1,168 @@
+"""Apply OpenStreetMap change files (.osc) to extracted Ways, instead of extracting again.
+
+read_changes reads the node and way edits in change files, like Geofabrik's daily diffs, and
+apply_changes rebuilds only the ways they touch: ways edited in the changes, and extracted ways
+with a node that moved. Node locations come from the change files, then from the points of the
+extracted ways, and last, for any still missing, from one pass over the PBFs.
+"""
+
+from __future__ import print_function
+import numpy
+import osmium as o
+from src.openstreetmap_labels import match_extract_type, way_in_extents
+from src.ways import NO_WAY_TYPE, Ways
+
+
+class ChangeReader(o.SimpleHandler):
+    """Collect the node and way edits in change files; an object's last edit is kept."""
+
+    def __init__(self):
+        """Start with no edits."""
+        o.SimpleHandler.__init__(self)
+        # node id: (lon, lat), or None if it was deleted
+        self.nodes = {}
+        # way id: (tags, node ids), or None if it was deleted
+        self.ways = {}
+
+    def node(self, n):
+        """Record a created, moved or deleted node."""
+        if n.deleted or not n.location.valid():
+            self.nodes[n.id] = None
+        else:
+            self.nodes[n.id] = (n.location.lon, n.location.lat)
+
+    def way(self, w):
+        """Record a created, modified or deleted way."""
+        if w.deleted:
+            self.ways[w.id] = None
+        else:
+            self.ways[w.id] = ([(tag.k, tag.v) for tag in w.tags], [node.ref for node in w.nodes])
+
+
+class NodeFinder(o.SimpleHandler):
+    """Find the locations of a set of nodes in a PBF."""
+
+    def __init__(self, node_ids):
+        """Look for the nodes in node_ids."""
+        o.SimpleHandler.__init__(self)
+        self.node_ids = set(node_ids)
+        self.locations = {}
+
+    def node(self, n):
+        """Record the location of a node being looked for."""
+        if n.id in self.node_ids and n.location.valid():
+            self.locations[n.id] = (n.location.lon, n.location.lat)
+
+
+def read_changes(change_files):
+    """Return the (nodes, ways) edit dicts of ChangeReader, for change_files applied in order."""
+    reader = ChangeReader()
+    for path in change_files:
+        reader.apply_file(path)
+    return reader.nodes, reader.ways
+
+
+def find_node_locations(pbf_paths, node_ids):
+    """Return a dict of the (lon, lat) of each of node_ids found in pbf_paths."""
+    finder = NodeFinder(node_ids)
+    for path in pbf_paths:
+        finder.apply_file(path)
+    return finder.locations
+
+
+def extracted_node_locations(ways, node_ids):
+    """Return a dict of the (lon, lat) of each of node_ids that's a point of ways."""
+    node_ids = numpy.array(sorted(node_ids), dtype=numpy.int64)
+    order = numpy.argsort(ways.node_ids, kind='mergesort')
+    sorted_ids = ways.node_ids[order]
+    positions = numpy.minimum(numpy.searchsorted(sorted_ids, node_ids), len(sorted_ids) - 1)
+    found = (sorted_ids[positions] == node_ids) if len(sorted_ids) else \
+        numpy.zeros(len(node_ids), dtype=bool)
+    points = ways.coords[order[positions[found]]]
+    return dict((node_id, tuple(point)) for node_id, point in zip(node_ids[found].tolist(),
+                                                                  points.tolist()))
+
+
+def line_points(node_ids, locations):
+    """Return (coords, node_ids) for a way's nodes, like way_lon_lats, or None if one is missing.
+
+    coords is a flat lon, lat list, without repeats of the same location in a row.
+    """
+    coords, kept = [], []
+    for node_id in node_ids:
+        location = locations.get(node_id)
+        if location is None:
+            return None
+        if coords and (coords[-2], coords[-1]) == location:
+            continue
+        coords.extend(location)
+        kept.append(node_id)
+    return coords, kept
+
+
+def apply_changes(ways, nodes, changed_ways, extract_type, extents=None, pbf_paths=()):
+    """Apply read_changes' edits to ways, extracted for extract_type within extents (optional).
+
+    Returns (updated, touched): a new Ways of ways with the edits applied, and a Ways of the old
+    and new versions of every way that was rebuilt or removed, to find what they cover.
+    pbf_paths are the PBFs ways were extracted from, to look up nodes the changes reference but
+    don't move, and that aren't points of ways; ways with nodes that still can't be found are
+    dropped, like extraction drops ways with nodes missing from the PBF.
+    """
+    if extents is not None:
+        extents = numpy.array(extents, dtype=numpy.float64).reshape(-1, 4)
+    offsets = ways.offsets
+    way_numbers = numpy.repeat(numpy.arange(len(ways)), numpy.diff(offsets))
+    # points whose node moved or was deleted, not just retagged
+    moved = numpy.in1d(ways.node_ids, numpy.array(sorted(nodes), dtype=numpy.int64))
+    moved_points = numpy.flatnonzero(moved)
+    new_locations = numpy.array([nodes[node_id] or (numpy.nan, numpy.nan)
+                                 for node_id in ways.node_ids[moved_points].tolist()],
+                                dtype=numpy.float64).reshape(-1, 2)
+    moved[moved_points] = (ways.coords[moved_points] != new_locations).any(axis=1)
+    edited = numpy.in1d(ways.ids, numpy.array(sorted(changed_ways), dtype=numpy.int64))
+    old_numbers = numpy.union1d(way_numbers[moved], numpy.flatnonzero(edited))
+
+    # the (way_type, tags, node ids) of each way to rebuild: the extracted ways with moved
+    # nodes, as they were, and the edited ways that are of extract_type
+    rebuilding = {}
+    for number in old_numbers[~edited[old_numbers]].tolist():
+        code = ways.type_codes[number]
+        rebuilding[int(ways.ids[number])] = (ways.types[code] if code != NO_WAY_TYPE else None,
+                                             ways.tags(number),
+                                             ways.node_ids[offsets[number]:offsets[number + 1]])
+    for way_id, change in changed_ways.items():
+        if change is None:
+            continue
+        tags, node_ids = change
+        matches, way_type = match_extract_type(extract_type, tags)
+        if matches:
+            rebuilding[way_id] = (way_type, tags, node_ids)
+
+    locations = dict((node_id, location) for node_id, location in nodes.items()
+                     if location is not None)
+    needed = set(node_id for _, _, node_ids in rebuilding.values()
+                 for node_id in numpy.asarray(node_ids).tolist()) - set(nodes)
+    locations.update(extracted_node_locations(ways, needed))
+    missing = needed - set(locations)
+    if missing and pbf_paths:
+        print("LOOKING UP {} nodes in {}".format(len(missing), ', '.join(pbf_paths)))
+        locations.update(find_node_locations(pbf_paths, missing))
+
+    rebuilt = Ways(ways.keep_tags)
+    for way_id in sorted(rebuilding):
+        way_type, tags, node_ids = rebuilding[way_id]
+        points = line_points(numpy.asarray(node_ids).tolist(), locations)
+        if points is None or len(points[0]) < 4:
+            continue
+        coords, kept = points
+        if extents is not None and not way_in_extents(coords, extents):
+            continue
+        rebuilt.append_coords(way_id, way_type, coords, tags, kept)
+
+    unchanged = numpy.setdiff1d(numpy.arange(len(ways)), old_numbers)
+    removed = len(set(ways.ids[old_numbers].tolist()) - set(rebuilt.ids.tolist()))
+    print("APPLIED changes: rebuilt {} ways, removed {}".format(len(rebuilt), removed))
+    updated = Ways.concatenate([ways.take(unchanged), rebuilt])
+    touched = Ways.concatenate([ways.take(old_numbers), rebuilt])
+    return updated, touched
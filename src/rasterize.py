@@ -0,0 +1,112 @@
+"""Draw way segments into label rasters with numpy, all segments of a NAIP at once.
+
+Each segment is walked one pixel per step along its longer axis (a DDA), every segment's steps
+are laid end to end in one array, and the pixels are set with a single fancy-index assignment.
+"""
+
+import numpy
+
+# how many pixels rasterize_segments draws at once, to bound its temporary arrays
+RASTERIZE_CHUNK_PIXELS = 1 << 22
+
+
+def segment_pixels(x0, y0, x1, y1):
+    """Return the (xs, ys, segment ids) of the pixels along each segment from (x0, y0) to (x1, y1).
+
+    Takes arrays of pixel coordinates, one entry per segment. Both end pixels are included.
+    """
+    x0, y0, x1, y1 = [numpy.asarray(a, dtype=numpy.float64) for a in (x0, y0, x1, y1)]
+    dx, dy = x1 - x0, y1 - y0
+    steps = numpy.maximum(numpy.abs(dx), numpy.abs(dy)).astype(numpy.int64) + 1
+    segment_ids = numpy.repeat(numpy.arange(len(steps)), steps)
+    # position of each pixel along its own segment, from 0 to 1
+    first_step = numpy.cumsum(steps) - steps
+    t = numpy.arange(len(segment_ids)) - first_step[segment_ids]
+    t = t / numpy.maximum(steps - 1, 1).astype(numpy.float64)[segment_ids]
+    xs = numpy.floor(x0[segment_ids] + dx[segment_ids] * t).astype(numpy.int64)
+    ys = numpy.floor(y0[segment_ids] + dy[segment_ids] * t).astype(numpy.int64)
+    return xs, ys, segment_ids
+
+
+def rasterize_segments(bitmap, x0, y0, x1, y1, pixels_to_fatten_roads=0, border=0, value=1):
+    """Set value along each segment from (x0, y0) to (x1, y1), in pixel coordinates, on bitmap.
+
+    Lines are fattened by pixels_to_fatten_roads pixels on each side: up, down, left and right,
+    or only left and right for vertical segments. Pixels within border of the bitmap's edges
+    are left alone. Returns bitmap.
+    """
+    x0, y0, x1, y1 = [numpy.asarray(a, dtype=numpy.float64).ravel() for a in (x0, y0, x1, y1)]
+    rows, cols = bitmap.shape
+    fatten = pixels_to_fatten_roads or 0
+    offsets = numpy.arange(1, fatten + 1)
+    # stamp offsets (dx, dy, only for non-vertical segments)
+    stamp = [(0, 0, False)]
+    stamp += [(o, 0, False) for o in offsets] + [(-o, 0, False) for o in offsets]
+    stamp += [(0, o, True) for o in offsets] + [(0, -o, True) for o in offsets]
+
+    lengths = numpy.maximum(numpy.abs(x1 - x0), numpy.abs(y1 - y0)) + 1
+    chunk_ends = numpy.searchsorted(numpy.cumsum(lengths),
+                                    numpy.arange(RASTERIZE_CHUNK_PIXELS, lengths.sum(),
+                                                 RASTERIZE_CHUNK_PIXELS))
+    for chunk in numpy.split(numpy.arange(len(x0)), chunk_ends):
+        if not len(chunk):
+            continue
+        xs, ys, segment_ids = segment_pixels(x0[chunk], y0[chunk], x1[chunk], y1[chunk])
+        vertical = numpy.floor(x0[chunk]) == numpy.floor(x1[chunk])
+        not_vertical = ~vertical[segment_ids]
+        for dx, dy, skip_vertical in stamp:
+            px, py = xs + dx, ys + dy
+            keep = ((px >= border) & (px < cols - border) &
+                    (py >= border) & (py < rows - border))
+            if skip_vertical:
+                keep &= not_vertical
+            bitmap[py[keep], px[keep]] = value
+    return bitmap
+
+
+# distances are clipped at this many pixels, so they fit in a uint8 raster
+DISTANCE_LABEL_MAX = 32
+
+# how many rows distance_transform works on at once, to bound its temporary arrays
+DISTANCE_STRIP_ROWS = 1024
+
+
+def distance_transform(bitmap, max_distance=DISTANCE_LABEL_MAX):
+    """Return a uint8 raster of each pixel's distance to the nearest set pixel of bitmap.
+
+    Distances are Euclidean, rounded up, so distance <= d means within d pixels, and are
+    clipped at max_distance, which stands for max_distance px or more. The exact transform is
+    taken separably (along rows, then down columns), over a strip of rows at a time.
+    """
+    bitmap = numpy.asarray(bitmap) != 0
+    rows = bitmap.shape[0]
+    distances = numpy.empty(bitmap.shape, dtype=numpy.uint8)
+    for start in range(0, rows, DISTANCE_STRIP_ROWS):
+        stop = min(start + DISTANCE_STRIP_ROWS, rows)
+        # the strip, plus the rows within max_distance above and below it
+        halo_start, halo_stop = max(start - max_distance, 0), min(stop + max_distance, rows)
+        squared = squared_distances(bitmap[halo_start:halo_stop], max_distance)
+        squared = squared[start - halo_start:stop - halo_start]
+        distances[start:stop] = numpy.minimum(numpy.ceil(numpy.sqrt(squared)), max_distance)
+    return distances
+
+
+def squared_distances(bitmap, max_distance):
+    """Return the squared distance to the nearest set pixel, or more if over max_distance."""
+    rows, cols = bitmap.shape
+    # distance to the nearest set pixel in the same row, nearest last
+    row_distances = numpy.full(bitmap.shape, max_distance + 1, dtype=numpy.uint16)
+    for offset in range(min(max_distance, cols - 1), -1, -1):
+        near = numpy.zeros(bitmap.shape, dtype=bool)
+        near[:, offset:] |= bitmap[:, :cols - offset]
+        near[:, :cols - offset] |= bitmap[:, offset:]
+        row_distances[near] = offset
+    row_squared = row_distances ** 2
+    # then the nearest of those, from the rows within max_distance above and below
+    squared = row_squared.copy()
+    for offset in range(1, min(max_distance, rows - 1) + 1):
+        from_above = row_squared[:-offset] + offset ** 2
+        numpy.minimum(squared[offset:], from_above, out=squared[offset:])
+        from_below = row_squared[offset:] + offset ** 2
+        numpy.minimum(squared[:-offset], from_below, out=squared[:-offset])
+    return squared
@@ -13,8 +13,9 @@ from src.training_visualization import render_results_for_analysis
 def post_findings_to_s3(raster_data_paths, model, training_info, bands, render_results):
     """Aggregate findings from all NAIPs into a pickled list, post to S3."""
     findings = []
+    params = training_info['label_params']
     for path in raster_data_paths:
-        labels, images = load_all_training_tiles(path, bands)
+        labels, images = load_all_training_tiles(path, bands, params)
         if len(labels) == 0 or len(images) == 0:
             print("WARNING, there is a borked naip image file")
             continue
@@ -26,7 +27,7 @@ def post_findings_to_s3(raster_data_paths, model, training_info, bands, render_r
         if render_results:
             # render JPEGs showing findings
             render_results_for_analysis([path], false_positives, fp_images, training_info['bands'],
-                                        training_info['tile_size'])
+                                        training_info['tile_size'], params)
 
         # combine findings for all NAIP images analyzedfor the region
         [findings.append(f) for f in tag_with_locations(fp_images, false_positives,
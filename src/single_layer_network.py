@@ -7,45 +7,41 @@ import time
 import tensorflow as tf
 import tflearn
 from tflearn.layers.conv import conv_2d, max_pool_2d
-from src.config import MODEL_METADATA_FILE, MODEL_FILE, METADATA_FILE
-from src.training_data import load_training_tiles, equalize_data, format_as_onehot_arrays, has_ways_in_center
+from src.config import MODEL_METADATA_FILE, MODEL_FILE, METADATA_FILE, TILE_STORE_DIR
+from src.tile_store import BalancedSampler, TrainingDataset
+from src.training_data import format_as_onehot_arrays, has_ways_in_center_batch
 
 
-def train_on_cached_data(neural_net_type, number_of_epochs):
-    """Load tiled/cached training data in batches, and train the neural net."""
+def train_on_cached_data(neural_net_type, number_of_epochs, on_off_ratio=1.0):
+    """Load tiled/cached training data in batches, and train the neural net.
+
+    Batches are drawn by a BalancedSampler, with on_off_ratio tiles that have a road through
+    the center for every tile without one.
+    """
 
     with open(METADATA_FILE, 'r') as infile:
         training_info = pickle.load(infile)
     bands = training_info['bands']
     tile_size = training_info['tile_size']
 
-    training_images = []
-    onehot_training_labels = []
+    dataset = TrainingDataset(TILE_STORE_DIR)
     model = None
 
-    # there are usually 100+ images with road through the middle, out of every 10,000
-    # because we want half on, half off, and discard most images
-    EQUALIZATION_BATCH_SIZE = 10000
+    # the number of ON and OFF tiles to train each mini batch on
+    TRAINING_BATCH_SIZE = 100
 
-    # the number of times to pull EQUALIZATION_BATCH_SIZE images from disk
+    # the number of mini batches to pull from disk
     NUMBER_OF_BATCHES = 50
 
+    sampler = BalancedSampler(dataset, TRAINING_BATCH_SIZE, on_off_ratio)
+    print("SAMPLING {} batches per epoch of the {} tile dataset".format(len(sampler), len(dataset)))
+    batches = sampler.batches()
     for x in range(0, NUMBER_OF_BATCHES):
-        new_label_paths = load_training_tiles(EQUALIZATION_BATCH_SIZE)
-        print("Got batch of {} labels".format(len(new_label_paths)))
-        new_training_images, new_onehot_training_labels = format_as_onehot_arrays(new_label_paths)
-        equal_count_way_list, equal_count_tile_list = equalize_data(new_onehot_training_labels,
-                                                                    new_training_images, False)
-        [training_images.append(i) for i in equal_count_tile_list]
-        [onehot_training_labels.append(l) for l in equal_count_way_list]
-
-        # once we have 100 test_images, train on a mini batch
-        if len(training_images) >= 100:
-            # continue training the model with the new data set
-            model = train_with_data(onehot_training_labels, training_images, neural_net_type, bands,
-                                    tile_size, number_of_epochs, model)
-            training_images = []
-            onehot_training_labels = []
+        tile_ids = next(batches)
+        training_images, onehot_training_labels = format_as_onehot_arrays(dataset, tile_ids)
+        # continue training the model with the new data set
+        model = train_with_data(onehot_training_labels, training_images, neural_net_type, bands,
+                                tile_size, number_of_epochs, model)
 
     save_model(model, neural_net_type, bands, tile_size)
 
@@ -56,11 +52,7 @@ def train_with_data(onehot_training_labels, training_images,
                     neural_net_type, band_list, tile_size, number_of_epochs, model):
     """Package data for tensorflow and analyze."""
     npy_training_labels = numpy.asarray(onehot_training_labels)
-
-    # normalize 0-255 values to 0-1
-    norm_training_images = numpy.array([img_loc_tuple[0] for img_loc_tuple in training_images])
-    norm_train_images = norm_training_images.astype(numpy.float32)
-    norm_train_images = numpy.multiply(norm_train_images, 1.0 / 255.0)
+    norm_train_images = normalize_tiles(training_images)
 
     with tf.Graph().as_default():
         if not model:
@@ -82,6 +74,16 @@ def train_with_data(onehot_training_labels, training_images,
     return model
 
 
+def normalize_tiles(tiles):
+    """Stack uint8 tiles into one float32 array, with 0-255 values normalized to 0-1.
+
+    This is the only copy made of the tiles, so pass views (e.g. from tile_view) where possible.
+    """
+    norm_tiles = numpy.asarray(tiles, dtype=numpy.float32)
+    norm_tiles *= 1.0 / 255.0
+    return norm_tiles
+
+
 def model_for_type(neural_net_type, tile_size, on_band_count):
     """The neural_net_type can be: one_layer_relu,
                                    one_layer_relu_conv,
@@ -134,29 +136,27 @@ def load_model(neural_net_type, tile_size, on_band_count):
 
 def list_findings(labels, test_images, model):
     """Return lists of predicted false negative/positive labels/data."""
-    npy_test_images = numpy.array([img_loc_tuple[0] for img_loc_tuple in test_images])
-    npy_test_images = npy_test_images.astype(numpy.float32)
-    npy_test_images = numpy.multiply(npy_test_images, 1.0 / 255.0)
-
     false_pos = []
     fp_images = []
     index = 0
-    for x in range(0, len(npy_test_images) - 100, 100):
-        images = npy_test_images[x:x + 100]
+    # whether OpenStreetMap has a way within 1px and 16px of each tile's center
+    ways_in_center = has_ways_in_center_batch(numpy.array([label[0] for label in labels]), [1, 16])
+    for x in range(0, len(test_images) - 100, 100):
         image_tuples = test_images[x:x + 100]
+        images = normalize_tiles([img_loc_tuple[0] for img_loc_tuple in image_tuples])
         index, false_pos, fp_images = sort_findings(model,
                                                     image_tuples,
                                                     images,
-                                                    labels,
+                                                    ways_in_center,
                                                     false_pos,
                                                     fp_images,
                                                     index)
-    images = npy_test_images[index:]
     image_tuples = test_images[index:]
+    images = normalize_tiles([img_loc_tuple[0] for img_loc_tuple in image_tuples])
     index, false_pos, fp_images = sort_findings(model,
                                                 image_tuples,
                                                 images,
-                                                labels,
+                                                ways_in_center,
                                                 false_pos,
                                                 fp_images,
                                                 index)
@@ -164,18 +164,19 @@ def list_findings(labels, test_images, model):
     return false_pos, fp_images
 
 
-def sort_findings(model, image_tuples, test_images, labels, false_positives, fp_images, index):
+def sort_findings(model, image_tuples, test_images, ways_in_center, false_positives, fp_images,
+                  index):
     """False positive if model says road doesn't exist, but OpenStreetMap says it does.
 
     False negative if model says road exists, but OpenStreetMap doesn't list it.
+    ways_in_center is the (N, 2) has_ways_in_center_batch result for tolerances of 1 and 16.
     """
     pred_index = 0
     for p in model.predict(test_images):
-        label = labels[index][0]
-        if has_ways_in_center(label, 1) and p[0] > .5:
+        if ways_in_center[index, 0] and p[0] > .5:
             false_positives.append(p)
             fp_images.append(image_tuples[pred_index])
-        # elif not has_ways_in_center(label, 16) and p[0] <= .5:
+        # elif not ways_in_center[index, 1] and p[0] <= .5:
         #    false_negatives.append(p)
         #    fn_images.append(image_tuples[pred_index])
         pred_index += 1
@@ -185,16 +186,15 @@ def sort_findings(model, image_tuples, test_images, labels, false_positives, fp_
 
 def predictions_for_tiles(test_images, model):
     """Batch predictions on the test image set, to avoid a memory spike."""
-    npy_test_images = numpy.array([img_loc_tuple[0] for img_loc_tuple in test_images])
-    test_images = npy_test_images.astype(numpy.float32)
-    test_images = numpy.multiply(test_images, 1.0 / 255.0)
-
     all_predictions = []
     for x in range(0, len(test_images) - 100, 100):
-        for p in model.predict(test_images[x:x + 100]):
+        images = normalize_tiles([img_loc_tuple[0] for img_loc_tuple in test_images[x:x + 100]])
+        for p in model.predict(images):
             all_predictions.append(p)
 
-    for p in model.predict(test_images[len(all_predictions):]):
+    images = normalize_tiles([img_loc_tuple[0] for img_loc_tuple in
+                              test_images[len(all_predictions):]])
+    for p in model.predict(images):
         all_predictions.append(p)
     assert len(all_predictions) == len(test_images)
 
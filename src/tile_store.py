@@ -0,0 +1,326 @@
+"""Store training tiles in a few large, memory-mappable shards, instead of one file per tile.
+
+Each NAIP's tiles are written to one or more shards: an images array of shape
+(N, tile_size, tile_size, bands) and a labels array of shape (N, tile_size, tile_size), both
+uint8 .npy files written with numpy.lib.format.open_memmap. A pickled index records, for
+every tile, its shard, its offset in the shard, the NAIP it was cut from, and its (col, row).
+
+The index also summarizes each label tile: its way pixel count, its center distance (the
+smallest tolerance has_ways_in_center is True at), and its ON/OFF/AMBIGUOUS class. For a store
+of LABEL_DISTANCE labels, these summarize the ways fattened by the store's pixels_to_fatten_roads,
+like bitmap labels are drawn, so both formats class the same tiles alike, and for LABEL_CLASSES
+labels, they summarize ways of every class.
+"""
+
+from __future__ import print_function
+import os
+import pickle
+
+import numpy
+from numpy.lib.format import open_memmap
+from src.label_rasters import LABEL_BITMAP, center_distances, label_mask, road_pixel_counts
+
+INDEX_FILENAME = 'index.pickle'
+
+TILE_INDEX_DTYPE = numpy.dtype([('shard', numpy.int32),
+                                ('offset', numpy.int32),
+                                ('naip', numpy.int32),
+                                ('col', numpy.int32),
+                                ('row', numpy.int32),
+                                ('road_pixels', numpy.int32),
+                                ('center_distance', numpy.int16),
+                                ('label_class', numpy.int8)])
+
+# label classes: OFF tiles have no ways near the center, ON tiles have a way through the center,
+# and AMBIGUOUS tiles are in between, and get left out of training
+TILE_OFF = 0
+TILE_ON = 1
+TILE_AMBIGUOUS = 2
+
+# a tile is ON if a way is within ON_TOLERANCE px of its center, OFF if none is within
+# OFF_TOLERANCE px
+ON_TOLERANCE = 1
+OFF_TOLERANCE = 16
+
+
+def classify_center_distances(distances, on_tolerance=ON_TOLERANCE, off_tolerance=OFF_TOLERANCE):
+    """Return the TILE_ON/TILE_OFF/TILE_AMBIGUOUS class for an array of center distances."""
+    distances = numpy.asarray(distances)
+    label_classes = numpy.full(distances.shape, TILE_AMBIGUOUS, dtype=numpy.int8)
+    label_classes[distances <= on_tolerance] = TILE_ON
+    label_classes[distances > off_tolerance] = TILE_OFF
+    return label_classes
+
+
+def shard_paths(store_dir, shard_name):
+    """Return the paths of the images and labels arrays for shard_name."""
+    return (os.path.join(store_dir, shard_name + '-images.npy'),
+            os.path.join(store_dir, shard_name + '-labels.npy'))
+
+
+def write_naip_shards(store_dir, naip_number, tile_size, band_count, tile_count, tiles,
+                      tiles_per_shard=None, label_format=LABEL_BITMAP, pixels_to_fatten_roads=0):
+    """Write the tiles cut from one NAIP into shards, and return a (shard_name, summary) list.
+
+    Tiles is an iterable of tile_count (image, label, (col, row)) tuples. Shards are named after
+    naip_number, and hold at most tiles_per_shard tiles (by default, all of the NAIP's tiles).
+    Each summary is a TILE_INDEX_DTYPE array with the origin and label summary of every tile in
+    the shard filled in, for labels of label_format (and pixels_to_fatten_roads, see
+    summarize_shard).
+    """
+    tiles_per_shard = tiles_per_shard or max(tile_count, 1)
+    shards = []
+    images = labels = origins = None
+    offset = 0
+    for image, label, origin in tiles:
+        if images is None or offset == len(images):
+            shard_name = '{0:06d}-{1:04d}'.format(naip_number, len(shards))
+            shard_size = min(tiles_per_shard, tile_count - len(shards) * tiles_per_shard)
+            images_path, labels_path = shard_paths(store_dir, shard_name)
+            images = open_memmap(images_path, mode='w+', dtype=numpy.uint8,
+                                 shape=(shard_size, tile_size, tile_size, band_count))
+            labels = open_memmap(labels_path, mode='w+', dtype=numpy.uint8,
+                                 shape=(shard_size, tile_size, tile_size))
+            origins = numpy.zeros((shard_size, 2), dtype=numpy.int32)
+            shards.append((shard_name, origins))
+            offset = 0
+        images[offset] = image
+        labels[offset] = label
+        origins[offset] = origin
+        offset += 1
+    for shard in (images, labels):
+        if shard is not None:
+            shard.flush()
+    return [(name, summarize_shard(store_dir, name, shard_origins, label_format,
+                                   pixels_to_fatten_roads))
+            for name, shard_origins in shards]
+
+
+def summarize_shard(store_dir, shard_name, origins, label_format=LABEL_BITMAP,
+                    pixels_to_fatten_roads=0):
+    """Return a TILE_INDEX_DTYPE array with the origins and label summaries of a shard's tiles.
+
+    Distance labels are summarized as ways fattened by pixels_to_fatten_roads, the width bitmap
+    labels are drawn with.
+    """
+    labels = numpy.load(shard_paths(store_dir, shard_name)[1], mmap_mode='r')
+    if label_format != LABEL_BITMAP:
+        labels = label_mask(labels, label_format, pixels_to_fatten_roads)
+    summary = numpy.zeros(len(origins), dtype=TILE_INDEX_DTYPE)
+    summary['col'] = origins[:, 0]
+    summary['row'] = origins[:, 1]
+    summary['road_pixels'] = road_pixel_counts(labels)
+    summary['center_distance'] = center_distances(labels)
+    summary['label_class'] = classify_center_distances(summary['center_distance'])
+    return summary
+
+
+class TileStoreWriter:
+    """Write tiles for a set of NAIPs into a sharded tile store."""
+
+    def __init__(self, store_dir, tile_size, band_count, tiles_per_shard=None,
+                 label_format=LABEL_BITMAP, pixels_to_fatten_roads=0):
+        """Start a new tile store in store_dir, which should already exist.
+
+        pixels_to_fatten_roads is how fattened the ways in the labels are, or for distance
+        labels, how fattened to summarize them as.
+        """
+        self.store_dir = store_dir
+        self.tile_size = tile_size
+        self.band_count = band_count
+        self.tiles_per_shard = tiles_per_shard
+        self.label_format = label_format
+        self.pixels_to_fatten_roads = pixels_to_fatten_roads
+        self.naip_paths = []
+        self.shard_names = []
+        self.tile_index = []
+
+    def add_naip(self, naip_path, tile_count, tiles):
+        """Write the tile_count (image, label, (col, row)) tuples in tiles, cut from naip_path."""
+        shards = write_naip_shards(self.store_dir, len(self.naip_paths), self.tile_size,
+                                   self.band_count, tile_count, tiles, self.tiles_per_shard,
+                                   self.label_format, self.pixels_to_fatten_roads)
+        self.add_shards(naip_path, shards)
+
+    def add_shards(self, naip_path, shards):
+        """Index the (shard_name, summary) shards already written for naip_path."""
+        naip_number = len(self.naip_paths)
+        self.naip_paths.append(naip_path)
+        for shard_name, summary in shards:
+            entries = summary.copy()
+            entries['shard'] = len(self.shard_names)
+            entries['offset'] = numpy.arange(len(entries))
+            entries['naip'] = naip_number
+            self.shard_names.append(shard_name)
+            self.tile_index.append(entries)
+
+    def close(self):
+        """Write the index for every tile added, and return how many tiles there are."""
+        if self.tile_index:
+            tiles = numpy.concatenate(self.tile_index)
+        else:
+            tiles = numpy.zeros(0, dtype=TILE_INDEX_DTYPE)
+        index = {'tile_size': self.tile_size,
+                 'band_count': self.band_count,
+                 'label_format': self.label_format,
+                 'pixels_to_fatten_roads': self.pixels_to_fatten_roads,
+                 'naip_paths': self.naip_paths,
+                 'shards': self.shard_names,
+                 'tiles': tiles}
+        with open(os.path.join(self.store_dir, INDEX_FILENAME), 'wb') as outfile:
+            pickle.dump(index, outfile, pickle.HIGHEST_PROTOCOL)
+        return len(tiles)
+
+
+def load_tile_index(store_dir):
+    """Return the index dict written by TileStoreWriter.close."""
+    with open(os.path.join(store_dir, INDEX_FILENAME), 'rb') as infile:
+        return pickle.load(infile)
+
+
+def indexed_shards(index, naip_number):
+    """Return the (shard_name, summary) list for naip_number's shards, from a tile store index.
+
+    To pass to TileStoreWriter.add_shards, to index a NAIP's shards again without rewriting them.
+    """
+    tiles = index['tiles'][index['tiles']['naip'] == naip_number]
+    return [(index['shards'][shard], tiles[tiles['shard'] == shard])
+            for shard in numpy.unique(tiles['shard'])]
+
+
+def load_shard(store_dir, shard_name):
+    """Return the (images, labels) arrays of shard_name, memory mapped read-only."""
+    images_path, labels_path = shard_paths(store_dir, shard_name)
+    return numpy.load(images_path, mmap_mode='r'), numpy.load(labels_path, mmap_mode='r')
+
+
+class TrainingDataset:
+    """Random access to every tile in a tile store, through its memory-mapped shards.
+
+    The index is read once, and each shard is mapped the first time one of its tiles is read,
+    so indexing and take() never open or unpickle per-tile files.
+    """
+
+    def __init__(self, store_dir):
+        """Open the tile store in store_dir."""
+        index = load_tile_index(store_dir)
+        self.store_dir = store_dir
+        self.tile_size = index['tile_size']
+        self.band_count = index['band_count']
+        self.label_format = index.get('label_format', LABEL_BITMAP)
+        self.naip_paths = index['naip_paths']
+        self.shard_names = index['shards']
+        self.tiles = index['tiles']
+        self.shards = [None] * len(self.shard_names)
+
+    def __len__(self):
+        """Return the number of tiles in the store."""
+        return len(self.tiles)
+
+    def __getitem__(self, tile_id):
+        """Return the (image, label) arrays for tile_id, as read-only views of its shard."""
+        entry = self.tiles[tile_id]
+        images, labels = self.shard(entry['shard'])
+        return images[entry['offset']], labels[entry['offset']]
+
+    def shard(self, shard_number):
+        """Return the memory-mapped (images, labels) arrays of a shard, mapping it if needed."""
+        if self.shards[shard_number] is None:
+            self.shards[shard_number] = load_shard(self.store_dir, self.shard_names[shard_number])
+        return self.shards[shard_number]
+
+    def label_masks(self, labels, pixels_to_fatten_roads=0):
+        """Return 0/1 way masks for labels read from the store, see label_rasters.label_mask."""
+        return label_mask(labels, self.label_format, pixels_to_fatten_roads)
+
+    def origin(self, tile_id):
+        """Return ((col, row), naip_path) for where tile_id was cut from."""
+        entry = self.tiles[tile_id]
+        return (int(entry['col']), int(entry['row'])), self.naip_paths[entry['naip']]
+
+    def tile_classes(self, on_tolerance=ON_TOLERANCE, off_tolerance=OFF_TOLERANCE):
+        """Return the TILE_ON/TILE_OFF/TILE_AMBIGUOUS class of every tile, from the index."""
+        if on_tolerance == ON_TOLERANCE and off_tolerance == OFF_TOLERANCE:
+            return self.tiles['label_class']
+        return classify_center_distances(self.tiles['center_distance'], on_tolerance,
+                                         off_tolerance)
+
+    def class_ids(self, label_class, on_tolerance=ON_TOLERANCE, off_tolerance=OFF_TOLERANCE):
+        """Return the ids of every tile of label_class, without reading any labels."""
+        return numpy.flatnonzero(self.tile_classes(on_tolerance, off_tolerance) == label_class)
+
+    def random_class_ids(self, on_count, off_count, on_tolerance=ON_TOLERANCE,
+                         off_tolerance=OFF_TOLERANCE):
+        """Return on_count random ON tile ids and off_count random OFF tile ids, shuffled."""
+        label_classes = self.tile_classes(on_tolerance, off_tolerance)
+        on_ids = numpy.flatnonzero(label_classes == TILE_ON)
+        off_ids = numpy.flatnonzero(label_classes == TILE_OFF)
+        tile_ids = numpy.concatenate((numpy.random.choice(on_ids, on_count),
+                                      numpy.random.choice(off_ids, off_count)))
+        numpy.random.shuffle(tile_ids)
+        return tile_ids
+
+    def take(self, indices):
+        """Return contiguous (B, T, T, bands) images and (B, T, T) labels for the tile indices.
+
+        Tiles are gathered with one fancy-index read per shard they come from.
+        """
+        entries = self.tiles[numpy.asarray(indices, dtype=numpy.int64)]
+        images = numpy.empty((len(entries), self.tile_size, self.tile_size, self.band_count),
+                             dtype=numpy.uint8)
+        labels = numpy.empty((len(entries), self.tile_size, self.tile_size), dtype=numpy.uint8)
+        for shard_number in numpy.unique(entries['shard']):
+            in_shard = numpy.flatnonzero(entries['shard'] == shard_number)
+            shard_images, shard_labels = self.shard(shard_number)
+            offsets = entries['offset'][in_shard]
+            images[in_shard] = shard_images[offsets]
+            labels[in_shard] = shard_labels[offsets]
+        return images, labels
+
+
+class BalancedSampler:
+    """Draw shuffled batches of ON and OFF tile ids from a TrainingDataset, without replacement.
+
+    Each batch has on_off_ratio ON tiles for every OFF tile. Within an epoch no tile id is
+    repeated; an epoch ends when the rarer class (for the ratio) runs out, and the next epoch
+    reshuffles both classes, so the commoner class is sampled differently every epoch.
+    """
+
+    def __init__(self, dataset, batch_size, on_off_ratio=1.0, on_tolerance=ON_TOLERANCE,
+                 off_tolerance=OFF_TOLERANCE, random_state=None):
+        """Sample batch_size tiles at a time from dataset, classified at the given tolerances."""
+        label_classes = dataset.tile_classes(on_tolerance, off_tolerance)
+        self.on_ids = numpy.flatnonzero(label_classes == TILE_ON)
+        self.off_ids = numpy.flatnonzero(label_classes == TILE_OFF)
+        self.on_count = int(round(batch_size * on_off_ratio / (1.0 + on_off_ratio)))
+        self.off_count = batch_size - self.on_count
+        self.random_state = random_state or numpy.random.RandomState()
+        if self.on_count > len(self.on_ids) or self.off_count > len(self.off_ids):
+            raise ValueError("not enough tiles for a batch of {} ON and {} OFF, the dataset has "
+                             "{} ON and {} OFF".format(self.on_count, self.off_count,
+                                                       len(self.on_ids), len(self.off_ids)))
+
+    def __len__(self):
+        """Return the number of batches in an epoch."""
+        batch_counts = []
+        if self.on_count:
+            batch_counts.append(len(self.on_ids) // self.on_count)
+        if self.off_count:
+            batch_counts.append(len(self.off_ids) // self.off_count)
+        return min(batch_counts) if batch_counts else 0
+
+    def epoch(self):
+        """Yield one epoch of batches, as shuffled arrays of tile ids."""
+        on_ids = self.random_state.permutation(self.on_ids)
+        off_ids = self.random_state.permutation(self.off_ids)
+        for x in range(len(self)):
+            batch = numpy.concatenate((on_ids[x * self.on_count:(x + 1) * self.on_count],
+                                       off_ids[x * self.off_count:(x + 1) * self.off_count]))
+            self.random_state.shuffle(batch)
+            yield batch
+
+    def batches(self):
+        """Yield batches forever, starting a new epoch whenever one is used up."""
+        while True:
+            for batch in self.epoch():
+                yield batch
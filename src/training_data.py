@@ -1,41 +1,180 @@
 """Create training data for a neural net, from NAIP images and OpenStreetMap data."""
 
 from __future__ import print_function
+import multiprocessing
 import numpy
 import os
 import pickle
-import random
+import shutil
 import sys
 import time
+from numpy.lib.stride_tricks import as_strided
 from osgeo import gdal
-from openstreetmap_labels import download_and_extract
-from geo_util import lon_lat_to_pixel, pixel_to_lon_lat
+from openstreetmap_labels import WayMap, download_files
+from geo_util import pixel_to_lon_lat, world_to_pixel
 from naip_images import NAIP_DATA_DIR, NAIPDownloader
-from src.config import LABEL_CACHE_DIR, LABELS_DATA_DIR, IMAGE_CACHE_DIR, METADATA_FILE
+from src.config import METADATA_FILE, TILE_STORE_DIR, UPDATED_WAYS_DIR
+from src.label_cache import LabelCache, file_digest, label_params, way_bitmap_cache_key
+from src.label_rasters import LABEL_BITMAP, LABEL_CLASSES, LABEL_DISTANCE, WAY_CLASSES, \
+    PackedBitmap, center_distances, label_mask, save_packed_bitmap
+from src.osm_changes import apply_changes, read_changes
+from src.rasterize import distance_transform, rasterize_segments
+from src.tile_store import TILE_AMBIGUOUS, TILE_ON, TileStoreWriter, indexed_shards, \
+    load_tile_index, write_naip_shards
+from src.way_index import WayIndex, clip_segments
+from src.ways import Ways
 
 # there is a 300 pixel buffer around NAIPs to be trimmed off, where NAIPs overlap...
 # otherwise using overlapping images makes wonky train/test splits
 NAIP_PIXEL_BUFFER = 300
 
+# the WayIndex to label NAIPs with, set before the tiling pool forks so workers share one copy
+_tiling_ways = None
+# each tiling process reuses one NAIP window buffer for every NAIP it reads
+_tiling_read_buffer = None
 
-def read_naip(file_path, bands_to_use):
+
+def read_naip(file_path, bands_to_use, buf=None):
     """
     Read in a NAIP, based on www.machinalis.com/blog/python-for-geospatial-data-processing.
 
     Bands_to_use is an array like [0,0,0,1], designating whether to use each band (R, G, B, IR).
+    Pass the bands_data of an earlier read as buf to read into its memory (see naip_buffer).
     """
     raster_dataset = gdal.Open(file_path, gdal.GA_ReadOnly)
+    bands_data = read_naip_window(raster_dataset, bands_to_use, 0, 0,
+                                  raster_dataset.RasterXSize, raster_dataset.RasterYSize, buf)
+    return raster_dataset, bands_data
 
-    bands_data = []
-    index = 0
-    for b in range(1, raster_dataset.RasterCount + 1):
-        band = raster_dataset.GetRasterBand(b)
-        if bands_to_use[index] == 1:
-            bands_data.append(band.ReadAsArray())
-        index += 1
-    bands_data = numpy.dstack(bands_data)
 
-    return raster_dataset, bands_data
+def naip_band_list(bands_to_use):
+    """Return the 1-based GDAL band numbers switched on in bands_to_use."""
+    return [index + 1 for index, use_band in enumerate(bands_to_use) if use_band == 1]
+
+
+def naip_buffer(rows, cols, band_count, buf=None):
+    """Return an empty rows x cols x band_count uint8 array, reusing buf's memory if big enough.
+
+    buf can be any array returned by an earlier call, e.g. the bands_data of the last NAIP read,
+    so a run over many NAIPs allocates once instead of once per NAIP.
+    """
+    size = rows * cols * band_count
+    if isinstance(buf, numpy.ndarray) and isinstance(buf.base, numpy.ndarray):
+        buf = buf.base
+    if buf is None or buf.dtype != numpy.uint8 or buf.size < size:
+        buf = numpy.empty(size, dtype=numpy.uint8)
+    return buf.reshape(-1)[:size].reshape(rows, cols, band_count)
+
+
+def read_naip_window(raster_dataset, bands_to_use, xoff, yoff, win_xsize, win_ysize, buf=None):
+    """Read a win_ysize x win_xsize x bands window of the NAIP, starting at pixel (xoff, yoff).
+
+    Only the bands switched on in bands_to_use are read, each straight into its strided slice
+    of memory from naip_buffer, with no per-band copy or dstack. Band ReadAsArray with buf_obj
+    works with the older GDAL bindings in the Docker image, unlike band_list and interleave.
+    """
+    band_list = naip_band_list(bands_to_use)
+    bands_data = naip_buffer(win_ysize, win_xsize, len(band_list), buf)
+    for index, band_number in enumerate(band_list):
+        raster_dataset.GetRasterBand(band_number).ReadAsArray(
+            xoff, yoff, win_xsize, win_ysize, buf_obj=bands_data[:, :, index])
+    return bands_data
+
+
+def tile_grid(rows, cols, tile_size, tile_overlap):
+    """Return the top rows and left cols of the tiles cut from a rows x cols NAIP.
+
+    Tiles start inside the NAIP_PIXEL_BUFFER, and step tile_size / tile_overlap pixels apart.
+    """
+    step = tile_size // tile_overlap
+    left_x, right_x = NAIP_PIXEL_BUFFER, cols - NAIP_PIXEL_BUFFER
+    top_y, bottom_y = NAIP_PIXEL_BUFFER, rows - NAIP_PIXEL_BUFFER
+    tile_rows = [row for row in range(top_y, bottom_y, step) if row + tile_size < bottom_y]
+    tile_cols = [col for col in range(left_x, right_x, step) if col + tile_size < right_x]
+    return tile_rows, tile_cols
+
+
+def tile_view(bands_data, tile_size, tile_overlap):
+    """Return every tile of an in-memory NAIP as one strided view, plus the tile origins.
+
+    The view shares memory with bands_data and has shape
+    (tile rows, tile cols, tile_size, tile_size) + bands_data.shape[2:].
+    Origins is an int32 (N, 2) array of (col, row), in the same row-major order, so tile i
+    is tiles[i // tile cols, i % tile cols]. Numpy can't flatten the two grid axes of a view
+    without copying, so use take_tiles to gather a batch of tiles by flat index.
+    """
+    rows, cols = bands_data.shape[0], bands_data.shape[1]
+    tile_rows, tile_cols = tile_grid(rows, cols, tile_size, tile_overlap)
+    step = tile_size // tile_overlap
+
+    origin_rows, origin_cols = numpy.meshgrid(tile_rows, tile_cols, indexing='ij')
+    origins = numpy.column_stack((origin_cols.ravel(), origin_rows.ravel())).astype(numpy.int32)
+
+    corner = bands_data[tile_rows[0]:, tile_cols[0]:] if len(origins) else bands_data
+    shape = (len(tile_rows), len(tile_cols), tile_size, tile_size) + bands_data.shape[2:]
+    strides = (step * corner.strides[0], step * corner.strides[1]) + corner.strides
+    return as_strided(corner, shape=shape, strides=strides), origins
+
+
+def take_tiles(tiles, indices):
+    """Gather the tiles at the flat indices from a tile_view, as one contiguous array."""
+    indices = numpy.asarray(indices)
+    tile_cols = tiles.shape[1]
+    return tiles[indices // tile_cols, indices % tile_cols]
+
+
+def naip_windows(raster_dataset, tile_size, tile_overlap):
+    """Return the tile cols, and the tile rows grouped into the windows iter_naip_tiles reads.
+
+    Each window is a few rows of tiles tall, enough to cover one row of the raster's blocks.
+    """
+    tile_rows, tile_cols = tile_grid(raster_dataset.RasterYSize, raster_dataset.RasterXSize,
+                                     tile_size, tile_overlap)
+    step = tile_size // tile_overlap
+    block_ysize = raster_dataset.GetRasterBand(1).GetBlockSize()[1]
+    tile_rows_per_read = max(1, -(-block_ysize // step))
+    windows = [tile_rows[i:i + tile_rows_per_read]
+               for i in range(0, len(tile_rows), tile_rows_per_read)]
+    return tile_cols, windows
+
+
+def naip_window_buffer(raster_dataset, bands_to_use, tile_size, tile_overlap, buf=None):
+    """Return a buffer big enough for any window iter_naip_tiles reads from the NAIP.
+
+    Pass the result back in as buf for the next NAIP, so it is only reallocated if it's too small.
+    """
+    tile_cols, windows = naip_windows(raster_dataset, tile_size, tile_overlap)
+    if not tile_cols or not windows:
+        return buf
+    win_xsize = tile_cols[-1] + tile_size - tile_cols[0]
+    win_ysize = windows[0][-1] + tile_size - windows[0][0]
+    return naip_buffer(win_ysize, win_xsize, sum(bands_to_use), buf)
+
+
+def iter_naip_tiles(raster_dataset, bands_to_use, tile_size, tile_overlap, buf=None):
+    """Yield (tile, (col, row)) for every tile of the NAIP, in row-major order.
+
+    The NAIP is read in windows a few rows of tiles tall, sized to cover a row of the raster's
+    internal blocks, so only one window is held in memory instead of the whole quad.
+
+    If buf is given (see naip_window_buffer), every window is read into its memory, so tiles are
+    only valid until the next window is read.
+    """
+    tile_cols, windows = naip_windows(raster_dataset, tile_size, tile_overlap)
+    if not tile_cols or not windows:
+        return
+
+    xoff = tile_cols[0]
+    win_xsize = tile_cols[-1] + tile_size - xoff
+    for window_rows in windows:
+        yoff = window_rows[0]
+        win_ysize = window_rows[-1] + tile_size - yoff
+        window = read_naip_window(raster_dataset, bands_to_use, xoff, yoff, win_xsize, win_ysize,
+                                  buf)
+        for row in window_rows:
+            for col in tile_cols:
+                y, x = row - yoff, col - xoff
+                yield window[y:y + tile_size, x:x + tile_size], (col, row)
 
 
 def tile_naip(raster_data_path, raster_dataset, bands_data, bands_to_use, tile_size, tile_overlap):
@@ -43,217 +182,345 @@ def tile_naip(raster_data_path, raster_dataset, bands_data, bands_to_use, tile_s
     Cut a 4-band raster image into tiles.
 
     Tiles are cubes - up to 4 bands, and N height x N width based on tile_size.
-    """
-    on_band_count = 0
-    for b in bands_to_use:
-        if b == 1:
-            on_band_count += 1
 
-    rows, cols, n_bands = bands_data.shape
-    print("OPENED NAIP with {} rows, {} cols, and {} bands".format(rows, cols, n_bands))
+    If bands_data is None, the tiles are streamed from raster_dataset with iter_naip_tiles,
+    instead of sliced from a NAIP already in memory.
+    """
+    rows, cols = raster_dataset.RasterYSize, raster_dataset.RasterXSize
+    print("OPENED NAIP with {} rows, {} cols, and {} bands".format(rows, cols, sum(bands_to_use)))
     print("GEO-BOUNDS for image chunk is {}".format(bounds_for_naip(raster_dataset, rows, cols)))
 
-    all_tiled_data = []
-
-    for col in range(NAIP_PIXEL_BUFFER, cols - NAIP_PIXEL_BUFFER, tile_size / tile_overlap):
-        for row in range(NAIP_PIXEL_BUFFER, rows - NAIP_PIXEL_BUFFER, tile_size / tile_overlap):
-            if row + tile_size < rows - NAIP_PIXEL_BUFFER and col + tile_size < cols - NAIP_PIXEL_BUFFER:
-                new_tile = bands_data[row:row + tile_size, col:col + tile_size, 0:on_band_count]
-                all_tiled_data.append((new_tile, (col, row), raster_data_path))
+    if bands_data is None:
+        return [(tile, origin, raster_data_path) for tile, origin in
+                iter_naip_tiles(raster_dataset, bands_to_use, tile_size, tile_overlap)]
 
-    return all_tiled_data
+    tiles, origins = tile_view(bands_data, tile_size, tile_overlap)
+    tile_cols = tiles.shape[1]
+    return [(tiles[i // tile_cols, i % tile_cols], (col, row), raster_data_path)
+            for i, (col, row) in enumerate(origins.tolist())]
 
 
-def way_bitmap_for_naip(ways, raster_data_path, raster_dataset, rows, cols, pixels_to_fatten_roads=None):
+def way_bitmap_for_naip(ways, raster_data_path, raster_dataset, rows, cols, params):
     """
-    Generate a matrix of size rows x cols, initialized to all zeroes.
-
-    Set matrix to 1 for any pixel where an OSM way runs over.
+    Generate a uint8 matrix of size rows x cols, initialized to all zeroes.
+
+    Set matrix to 1 for any pixel where an OSM way runs over, fattened by
+    params['pixels_to_fatten_roads'] (params are from label_cache.label_params). The bitmap is
+    cached bit-packed, and a cached bitmap is returned as a PackedBitmap, which decodes windows
+    as they're sliced.
+
+    With params['label_format'] LABEL_DISTANCE, ways are drawn unfattened, and the matrix is
+    instead each pixel's distance to the nearest way, clipped at DISTANCE_LABEL_MAX. With
+    LABEL_CLASSES, each way is drawn as its class id, from the params['way_classes'] table, in
+    one pass, class by class. Either is cached as a .npy, and returned memory mapped from the
+    cache.
     """
-    parts = raster_data_path.split('/')
-    naip_grid = parts[len(parts)-2]
-    naip_filename = parts[len(parts)-1]
-    cache_filename = LABELS_DATA_DIR + '/' + naip_grid + '/' + naip_filename + '-ways.bitmap.npy'
-
-    try:
-        arr = numpy.load(cache_filename)
-        print("CACHED: read label data from disk")
-        return arr
-    except:
-        pass
-        # print "ERROR reading bitmap cache from disk: {}".format(cache_filename)
-
-    way_bitmap = numpy.zeros([rows, cols], dtype=numpy.int)
+    label_format = params['label_format']
+    pixels_to_fatten_roads = params['pixels_to_fatten_roads']
+    cache = LabelCache()
+    cache_key = way_bitmap_cache_key(raster_data_path, params)
+    cache_filename = cache.get(cache_key)
+    if cache_filename is not None:
+        try:
+            arr = open_way_bitmap(cache_filename, label_format, cols)
+            print("CACHED: read label data from disk")
+            return arr
+        except (IOError, ValueError) as e:
+            print("ERROR reading bitmap cache from disk: {}, {}".format(cache_filename, e))
+            cache.remove(cache_key)
+
+    way_bitmap = numpy.zeros([rows, cols], dtype=numpy.uint8)
     bounds = bounds_for_naip(raster_dataset, rows, cols)
-    ways_on_naip = []
-
-    for way in ways:
-        for point_tuple in way['linestring']:
-            if bounds_contains_point(bounds, point_tuple):
-                ways_on_naip.append(way)
-                break
-    print("EXTRACTED {} highways in NAIP bounds, of {} ways".format(len(ways_on_naip), len(ways)))
+    if not isinstance(ways, WayIndex):
+        ways = WayIndex(ways)
+    segment_ids = ways.candidates(bounds['sw'][0], bounds['sw'][1],
+                                  bounds['ne'][0], bounds['ne'][1])
 
     print("MAKING BITMAP for way presence...", end="")
     t0 = time.time()
-    for w in ways_on_naip:
-        for x in range(len(w['linestring']) - 1):
-            current_point = w['linestring'][x]
-            next_point = w['linestring'][x + 1]
-            if not bounds_contains_point(bounds, current_point) or not bounds_contains_point(bounds, next_point):
-                continue
-            current_pix = lon_lat_to_pixel(raster_dataset, current_point)
-            next_pix = lon_lat_to_pixel(raster_dataset, next_point)
-            add_pixels_between(current_pix, next_pix, cols, rows, way_bitmap, pixels_to_fatten_roads)
+    # ways are projected into each NAIP projection once, so only the geotransform is per NAIP
+    projected = ways.projected_segments(raster_dataset.GetProjection(), segment_ids)
+    geotransform = raster_dataset.GetGeoTransform()
+    segments = numpy.hstack((world_to_pixel(geotransform, projected[:, 0:2]),
+                             world_to_pixel(geotransform, projected[:, 2:4])))
+    # segments crossing the bounds are clipped to them, rather than dropped
+    segments, inside = clip_segments(segments, NAIP_PIXEL_BUFFER, NAIP_PIXEL_BUFFER,
+                                     cols - NAIP_PIXEL_BUFFER, rows - NAIP_PIXEL_BUFFER)
+    segments = segments[inside]
+    if label_format == LABEL_DISTANCE:
+        pixels_to_fatten_roads = 0
+    if label_format == LABEL_CLASSES:
+        segment_classes = ways.way_classes(params['way_classes'])[ways.way_ids[segment_ids[inside]]]
+    else:
+        segment_classes = numpy.ones(len(segments), dtype=numpy.uint8)
+    # draw classes in increasing order, so higher ones win where ways overlap
+    for class_id in numpy.unique(segment_classes[segment_classes != 0]):
+        class_segments = segments[segment_classes == class_id]
+        rasterize_segments(way_bitmap, class_segments[:, 0], class_segments[:, 1],
+                           class_segments[:, 2], class_segments[:, 3], pixels_to_fatten_roads,
+                           border=NAIP_PIXEL_BUFFER, value=class_id)
+    if label_format == LABEL_DISTANCE:
+        way_bitmap = distance_transform(way_bitmap)
     print(" {0:.1f}s".format(time.time() - t0))
+    print("EXTRACTED {} highways in NAIP bounds, of {} ways".format(
+        len(numpy.unique(ways.way_ids[segment_ids[inside]])), ways.way_count))
 
-    print("CACHING %s..." % cache_filename, end="")
+    print("CACHING %s..." % raster_data_path, end="")
     t0 = time.time()
-    # make sure cache_filename's parent folder exists
-    try:
-        os.makedirs(os.path.dirname(cache_filename))
-    except:
-        pass
-    # then save file to cache_filename
-    numpy.save(cache_filename, way_bitmap)
+    if label_format == LABEL_DISTANCE:
+        cache.put(cache_key, '-ways.distance.npy', lambda f: numpy.save(f, way_bitmap))
+    elif label_format == LABEL_CLASSES:
+        cache.put(cache_key, '-ways.classes.npy', lambda f: numpy.save(f, way_bitmap))
+    else:
+        cache.put(cache_key, '-ways.packed.npy', lambda f: save_packed_bitmap(f, way_bitmap))
     print(" {0:.1f}s".format(time.time() - t0))
 
     return way_bitmap
 
 
+def open_way_bitmap(cache_filename, label_format=LABEL_BITMAP, cols=None):
+    """Open a cached way bitmap as a PackedBitmap, or a distance or class raster memory mapped."""
+    if label_format in (LABEL_DISTANCE, LABEL_CLASSES):
+        return numpy.load(cache_filename, mmap_mode='r')
+    return PackedBitmap(cache_filename, cols)
+
+
+def load_way_bitmap(raster_data_path, params, cols=None):
+    """Return the cached way bitmap for a NAIP, made with label_params params, undecoded."""
+    cache_filename = LabelCache().get(way_bitmap_cache_key(raster_data_path, params))
+    if cache_filename is None:
+        raise IOError("no cached way bitmap for {}".format(raster_data_path))
+    return open_way_bitmap(cache_filename, params['label_format'], cols)
+
+
 def bounds_for_naip(raster_dataset, rows, cols):
-    """Clip the NAIP to 0 to cols, 0 to rows."""
+    """Clip the NAIP to 0 to cols, 0 to rows.
+
+    Returns the lon/lat box around all four corners, since a UTM NAIP isn't square to lon/lat.
+    """
     left_x, right_x = NAIP_PIXEL_BUFFER, cols - NAIP_PIXEL_BUFFER
     top_y, bottom_y = NAIP_PIXEL_BUFFER, rows - NAIP_PIXEL_BUFFER
-    sw = pixel_to_lon_lat(raster_dataset, left_x, bottom_y)
-    ne = pixel_to_lon_lat(raster_dataset, right_x, top_y)
+    corners = [pixel_to_lon_lat(raster_dataset, x, y)
+               for x in (left_x, right_x) for y in (top_y, bottom_y)]
+    sw = (min(lon for lon, _ in corners), min(lat for _, lat in corners))
+    ne = (max(lon for lon, _ in corners), max(lat for _, lat in corners))
     return {'sw': sw, 'ne': ne}
 
 
-def add_pixels_between(start_pixel, end_pixel, cols, rows, way_bitmap, pixels_to_fatten_roads):
-    """Add the pixels between the start and end to way_bitmap, maybe thickened based on config."""
-    if end_pixel[0] - start_pixel[0] == 0:
-        for y in range(min(end_pixel[1], start_pixel[1]), max(end_pixel[1], start_pixel[1])):
-            safe_add_pixel(end_pixel[0], y, way_bitmap)
-            # if configged, fatten lines
-            for x in range(1, pixels_to_fatten_roads + 1):
-                safe_add_pixel(end_pixel[0] - x, y, way_bitmap)
-                safe_add_pixel(end_pixel[0] + x, y, way_bitmap)
-        return
+def tile_naip_into_store(job):
+    """Label and tile one NAIP into the tile store, from a create_tiled_training_data job.
 
-    slope = (end_pixel[1] - start_pixel[1]) / float(end_pixel[0] - start_pixel[0])
-    offset = end_pixel[1] - slope * end_pixel[0]
-
-    i = 0
-    while i < cols:
-        floatx = start_pixel[0] + (end_pixel[0] - start_pixel[0]) * i / float(cols)
-        p = (int(floatx), int(offset + slope * floatx))
-        safe_add_pixel(p[0], p[1], way_bitmap)
-        i += 1
-        # if configged, fatten lines
-        for x in range(1, pixels_to_fatten_roads + 1):
-            safe_add_pixel(p[0], p[1] - x, way_bitmap)
-            safe_add_pixel(p[0], p[1] + x, way_bitmap)
-            safe_add_pixel(p[0] - x, p[1], way_bitmap)
-            safe_add_pixel(p[0] + x, p[1], way_bitmap)
-
-
-def safe_add_pixel(x, y, way_bitmap):
-    """Turn on a pixel in way_bitmap if its in bounds."""
-    if x < NAIP_PIXEL_BUFFER or x >= len(way_bitmap[0]) - NAIP_PIXEL_BUFFER or \
-       y < NAIP_PIXEL_BUFFER or y >= len(way_bitmap) - NAIP_PIXEL_BUFFER:
-        return
-    way_bitmap[y][x] = 1
+    Job is a (naip_number, raster_data_path, band_list, tile_size, tile_overlap, params)
+    tuple, where params are the label_cache.label_params to label with. Returns
+    (raster_data_path, shards, seconds), where shards is the (shard_name, summary) list to
+    index with TileStoreWriter.add_shards.
+    """
+    global _tiling_read_buffer
+    naip_number, raster_data_path, band_list, tile_size, tile_overlap, params = job
+    t0 = time.time()
 
+    raster_dataset = gdal.Open(raster_data_path, gdal.GA_ReadOnly)
+    rows = raster_dataset.RasterYSize
+    cols = raster_dataset.RasterXSize
 
-def bounds_contains_point(bounds, point_tuple):
-    """Return True if the bounds geographically contains the point_tuple."""
-    if point_tuple[0] > bounds['ne'][0]:
-        return False
-    if point_tuple[0] < bounds['sw'][0]:
-        return False
-    if point_tuple[1] > bounds['ne'][1]:
-        return False
-    if point_tuple[1] < bounds['sw'][1]:
-        return False
-    return True
+    way_bitmap_npy = way_bitmap_for_naip(_tiling_ways, raster_data_path,
+                                         raster_dataset, rows, cols, params)
+
+    # tile the NAIP a window at a time, and the way bitmap alongside it
+    _tiling_read_buffer = naip_window_buffer(raster_dataset, band_list, tile_size, tile_overlap,
+                                             _tiling_read_buffer)
+    tile_rows, tile_cols = tile_grid(rows, cols, tile_size, tile_overlap)
+    tiles = ((tile, way_bitmap_npy[row:row + tile_size, col:col + tile_size], (col, row))
+             for tile, (col, row) in iter_naip_tiles(raster_dataset, band_list, tile_size,
+                                                     tile_overlap, _tiling_read_buffer))
+    shards = write_naip_shards(TILE_STORE_DIR, naip_number, tile_size, sum(band_list),
+                               len(tile_rows) * len(tile_cols), tiles,
+                               label_format=params['label_format'],
+                               pixels_to_fatten_roads=params['pixels_to_fatten_roads'])
+    return raster_data_path, shards, time.time() - t0
 
 
 def create_tiled_training_data(raster_data_paths, extract_type, band_list, tile_size,
-                               pixels_to_fatten_roads, label_data_files, tile_overlap, naip_state):
-    """Save tiles for training data to disk, file names are padded with 16 0s.
+                               pixels_to_fatten_roads, label_data_files, tile_overlap, naip_state,
+                               workers=1, label_format=LABEL_BITMAP, way_classes=None,
+                               also_extract=()):
+    """Save tiles for training data to the sharded tile store in TILE_STORE_DIR.
+
+    Each NAIP's image and label tiles go in one shard, see src/tile_store.py. Label tiles are
+    cut from way bitmaps, distance rasters with label_format LABEL_DISTANCE, or class rasters
+    with LABEL_CLASSES, using the way_classes table (WAY_CLASSES by default).
 
-    Images are named 0000000000000000.colors.
-    Labels are named 0000000000000000.lbl.
+    With workers > 1, NAIPs are tiled in a pool of that many processes. Shards are named, and
+    indexed, in raster_data_paths order, so the tile store is the same as tiling serially.
+
+    Only the ways overlapping one of the NAIPs are extracted from label_data_files, and with
+    workers > 1, the files are extracted in parallel too. The also_extract types are extracted
+    into the extraction cache in the same pass, for later runs, see WayMap.
     """
+    global _tiling_ways
+    # only extract the ways on the NAIPs being tiled
+    naip_extents, projection_wkts = naip_extents_and_projections(raster_data_paths)
+
     # tile images and labels
-    waymap = download_and_extract(label_data_files, extract_type)
-
-    tile_index = 0
-
-    for raster_data_path in raster_data_paths:
-
-        # TODO need new code to check cache
-        raster_dataset, bands_data = read_naip(raster_data_path, band_list)
-        rows = bands_data.shape[0]
-        cols = bands_data.shape[1]
-
-        way_bitmap_npy = way_bitmap_for_naip(waymap.extracter.ways, raster_data_path,
-                                             raster_dataset, rows, cols, pixels_to_fatten_roads)
-
-        left_x, right_x = NAIP_PIXEL_BUFFER, cols - NAIP_PIXEL_BUFFER
-        top_y, bottom_y = NAIP_PIXEL_BUFFER, rows - NAIP_PIXEL_BUFFER
-
-        # tile the way bitmap
-        origin_tile_index = tile_index
-        for col in range(left_x, right_x, tile_size / tile_overlap):
-            for row in range(top_y, bottom_y, tile_size / tile_overlap):
-                if row + tile_size < bottom_y and col + tile_size < right_x:
-                    file_suffix = '{0:016d}'.format(tile_index)
-                    label_filepath = "{}/{}.lbl".format(LABEL_CACHE_DIR, file_suffix)
-                    new_tile = way_bitmap_npy[row:row + tile_size, col:col + tile_size]
-                    with open(label_filepath, 'w') as outfile:
-                        numpy.save(outfile, numpy.asarray((new_tile, col, row, raster_data_path)))
-                    tile_index += 1
-
-        tile_index = origin_tile_index
-        # tile the NAIP
-        for tile in tile_naip(raster_data_path, raster_dataset, bands_data, band_list, tile_size, tile_overlap):
-            file_suffix = '{0:016d}'.format(tile_index)
-            img_filepath = "{}/{}.colors".format(IMAGE_CACHE_DIR, file_suffix)
-            with open(img_filepath, 'w') as outfile:
-                numpy.save(outfile, tile)
-            tile_index += 1
+    label_data_paths = download_files(label_data_files)
+    waymap = WayMap(extract_type=extract_type, extents=naip_extents, also_extract=also_extract)
+    waymap.extract_files(label_data_paths, workers)
+    if label_format == LABEL_CLASSES:
+        way_classes = way_classes or WAY_CLASSES
+    else:
+        way_classes = None
+    params = label_params(label_data_paths, extract_type, pixels_to_fatten_roads, label_format,
+                          way_classes)
+    # index the ways once, and project them into each NAIP projection in use, before any
+    # workers fork, so each NAIP only looks up its own
+    way_index = WayIndex(waymap.ways)
+    if way_classes is not None:
+        # fail before tiling if a way has no class
+        way_index.way_classes(way_classes)
+    _tiling_ways = way_index
+    for projection_wkt in projection_wkts:
+        _tiling_ways.projected_points(projection_wkt)
+
+    tile_store = TileStoreWriter(TILE_STORE_DIR, tile_size, sum(band_list),
+                                 label_format=label_format,
+                                 pixels_to_fatten_roads=pixels_to_fatten_roads)
+    jobs = [(naip_number, raster_data_path, band_list, tile_size, tile_overlap, params)
+            for naip_number, raster_data_path in enumerate(raster_data_paths)]
+
+    t0 = time.time()
+    for raster_data_path, shards, seconds in run_tiling_jobs(jobs, workers):
+        tile_store.add_shards(raster_data_path, shards)
+        print("TILED {0} in {1:.1f}s".format(raster_data_path, seconds))
+    _tiling_ways = None
+
+    tile_count = tile_store.close()
+    elapsed = time.time() - t0
+    print("STORED {0} tiles from {1} NAIPs in {2:.1f}s, {3:.0f} tiles/s".format(
+        tile_count, len(raster_data_paths), elapsed, tile_count / max(elapsed, 1e-6)))
 
     # dump the metadata to disk for configuring the analysis script later
-    training_info = {'bands': band_list, 'tile_size': tile_size, 'naip_state': naip_state}
+    training_info = {'bands': band_list, 'tile_size': tile_size, 'naip_state': naip_state,
+                     'label_params': params, 'tile_overlap': tile_overlap,
+                     'label_data_paths': label_data_paths, 'ways_dir': None}
     with open(METADATA_FILE, 'w') as outfile:
         pickle.dump(training_info, outfile)
 
 
-def equalize_data(road_labels, naip_tiles, save_clippings):
-    """Make sure labeled data includes an equal set of ON and OFF tiles."""
-    wayless_indices = []
-    way_indices = []
-    for x in range(0, len(road_labels)):
-        if road_labels[x][0] == 0:
-            way_indices.append(x)
-        else:
-            wayless_indices.append(x)
+def naip_extents_and_projections(raster_data_paths):
+    """Return (naip_extents, projection_wkts) for the NAIPs at raster_data_paths.
 
-    count_wayless = len(wayless_indices)
-    count_withways = len(way_indices)
+    naip_extents lists the lon/lat (x_left, y_bottom, x_right, y_top) bounds_for_naip of each
+    NAIP, and projection_wkts is the set of their projections.
+    """
+    naip_extents = []
+    projection_wkts = set()
+    for path in raster_data_paths:
+        raster_dataset = gdal.Open(path, gdal.GA_ReadOnly)
+        projection_wkts.add(raster_dataset.GetProjection())
+        bounds = bounds_for_naip(raster_dataset, raster_dataset.RasterYSize,
+                                 raster_dataset.RasterXSize)
+        naip_extents.append(bounds['sw'] + bounds['ne'])
+    return naip_extents, projection_wkts
+
+
+def run_tiling_jobs(jobs, workers=1):
+    """Yield the result of tile_naip_into_store for each job, in order.
+
+    With workers > 1, the jobs run in a pool of that many processes.
+    """
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for result in pool.imap(tile_naip_into_store, jobs):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in jobs:
+            yield tile_naip_into_store(job)
+
+
+def update_tiled_training_data(change_files, workers=1):
+    """Apply OSM change files to the ways the tile store was labelled with, and retile to match.
+
+    Only the NAIPs that the old or new version of a changed way crosses are labelled and tiled
+    again; every other NAIP's shards, index entries and cached labels are kept. change_files
+    are applied in order, on top of any applied before, and the updated ways are saved in
+    UPDATED_WAYS_DIR. Returns the numbers of the NAIPs that were retiled.
+    """
+    global _tiling_ways
+    with open(METADATA_FILE, 'r') as infile:
+        training_info = pickle.load(infile)
+    params = training_info['label_params']
+    index = load_tile_index(TILE_STORE_DIR)
+    raster_data_paths = index['naip_paths']
+    naip_extents, projection_wkts = naip_extents_and_projections(raster_data_paths)
+
+    if training_info.get('ways_dir'):
+        ways = Ways.load(training_info['ways_dir'])
+    else:
+        waymap = WayMap(extract_type=params['extract_type'], extents=naip_extents)
+        waymap.extract_files(training_info['label_data_paths'], workers)
+        ways = waymap.ways
+    nodes, changed_ways = read_changes(change_files)
+    ways, touched = apply_changes(ways, nodes, changed_ways, params['extract_type'],
+                                  naip_extents, training_info['label_data_paths'])
+
+    # the NAIPs a changed way crossed, or crosses now
+    touched_index = WayIndex(touched)
+    retiling = [naip_number for naip_number, extent in enumerate(naip_extents)
+                if len(touched_index.candidates(*extent))]
+    print("RETILING {} of {} NAIPs".format(len(retiling), len(raster_data_paths)))
+
+    new_params = dict(params, change_digests=params.get('change_digests', []) +
+                      [file_digest(path) for path in change_files])
+    label_cache = LabelCache()
+    for naip_number, raster_data_path in enumerate(raster_data_paths):
+        if naip_number not in retiling:
+            label_cache.link(way_bitmap_cache_key(raster_data_path, params),
+                             way_bitmap_cache_key(raster_data_path, new_params))
+
+    if retiling:
+        _tiling_ways = WayIndex(ways)
+        for projection_wkt in projection_wkts:
+            _tiling_ways.projected_points(projection_wkt)
+    band_list = training_info['bands']
+    jobs = [(naip_number, raster_data_paths[naip_number], band_list, index['tile_size'],
+             training_info['tile_overlap'], new_params) for naip_number in retiling]
+    retiled = {}
+    for raster_data_path, shards, seconds in run_tiling_jobs(jobs, workers):
+        retiled[raster_data_path] = shards
+        print("TILED {0} in {1:.1f}s".format(raster_data_path, seconds))
+    _tiling_ways = None
+
+    tile_store = TileStoreWriter(TILE_STORE_DIR, index['tile_size'], index['band_count'],
+                                 label_format=index.get('label_format', LABEL_BITMAP),
+                                 pixels_to_fatten_roads=params['pixels_to_fatten_roads'])
+    for naip_number, raster_data_path in enumerate(raster_data_paths):
+        shards = retiled.get(raster_data_path)
+        if shards is None:
+            shards = indexed_shards(index, naip_number)
+        tile_store.add_shards(raster_data_path, shards)
+    tile_store.close()
+
+    save_updated_ways(ways)
+    training_info['label_params'] = new_params
+    training_info['ways_dir'] = UPDATED_WAYS_DIR
+    with open(METADATA_FILE, 'w') as outfile:
+        pickle.dump(training_info, outfile)
+    return retiling
 
-    equal_count_way_list = []
-    equal_count_tile_list = []
-    for x in range(min(count_wayless, count_withways)):
-        way_index = way_indices[x]
-        wayless_index = wayless_indices[x]
-        equal_count_way_list.append(road_labels[way_index])
-        equal_count_way_list.append(road_labels[wayless_index])
-        equal_count_tile_list.append(naip_tiles[way_index])
-        equal_count_tile_list.append(naip_tiles[wayless_index])
-    return equal_count_way_list, equal_count_tile_list
+
+def save_updated_ways(ways):
+    """Save ways to UPDATED_WAYS_DIR, replacing the ways there, which ways may be mapped from."""
+    temp_dir = UPDATED_WAYS_DIR + '.new'
+    if os.path.isdir(temp_dir):
+        shutil.rmtree(temp_dir)
+    ways.save(temp_dir)
+    if os.path.isdir(UPDATED_WAYS_DIR):
+        shutil.rmtree(UPDATED_WAYS_DIR)
+    os.rename(temp_dir, UPDATED_WAYS_DIR)
 
 
 def has_ways_in_center(tile, tolerance):
@@ -268,76 +535,66 @@ def has_ways_in_center(tile, tolerance):
     return False
 
 
-def format_as_onehot_arrays(new_label_paths):
+def has_ways_in_center_batch(labels, tolerances):
+    """Return has_ways_in_center for each tile of a stacked (N, T, T) label array.
+
+    Tolerances is an int, giving a boolean vector of length N, or a list of ints, giving an
+    (N, len(tolerances)) boolean array. All the tolerances share one pass over the labels,
+    which only looks at the center window of the largest tolerance.
+    """
+    labels = numpy.asarray(labels)
+    widest = numpy.max(tolerances)
+    if widest < 1:
+        # has_ways_in_center looks at no pixels, so is False, and the center window is empty
+        shape = (len(labels),) if numpy.isscalar(tolerances) else (len(labels), len(tolerances))
+        return numpy.zeros(shape, dtype=bool)
+    center_row, center_col = labels.shape[1] // 2, labels.shape[2] // 2
+    if widest <= min(center_row, center_col):
+        labels = labels[:, center_row - widest:center_row + widest,
+                        center_col - widest:center_col + widest]
+    distances = center_distances(labels)
+    if numpy.isscalar(tolerances):
+        return distances <= tolerances
+    return distances[:, numpy.newaxis] <= numpy.asarray(tolerances)[numpy.newaxis, :]
+
+
+def format_as_onehot_arrays(dataset, tile_ids):
     """Return a list of one-hot array labels, for a list of tiles.
 
     Converts to a one-hot array of whether the tile has ways (i.e. [0,1] or [1,0] for each).
+    Tiles are classified from the summaries in dataset's index (a TrainingDataset), so only
+    the ON and OFF tiles' images are read, in one take().
     """
-    training_images, onehot_training_labels = [], []
     print("CREATING ONE-HOT LABELS...")
     t0 = time.time()
-    on_count = 0
-    off_count = 0
-    for filename in new_label_paths:
-
-        full_path = "{}/{}".format(LABEL_CACHE_DIR, filename)
-        label = numpy.load(full_path)
-
-        parts = full_path.split('.')[0].split('/')
-        file_suffix = parts[len(parts)-1]
-        img_path = "{}/{}.colors".format(IMAGE_CACHE_DIR, file_suffix)
-
-        if has_ways_in_center(label[0], 1):
-            onehot_training_labels.append([0, 1])
-            on_count += 1
-            training_images.append(numpy.load(img_path))
-        elif not has_ways_in_center(label[0], 16):
-            onehot_training_labels.append([1, 0])
-            off_count += 1
-            training_images.append(numpy.load(img_path))
-
+    tile_ids = numpy.asarray(tile_ids, dtype=numpy.int64)
+    label_classes = dataset.tile_classes()[tile_ids]
+    is_on = label_classes[label_classes != TILE_AMBIGUOUS] == TILE_ON
+    images, _ = dataset.take(tile_ids[label_classes != TILE_AMBIGUOUS])
+    training_images = list(images)
+    onehot_training_labels = [[0, 1] if on else [1, 0] for on in is_on]
     print("one-hotting took {0:.1f}s".format(time.time() - t0))
     return training_images, onehot_training_labels
 
 
-def load_training_tiles(number_of_tiles):
-    """Return number_of_tiles worth of training_label_paths."""
-    print("LOADING DATA: reading from disk and unpickling")
-    t0 = time.time()
-    training_label_paths = []
-    all_paths = os.listdir(LABEL_CACHE_DIR)
-    for x in range(0, number_of_tiles):
-        label_path = random.choice(all_paths)
-        training_label_paths.append(label_path)
-    print("DATA LOADED: time to deserialize test data {0:.1f}s".format(time.time() - t0))
-    return training_label_paths
-
+def load_all_training_tiles(naip_path, bands, params):
+    """Return the image and label tiles for the naip_path, labelled with label_params params.
 
-def load_all_training_tiles(naip_path, bands):
-    """Return the image and label tiles for the naip_path."""
+    Labels are 0/1 way masks, fattened by params['pixels_to_fatten_roads'].
+    """
     print("LOADING DATA: reading from disk and unpickling")
     t0 = time.time()
     tile_size = 64
     tile_overlap = 1
-    raster_dataset, bands_data = read_naip(naip_path, bands)
-    training_images = tile_naip(naip_path, raster_dataset, bands_data, bands, tile_size, tile_overlap)
-    rows = bands_data.shape[0]
-    cols = bands_data.shape[1]
-    parts = naip_path.split('/')
-    naip_grid = parts[len(parts)-2]
-    naip_filename = parts[len(parts)-1]
-    cache_filename = LABELS_DATA_DIR + '/' + naip_grid + '/' + naip_filename + '-ways.bitmap.npy'
-    way_bitmap_npy = numpy.load(cache_filename)
-
-    left_x, right_x = NAIP_PIXEL_BUFFER, cols - NAIP_PIXEL_BUFFER
-    top_y, bottom_y = NAIP_PIXEL_BUFFER, rows - NAIP_PIXEL_BUFFER
+    raster_dataset = gdal.Open(naip_path, gdal.GA_ReadOnly)
+    training_images = tile_naip(naip_path, raster_dataset, None, bands, tile_size, tile_overlap)
+    way_bitmap = load_way_bitmap(naip_path, params, raster_dataset.RasterXSize)
 
     training_labels = []
-    for col in range(left_x, right_x, tile_size / tile_overlap):
-        for row in range(top_y, bottom_y, tile_size / tile_overlap):
-            if row + tile_size < bottom_y and col + tile_size < right_x:
-                new_tile = way_bitmap_npy[row:row + tile_size, col:col + tile_size]
-                training_labels.append(numpy.asarray((new_tile, col, row, naip_path)))
+    for _, (col, row), _ in training_images:
+        new_tile = label_mask(way_bitmap[row:row + tile_size, col:col + tile_size],
+                              params['label_format'], params['pixels_to_fatten_roads'])
+        training_labels.append(numpy.asarray((new_tile, col, row, naip_path)))
 
     print("DATA LOADED: time to deserialize test data {0:.1f}s".format(time.time() - t0))
     return training_labels, training_images
@@ -376,7 +633,11 @@ def download_and_serialize(number_of_naips,
                            tile_size,
                            pixels_to_fatten_roads,
                            label_data_files,
-                           tile_overlap):
+                           tile_overlap,
+                           workers=1,
+                           label_format=LABEL_BITMAP,
+                           way_classes=None,
+                           also_extract=()):
     """Download NAIP images, PBF files, and serialize training data."""
     raster_data_paths = NAIPDownloader(number_of_naips,
                                        randomize_naips,
@@ -391,7 +652,11 @@ def download_and_serialize(number_of_naips,
                                pixels_to_fatten_roads,
                                label_data_files,
                                tile_overlap,
-                               naip_state)
+                               naip_state,
+                               workers,
+                               label_format,
+                               way_classes,
+                               also_extract)
     return raster_data_paths
 
 
@@ -1,18 +1,22 @@
 """Visualize predictions from a neural net analyzing satellite imagery to extract features."""
 
 from __future__ import print_function
-import numpy
 import os
 import time
 from PIL import Image
-from src.training_data import load_training_tiles, way_bitmap_for_naip
+from src.label_rasters import LABEL_BITMAP, label_mask
+from src.training_data import load_all_training_tiles, load_way_bitmap
 from src.single_layer_network import list_findings
 
+# how many rows of the way bitmap to decode at a time when drawing ways on a JPEG
+RENDER_STRIP_ROWS = 256
+
 
 def render_errors(raster_data_paths, model, training_info, render_results):
     """Render JPEGs showing findings."""
+    params = training_info['label_params']
     for path in raster_data_paths:
-        labels, images = load_training_tiles(path)
+        labels, images = load_all_training_tiles(path, training_info['bands'], params)
         if len(labels) == 0 or len(images) == 0:
             print("WARNING, there is a borked naip image file")
             continue
@@ -22,20 +26,20 @@ def render_errors(raster_data_paths, model, training_info, render_results):
         print("FINDINGS: {} false pos of {} tiles, from {}".format(
             len(false_positives), len(images), filename))
         render_results_for_analysis([path], false_positives, fp_images, training_info['bands'],
-                                    training_info['tile_size'])
+                                    training_info['tile_size'], params)
 
 
-def render_results_for_analysis(raster_data_paths, predictions, test_images, band_list, tile_size):
-    """Generate a JPEG for each TIFF showing predictions shaded."""
+def render_results_for_analysis(raster_data_paths, predictions, test_images, band_list, tile_size,
+                                params):
+    """Generate a JPEG for each TIFF showing predictions shaded, and the ways labelled by params."""
     for raster_data_path in raster_data_paths:
-        way_bitmap_npy = numpy.asarray(way_bitmap_for_naip(None, raster_data_path, None, None,
-                                                           None))
-        render_predictions(raster_data_path, predictions, test_images, way_bitmap_npy, band_list,
-                           tile_size)
+        way_bitmap = load_way_bitmap(raster_data_path, params)
+        render_predictions(raster_data_path, predictions, test_images, way_bitmap, band_list,
+                           tile_size, params['label_format'], params['pixels_to_fatten_roads'])
 
 
 def render_predictions(raster_data_path, predictions, test_images, way_bitmap_npy, band_list,
-                       tile_size):
+                       tile_size, label_format=LABEL_BITMAP, pixels_to_fatten_roads=0):
     """Generate a JPEG for the given raster_data_path, showing predictions shaded."""
     test_images_by_naip = []
     predictions_by_naip = []
@@ -51,7 +55,9 @@ def render_predictions(raster_data_path, predictions, test_images, way_bitmap_np
                             test_images_by_naip,
                             band_list,
                             tile_size,
-                            predictions=predictions_by_naip)
+                            predictions=predictions_by_naip,
+                            label_format=label_format,
+                            pixels_to_fatten_roads=pixels_to_fatten_roads)
 
 
 def render_results_as_image(raster_data_path,
@@ -59,7 +65,9 @@ def render_results_as_image(raster_data_path,
                             test_images,
                             band_list,
                             tile_size,
-                            predictions=None):
+                            predictions=None,
+                            label_format=LABEL_BITMAP,
+                            pixels_to_fatten_roads=0):
     """Save the source TIFF as a JPEG, with labels and data overlaid."""
     timestr = time.strftime("%Y%m%d-%H%M%S")
     outfile = os.path.splitext(raster_data_path)[0] + '-' + timestr + ".jpeg"
@@ -67,8 +75,7 @@ def render_results_as_image(raster_data_path,
     # http://stackoverflow.com/questions/28870504/converting-tiff-to-jpeg-in-python
     im = Image.open(raster_data_path)
     print("GENERATING JPEG for %s" % raster_data_path)
-    rows = len(way_bitmap)
-    cols = len(way_bitmap[0])
+    cols, rows = im.size
     t0 = time.time()
     r, g, b, ir = im.split()
     # visualize single band analysis tinted for R-G-B,
@@ -100,11 +107,12 @@ def render_results_as_image(raster_data_path,
     print("{0:.1f}s to SHADE PREDICTIONS on JPEG".format(t1 - t0))
 
     t0 = time.time()
-    # show raw data that spawned the labels
-    for row in range(0, rows):
-        for col in range(0, cols):
-            if way_bitmap[row][col] != 0:
-                im.putpixel((col, row), (255, 0, 0))
+    # show raw data that spawned the labels, decoding the way bitmap a strip of rows at a time
+    for row in range(0, rows, RENDER_STRIP_ROWS):
+        strip = label_mask(way_bitmap[row:row + RENDER_STRIP_ROWS, 0:cols], label_format,
+                           pixels_to_fatten_roads)
+        mask = Image.fromarray(strip * 255, mode='L')
+        im.paste((255, 0, 0), (0, row, cols, row + strip.shape[0]), mask)
     t1 = time.time()
     print("{0:.1f}s to DRAW WAYS ON JPEG".format(t1 - t0))
 
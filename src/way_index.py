@@ -0,0 +1,165 @@
+"""A spatial index over the segments of extracted ways, to find the ones on a NAIP quickly.
+
+Segments are bucketed into a uniform grid of lon/lat cells by their bounding boxes, once per
+extract, so looking up a NAIP's segments only visits the cells its bounds cover, instead of
+every point of every way in the extract.
+
+Way points are also projected into each NAIP projection (UTM zone) in use once per extract,
+so a NAIP's segments only need its geotransform applied to put them in pixels.
+"""
+
+import numpy
+from src.geo_util import project_lon_lats
+from src.label_rasters import way_class_ids
+from src.ways import Ways
+
+# width and height of the index's grid cells, in degrees (a NAIP is about 0.07 x 0.07)
+WAY_INDEX_CELL_DEGREES = 0.05
+
+
+def clip_segments(segments, min_x, min_y, max_x, max_y):
+    """Clip (N, 4) x0, y0, x1, y1 segments to a box, with Liang-Barsky.
+
+    Returns (clipped, inside): the clipped segments, and a boolean array of which segments
+    touch the box at all. Rows of clipped for segments outside the box are meaningless.
+    """
+    segments = numpy.asarray(segments, dtype=numpy.float64).reshape(-1, 4)
+    x0, y0 = segments[:, 0], segments[:, 1]
+    dx, dy = segments[:, 2] - x0, segments[:, 3] - y0
+    t_start = numpy.zeros(len(segments))
+    t_end = numpy.ones(len(segments))
+    inside = numpy.ones(len(segments), dtype=bool)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        for p, q in ((-dx, x0 - min_x), (dx, max_x - x0), (-dy, y0 - min_y), (dy, max_y - y0)):
+            # parallel to this edge, and outside it
+            inside &= ~((p == 0) & (q < 0))
+            r = q / p
+            entering, leaving = p < 0, p > 0
+            t_start[entering] = numpy.maximum(t_start[entering], r[entering])
+            t_end[leaving] = numpy.minimum(t_end[leaving], r[leaving])
+    inside &= t_start <= t_end
+    clipped = numpy.column_stack((x0 + t_start * dx, y0 + t_start * dy,
+                                  x0 + t_end * dx, y0 + t_end * dy))
+    return clipped, inside
+
+
+class WayIndex:
+    """The segments of Ways, or a list of way dicts with a 'linestring' of (lon, lat), gridded.
+
+    points is an (M, 2) array of every way's lon/lat points, in order. segments is an (N, 4)
+    array of lon0, lat0, lon1, lat1 for every pair of consecutive points, segment_starts the
+    index in points of each segment's first point, way_ids the index in ways of the way
+    each segment belongs to, and way_types each way's 'way_type'.
+    """
+
+    def __init__(self, ways, cell_size=WAY_INDEX_CELL_DEGREES):
+        """Index the segments of ways, in a grid of cell_size degree cells."""
+        self.way_count = len(ways)
+        self.cell_size = float(cell_size)
+        if isinstance(ways, Ways):
+            # already columns, so no need to walk the ways
+            types = ways.types + [None]
+            self.way_types = [types[code] for code in ways.type_codes]
+            lengths = numpy.diff(ways.offsets)
+            self.points = numpy.asarray(ways.coords)
+        else:
+            self.way_types = [way.get('way_type') for way in ways]
+            lengths = numpy.array([len(way['linestring']) for way in ways], dtype=numpy.int64)
+            self.points = numpy.array([point[:2] for way in ways for point in way['linestring']],
+                                      dtype=numpy.float64).reshape(-1, 2)
+        # every point but the last of each way starts a segment
+        segment_counts = numpy.maximum(lengths - 1, 0)
+        first_segments = numpy.cumsum(segment_counts) - segment_counts
+        way_starts = numpy.cumsum(lengths) - lengths
+        self.segment_starts = numpy.repeat(way_starts - first_segments, segment_counts) + \
+            numpy.arange(segment_counts.sum())
+        self.segments = numpy.hstack((self.points[self.segment_starts],
+                                      self.points[self.segment_starts + 1]))
+        self.way_ids = numpy.repeat(numpy.arange(len(ways)), segment_counts)
+        self.projected = {}
+        self._build_grid()
+
+    def _build_grid(self):
+        """Bucket each segment into every grid cell its bounding box overlaps."""
+        segments = self.segments
+        self.origin = segments[:, 0:2].min(axis=0) if len(segments) else numpy.zeros(2)
+        first_col, first_row = self._cells(numpy.minimum(segments[:, 0], segments[:, 2]),
+                                           numpy.minimum(segments[:, 1], segments[:, 3]))
+        last_col, last_row = self._cells(numpy.maximum(segments[:, 0], segments[:, 2]),
+                                         numpy.maximum(segments[:, 1], segments[:, 3]))
+        self.grid_cols = int(last_col.max()) + 1 if len(segments) else 0
+        widths = last_col - first_col + 1
+        cell_counts = widths * (last_row - first_row + 1)
+        segment_ids = numpy.repeat(numpy.arange(len(segments)), cell_counts)
+        nth_cell = numpy.arange(len(segment_ids)) - numpy.repeat(
+            numpy.cumsum(cell_counts) - cell_counts, cell_counts)
+        cols = first_col[segment_ids] + nth_cell % widths[segment_ids]
+        rows = first_row[segment_ids] + nth_cell // widths[segment_ids]
+        keys = rows * self.grid_cols + cols
+        order = numpy.argsort(keys, kind='mergesort')
+        self.cell_segment_ids = segment_ids[order]
+        # cell_keys[i]'s segments are cell_segment_ids[cell_starts[i]:cell_starts[i + 1]]
+        self.cell_keys, cell_starts = numpy.unique(keys[order], return_index=True)
+        self.cell_starts = numpy.append(cell_starts, len(order))
+
+    def _cells(self, lons, lats):
+        """Return the (cols, rows) of the grid cells lons and lats fall in, as int64 arrays."""
+        cols = numpy.floor((lons - self.origin[0]) / self.cell_size).astype(numpy.int64)
+        rows = numpy.floor((lats - self.origin[1]) / self.cell_size).astype(numpy.int64)
+        return cols, rows
+
+    def __len__(self):
+        """Return the number of segments indexed."""
+        return len(self.segments)
+
+    def candidates(self, min_lon, min_lat, max_lon, max_lat):
+        """Return the ids of the segments whose bounding boxes overlap a lon/lat box, sorted."""
+        if not len(self.segments):
+            return numpy.zeros(0, dtype=numpy.int64)
+        (first_col, last_col), (first_row, last_row) = self._cells(
+            numpy.array([min_lon, max_lon]), numpy.array([min_lat, max_lat]))
+        first_col, last_col = max(first_col, 0), min(last_col, self.grid_cols - 1)
+        first_row = max(first_row, 0)
+        found = []
+        if first_col <= last_col:
+            for row in range(first_row, last_row + 1):
+                first, last = numpy.searchsorted(
+                    self.cell_keys, [row * self.grid_cols + first_col,
+                                     row * self.grid_cols + last_col + 1])
+                found.append(self.cell_segment_ids[self.cell_starts[first]:
+                                                   self.cell_starts[last]])
+        segment_ids = numpy.unique(numpy.concatenate(found)) if found else \
+            numpy.zeros(0, dtype=numpy.int64)
+        # drop segments that only share a cell with the box
+        segments = self.segments[segment_ids]
+        overlaps = ((numpy.maximum(segments[:, 0], segments[:, 2]) >= min_lon) &
+                    (numpy.minimum(segments[:, 0], segments[:, 2]) <= max_lon) &
+                    (numpy.maximum(segments[:, 1], segments[:, 3]) >= min_lat) &
+                    (numpy.minimum(segments[:, 1], segments[:, 3]) <= max_lat))
+        return segment_ids[overlaps]
+
+    def way_classes(self, classes):
+        """Return the uint8 class id of each way, from a way_type to class id dict.
+
+        See label_rasters.way_class_ids for ways whose way_type isn't in classes.
+        """
+        return way_class_ids(classes, self.way_types)
+
+    def projected_points(self, projection_wkt):
+        """Return points projected into projection_wkt's SRS, projecting them the first time."""
+        if projection_wkt not in self.projected:
+            self.projected[projection_wkt] = project_lon_lats(projection_wkt, self.points)
+        return self.projected[projection_wkt]
+
+    def projected_segments(self, projection_wkt, segment_ids):
+        """Return (N, 4) x0, y0, x1, y1 for segment_ids, in projection_wkt's SRS."""
+        points = self.projected_points(projection_wkt)
+        starts = self.segment_starts[segment_ids]
+        return numpy.hstack((points[starts], points[starts + 1]))
+
+    def clipped_segments(self, min_lon, min_lat, max_lon, max_lat):
+        """Return (segments, way_ids) for the segments in a lon/lat box, clipped to it."""
+        segment_ids = self.candidates(min_lon, min_lat, max_lon, max_lat)
+        clipped, inside = clip_segments(self.segments[segment_ids], min_lon, min_lat, max_lon,
+                                        max_lat)
+        return clipped[inside], self.way_ids[segment_ids[inside]]
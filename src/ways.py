@@ -0,0 +1,275 @@
+"""Columnar storage for ways extracted from OSM, instead of a dict and tuple lists per way.
+
+Every way's points are in one flat float64 (N, 2) array of (lon, lat), with an int64 offsets
+array marking where each way starts, and the OSM node id of each point (-1 if unknown) in a
+matching int64 array. Way ids and interned way_type codes are one array each, and tags, if
+kept, are interned key and value codes in a side table laid out the same way.
+
+Ways still reads like the list of way dicts it replaces: ways[i] is a dict with 'id',
+'way_type', 'linestring' and 'tags'. Saved Ways load back memory mapped, without copying.
+"""
+
+import json
+import os
+from array import array
+
+import numpy
+
+# the .npy columns Ways.save writes, and the JSON file of interned strings
+WAYS_COLUMNS = ('coords', 'node_ids', 'offsets', 'ids', 'type_codes', 'tag_offsets',
+                'tag_keys', 'tag_values')
+WAYS_STRINGS_FILENAME = 'strings.json'
+
+# the type code of ways without a way_type
+NO_WAY_TYPE = -1
+# the node id of points whose node isn't known
+NO_NODE_ID = -1
+
+
+def gather_runs(offsets, indices):
+    """Return (offsets, positions) for gathering the runs offsets delimits, at indices.
+
+    Run i is offsets[i] to offsets[i + 1]. positions indexes the values of the runs at
+    indices, back to back, and the returned offsets delimit them.
+    """
+    starts = offsets[indices]
+    lengths = offsets[indices + 1] - starts
+    gathered_offsets = numpy.concatenate(([0], numpy.cumsum(lengths))).astype(numpy.int64)
+    positions = numpy.repeat(starts - gathered_offsets[:-1], lengths) + \
+        numpy.arange(gathered_offsets[-1])
+    return gathered_offsets, positions
+
+
+class Ways:
+    """A growable, then saveable, column store of ways; see the module docstring."""
+
+    def __init__(self, keep_tags=True):
+        """Start an empty store; with keep_tags False, tags passed to append are dropped."""
+        self.keep_tags = keep_tags
+        self.types = []
+        self.strings = []
+        self._type_codes_by_name = {}
+        self._string_codes = {}
+        # builders, appended to until the columns are first read
+        self._builders = {'coords': array('d'), 'node_ids': array('l'), 'offsets': array('l', [0]),
+                          'ids': array('l'), 'type_codes': array('l'),
+                          'tag_offsets': array('l', [0]), 'tag_keys': array('l'),
+                          'tag_values': array('l')}
+        self._columns = None
+
+    def append(self, way_id, way_type, linestring, tags=(), node_ids=None):
+        """Add a way, with a linestring of (lon, lat) points and a list of (key, value) tags.
+
+        node_ids (optional) is the node id of each point.
+        """
+        coords = []
+        for point in linestring:
+            coords.extend(point[0:2])
+        self.append_coords(way_id, way_type, coords, tags, node_ids)
+
+    def append_coords(self, way_id, way_type, coords, tags=(), node_ids=None):
+        """Add a way, like append, but with its points as a flat lon0, lat0, lon1, ... sequence."""
+        if self._columns is not None:
+            self._thaw()
+        builders = self._builders
+        builders['coords'].extend(coords)
+        if node_ids is None:
+            node_ids = [NO_NODE_ID] * (len(coords) // 2)
+        builders['node_ids'].extend(node_ids)
+        builders['offsets'].append(len(builders['coords']) // 2)
+        builders['ids'].append(way_id)
+        builders['type_codes'].append(self._type_code(way_type))
+        if self.keep_tags:
+            for key, value in tags:
+                builders['tag_keys'].append(self._string_code(key))
+                builders['tag_values'].append(self._string_code(value))
+        builders['tag_offsets'].append(len(builders['tag_keys']))
+
+    def _type_code(self, way_type):
+        """Return the interned code for way_type."""
+        if way_type is None:
+            return NO_WAY_TYPE
+        if way_type not in self._type_codes_by_name:
+            self._type_codes_by_name[way_type] = len(self.types)
+            self.types.append(way_type)
+        return self._type_codes_by_name[way_type]
+
+    def _string_code(self, string):
+        """Return the interned code for a tag key or value."""
+        if string not in self._string_codes:
+            self._string_codes[string] = len(self.strings)
+            self.strings.append(string)
+        return self._string_codes[string]
+
+    def columns(self):
+        """Return the dict of numpy column arrays, converting the builders the first time."""
+        if self._columns is None:
+            columns = {}
+            for name, builder in self._builders.items():
+                columns[name] = numpy.array(builder, dtype=numpy.int64 if builder.typecode == 'l'
+                                            else numpy.float64)
+            columns['coords'] = columns['coords'].reshape(-1, 2)
+            self._columns = columns
+            self._builders = None
+        return self._columns
+
+    def _thaw(self):
+        """Turn the columns back into builders, to append to them."""
+        self._builders = {}
+        for name, column in self._columns.items():
+            typecode = 'd' if column.dtype == numpy.float64 else 'l'
+            self._builders[name] = array(typecode, numpy.ravel(column).tolist())
+        self._columns = None
+
+    @property
+    def coords(self):
+        """Return the (N, 2) float64 array of every way's (lon, lat) points."""
+        return self.columns()['coords']
+
+    @property
+    def node_ids(self):
+        """Return the int64 array of the node id of each point in coords, or NO_NODE_ID."""
+        return self.columns()['node_ids']
+
+    @property
+    def offsets(self):
+        """Return the int64 array of where each way's points start in coords, and the end."""
+        return self.columns()['offsets']
+
+    @property
+    def ids(self):
+        """Return the int64 array of OSM way ids."""
+        return self.columns()['ids']
+
+    @property
+    def type_codes(self):
+        """Return the int64 array of each way's index in types, or NO_WAY_TYPE."""
+        return self.columns()['type_codes']
+
+    def __len__(self):
+        """Return the number of ways."""
+        if self._columns is None:
+            return len(self._builders['ids'])
+        return len(self._columns['ids'])
+
+    def __getitem__(self, index):
+        """Return way index as a dict with 'id', 'way_type', 'linestring' and 'tags'."""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("way index out of range")
+        code = int(self.type_codes[index])
+        return {'id': int(self.ids[index]),
+                'way_type': self.types[code] if code != NO_WAY_TYPE else None,
+                'linestring': [tuple(point) for point in self.linestring(index).tolist()],
+                'tags': self.tags(index)}
+
+    def __iter__(self):
+        """Iterate over the ways as dicts, like __getitem__."""
+        for index in range(len(self)):
+            yield self[index]
+
+    def linestring(self, index):
+        """Return the (n, 2) array of way index's points, as a view of coords."""
+        offsets = self.offsets
+        return self.coords[offsets[index]:offsets[index + 1]]
+
+    def tags(self, index):
+        """Return way index's list of (key, value) tags; empty if tags weren't kept."""
+        columns = self.columns()
+        start, stop = columns['tag_offsets'][index:index + 2]
+        return [(self.strings[key], self.strings[value])
+                for key, value in zip(columns['tag_keys'][start:stop],
+                                      columns['tag_values'][start:stop])]
+
+    def save(self, directory):
+        """Save the columns as .npy files in directory, with the interned strings as JSON."""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name, column in self.columns().items():
+            numpy.save(os.path.join(directory, name + '.npy'), column)
+        with open(os.path.join(directory, WAYS_STRINGS_FILENAME), 'w') as outfile:
+            json.dump({'types': self.types, 'strings': self.strings,
+                       'keep_tags': self.keep_tags}, outfile)
+
+    def take(self, indices):
+        """Return a new Ways of the ways at indices, in that order."""
+        indices = numpy.asarray(indices, dtype=numpy.int64)
+        columns = self.columns()
+        taken = Ways(self.keep_tags)
+        taken.types, taken.strings = list(self.types), list(self.strings)
+        taken._type_codes_by_name = dict(self._type_codes_by_name)
+        taken._string_codes = dict(self._string_codes)
+        offsets, positions = gather_runs(columns['offsets'], indices)
+        tag_offsets, tag_positions = gather_runs(columns['tag_offsets'], indices)
+        taken._columns = {'coords': columns['coords'][positions],
+                          'node_ids': columns['node_ids'][positions],
+                          'offsets': offsets,
+                          'ids': columns['ids'][indices],
+                          'type_codes': columns['type_codes'][indices],
+                          'tag_offsets': tag_offsets,
+                          'tag_keys': columns['tag_keys'][tag_positions],
+                          'tag_values': columns['tag_values'][tag_positions]}
+        taken._builders = None
+        return taken
+
+    @classmethod
+    def merge(cls, ways_list):
+        """Return a new Ways of the ways in each of ways_list, dropping repeated way ids.
+
+        A way in more than one of ways_list (one on a border between extracts) is kept where it
+        first appears. A single Ways is returned as is.
+        """
+        if len(ways_list) == 1:
+            return ways_list[0]
+        merged = cls.concatenate(ways_list)
+        _, first = numpy.unique(merged.ids, return_index=True)
+        if len(first) == len(merged):
+            return merged
+        return merged.take(numpy.sort(first))
+
+    @classmethod
+    def concatenate(cls, ways_list):
+        """Return a new Ways of the ways in each of ways_list, in order."""
+        merged = cls(all(ways.keep_tags for ways in ways_list))
+        columns = dict((name, [numpy.zeros(0, dtype=numpy.int64)]) for name in WAYS_COLUMNS)
+        columns['coords'] = [numpy.zeros((0, 2))]
+        point_count = tag_count = 0
+        for ways in ways_list:
+            type_codes = numpy.array([merged._type_code(name) for name in ways.types] +
+                                     [NO_WAY_TYPE], dtype=numpy.int64)
+            string_codes = numpy.array([merged._string_code(string) for string in ways.strings],
+                                       dtype=numpy.int64)
+            part = ways.columns()
+            columns['coords'].append(part['coords'])
+            columns['node_ids'].append(part['node_ids'])
+            columns['offsets'].append(part['offsets'][:-1] + point_count)
+            columns['ids'].append(part['ids'])
+            # NO_WAY_TYPE indexes the last code, which is NO_WAY_TYPE again
+            columns['type_codes'].append(type_codes[part['type_codes']])
+            columns['tag_offsets'].append(part['tag_offsets'][:-1] + tag_count)
+            columns['tag_keys'].append(string_codes[part['tag_keys']])
+            columns['tag_values'].append(string_codes[part['tag_values']])
+            point_count += len(part['coords'])
+            tag_count += len(part['tag_keys'])
+        columns['offsets'].append(numpy.array([point_count]))
+        columns['tag_offsets'].append(numpy.array([tag_count]))
+        merged._columns = dict((name, numpy.concatenate(parts)) for name, parts in columns.items())
+        merged._builders = None
+        return merged
+
+    @classmethod
+    def load(cls, directory):
+        """Load Ways saved to directory, with its columns memory mapped read-only."""
+        with open(os.path.join(directory, WAYS_STRINGS_FILENAME)) as infile:
+            strings = json.load(infile)
+        ways = cls(strings['keep_tags'])
+        ways.types = strings['types']
+        ways.strings = strings['strings']
+        ways._type_codes_by_name = dict((name, code) for code, name in enumerate(ways.types))
+        ways._string_codes = dict((string, code) for code, string in enumerate(ways.strings))
+        ways._columns = dict((name, numpy.load(os.path.join(directory, name + '.npy'),
+                                               mmap_mode='r'))
+                             for name in WAYS_COLUMNS)
+        ways._builders = None
+        return ways
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from src.download import Download, is_downloaded, plan_segments
+
+
+class FileServer(ThreadingMixIn, HTTPServer):
+    """Serves files from a dict of path: bytes, with byte ranges, on localhost."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FileHandler)
+        self.files = {}
+        self.ranges = True
+        # stop sending a response after this many bytes, to interrupt downloads
+        self.cut_after = None
+        self.requests = []
+        self.sent = 0
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server_address[1], path)
+
+
+class FileHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _headers(self):
+        server = self.server
+        server.requests.append((self.command, self.headers.get('Range')))
+        data = server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return None
+        range_header = self.headers.get('Range')
+        if server.ranges and range_header:
+            start, end = [int(bound) for bound in range_header.split('=')[1].split('-')]
+            data = data[start:end + 1]
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        if server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', '"{}"'.format(hashlib.md5(server.files[self.path]).hexdigest()))
+        self.end_headers()
+        return data
+
+    def do_HEAD(self):
+        self._headers()
+
+    def do_GET(self):
+        data = self._headers()
+        if data is None:
+            return
+        if self.server.cut_after is not None:
+            data = data[:self.server.cut_after]
+        self.wfile.write(data)
+        self.server.sent += len(data)
+
+
+class TestDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FileServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.data = os.urandom(100000)
+        self.server.files['/state.osm.pbf'] = self.data
+        self.server.files['/state.osm.pbf.md5'] = '{}  state.osm.pbf\n'.format(
+            hashlib.md5(self.data).hexdigest())
+        self.url = self.server.url('/state.osm.pbf')
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'state.osm.pbf')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tempdir)
+
+    def download(self):
+        return Download(self.url, self.path, segments=4, min_segment_bytes=10000).run()
+
+    def assertDownloaded(self):
+        with open(self.path, 'rb') as infile:
+            self.assertEqual(infile.read(), self.data)
+        self.assertEqual(sorted(os.listdir(self.tempdir)), ['state.osm.pbf',
+                                                            'state.osm.pbf.md5'])
+
+    def test_plan_segments(self):
+        self.assertEqual(plan_segments(10, 4, 3), [[0, 3, 0], [3, 6, 0], [6, 10, 0]])
+        self.assertEqual(plan_segments(10, 4, 20), [[0, 10, 0]])
+        self.assertEqual(plan_segments(None, 4, 3), [[0, None, 0]])
+
+    def test_downloads_in_ranges(self):
+        self.download()
+        self.assertDownloaded()
+        ranges = [range_header for command, range_header in self.server.requests
+                  if command == 'GET' and range_header]
+        self.assertEqual(len(ranges), 4)
+        self.assertTrue(is_downloaded(self.url, self.path))
+
+    def test_resumes(self):
+        self.server.cut_after = 5000
+        self.assertRaises(IOError, self.download)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertTrue(os.path.exists(self.path + '.part'))
+        self.server.cut_after = None
+        self.server.sent = 0
+        self.download()
+        self.assertDownloaded()
+        # the rest of each of 4 segments, and the .md5
+        md5_length = len(self.server.files['/state.osm.pbf.md5'])
+        self.assertEqual(self.server.sent, len(self.data) - 4 * 5000 + md5_length)
+
+    def test_without_ranges(self):
+        self.server.ranges = False
+        self.download()
+        self.assertDownloaded()
+
+    def test_md5_mismatch(self):
+        self.server.files['/state.osm.pbf.md5'] = '0' * 32
+        self.assertRaises(IOError, self.download)
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_checks_older_downloads(self):
+        with open(self.path, 'wb') as outfile:
+            outfile.write(self.data[:5000])
+        self.assertFalse(is_downloaded(self.url, self.path))
+        with open(self.path, 'wb') as outfile:
+            outfile.write(self.data)
+        self.assertTrue(is_downloaded(self.url, self.path))
+        self.assertTrue(os.path.exists(self.path + '.md5'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+import unittest
+
+import numpy
+
+from src.geo_util import world_to_pixel
+
+
+class TestWorldToPixel(unittest.TestCase):
+
+    def test_inverts_geotransform(self):
+        geotransform = (431000.0, 1.0, 0.0, 4336000.0, 0.0, -1.0)
+        pixels = world_to_pixel(geotransform, [(431000.0, 4336000.0), (431250.5, 4335900.0)])
+        numpy.testing.assert_allclose(pixels, [(0, 0), (250.5, 100)])
+
+    def test_inverts_rotated_geotransform(self):
+        geotransform = (100.0, 0.5, 0.1, 200.0, 0.2, -0.5)
+        cols_rows = numpy.array([(0, 0), (10, 20), (7.5, 3)])
+        xs = geotransform[0] + cols_rows[:, 0] * geotransform[1] + cols_rows[:, 1] * geotransform[2]
+        ys = geotransform[3] + cols_rows[:, 0] * geotransform[4] + cols_rows[:, 1] * geotransform[5]
+        numpy.testing.assert_allclose(world_to_pixel(geotransform, numpy.column_stack((xs, ys))),
+                                      cols_rows)
+
+
+if __name__ == "__main__":
+    unittest.main()
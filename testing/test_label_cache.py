@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from src import label_cache
+from src.label_cache import LabelCache, file_digest, label_params, way_bitmap_cache_key
+
+
+class TestLabelCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_file(self, filename, data):
+        path = os.path.join(self.tmp_dir, filename)
+        with open(path, 'wb') as outfile:
+            outfile.write(data)
+        return path
+
+    def test_keys_change_with_every_param(self):
+        naip_path = self.write_file('m_3807504_ne_18_1_20130924.tif', b'naip')
+        pbf_path = self.write_file('delaware-latest.osm.pbf', b'pbf')
+        params = label_params([pbf_path], 'highway', 3, 'bitmap')
+        key = way_bitmap_cache_key(naip_path, params)
+        self.assertEqual(key, way_bitmap_cache_key(naip_path, dict(params)))
+
+        other_keys = [way_bitmap_cache_key(naip_path, dict(params, **change))
+                      for change in [{'extract_type': 'tennis'}, {'pixels_to_fatten_roads': 2},
+                                     {'label_format': 'distance'}]]
+        self.write_file('delaware-latest.osm.pbf', b'newer pbf')
+        other_keys.append(way_bitmap_cache_key(
+            naip_path, label_params([pbf_path], 'highway', 3, 'bitmap')))
+        self.assertEqual(len(set(other_keys + [key])), 5)
+
+    def test_keys_follow_naip_contents(self):
+        naip_path = self.write_file('m_3807504_ne_18_1_20130924.tif', b'naip')
+        params = label_params([], 'highway', 3, 'bitmap')
+        key = way_bitmap_cache_key(naip_path, params)
+        self.assertEqual(way_bitmap_cache_key(self.write_file('moved.tif', b'naip'), params), key)
+        self.write_file('m_3807504_ne_18_1_20130924.tif', b'newer naip')
+        self.assertNotEqual(way_bitmap_cache_key(naip_path, params), key)
+
+    def test_file_digest_saved(self):
+        path = self.write_file('delaware-latest.osm.pbf', b'pbf')
+        digest = file_digest(path)
+        self.assertTrue(os.path.exists(path + '.sha1.json'))
+        # a new process uses the saved digest, instead of hashing the file again
+        label_cache._file_digests.clear()
+        with open(path + '.sha1.json') as infile:
+            saved = infile.read()
+        with open(path + '.sha1.json', 'w') as outfile:
+            outfile.write(saved.replace(digest, 'saved'))
+        self.assertEqual(file_digest(path), 'saved')
+        self.write_file('delaware-latest.osm.pbf', b'newer pbf')
+        self.assertNotEqual(file_digest(path), 'saved')
+        self.assertNotEqual(file_digest(path), digest)
+
+    def test_put_and_get(self):
+        cache = LabelCache(self.cache_dir)
+        self.assertEqual(cache.get('abc'), None)
+        path = cache.put('abc', '.bin', lambda outfile: outfile.write(b'12345'))
+        self.assertEqual(cache.get('abc'), path)
+        with open(path, 'rb') as infile:
+            self.assertEqual(infile.read(), b'12345')
+        self.assertFalse([f for f in os.listdir(self.cache_dir) if f.endswith('.tmp')])
+
+        os.remove(path)
+        self.assertEqual(cache.get('abc'), None)
+
+    def test_link(self):
+        cache = LabelCache(self.cache_dir)
+        self.assertEqual(cache.link('abc', 'def'), None)
+        cache.put('abc', '-ways.bin', lambda outfile: outfile.write(b'12345'))
+        path = cache.link('abc', 'def')
+        self.assertEqual(os.path.basename(path), 'def-ways.bin')
+        self.assertEqual(cache.get('def'), path)
+        cache.remove('abc')
+        with open(cache.get('def'), 'rb') as infile:
+            self.assertEqual(infile.read(), b'12345')
+
+    def test_links_count_once(self):
+        cache = LabelCache(self.cache_dir, max_bytes=25)
+        cache.put('a', '.bin', lambda outfile: outfile.write(b'x' * 10))
+        time.sleep(0.01)
+        cache.put('b', '.bin', lambda outfile: outfile.write(b'x' * 10))
+        time.sleep(0.01)
+        # the link shares a's 10 bytes, so with b least recently used, evicting b is enough
+        cache.link('a', 'a2')
+        self.assertNotEqual(cache.get('b'), None)
+        time.sleep(0.01)
+        cache.get('a')
+        cache.get('a2')
+        time.sleep(0.01)
+        cache.put('c', '.bin', lambda outfile: outfile.write(b'x' * 10))
+        self.assertEqual(cache.get('b'), None)
+        for key in ['a', 'a2', 'c']:
+            self.assertNotEqual(cache.get(key), None)
+
+    def test_link_evicts(self):
+        cache = LabelCache(self.cache_dir, max_bytes=15)
+        cache.put('a', '.bin', lambda outfile: outfile.write(b'x' * 10))
+        link = os.link
+
+        def fail(source, link_name):
+            raise OSError("cross-device link")
+
+        os.link = fail
+        try:
+            # a copy takes its own bytes, so the link evicts the entry it was copied from
+            path = cache.link('a', 'b')
+        finally:
+            os.link = link
+        self.assertEqual(cache.get('b'), path)
+        self.assertEqual(cache.get('a'), None)
+
+    def test_failed_write_leaves_nothing(self):
+        cache = LabelCache(self.cache_dir)
+
+        def write(outfile):
+            outfile.write(b'partial')
+            raise ValueError("write failed")
+
+        self.assertRaises(ValueError, cache.put, 'abc', '.bin', write)
+        self.assertEqual(cache.get('abc'), None)
+        self.assertFalse([f for f in os.listdir(self.cache_dir) if f.endswith('.bin') or
+                          f.endswith('.tmp')])
+
+    def test_evicts_least_recently_used(self):
+        cache = LabelCache(self.cache_dir, max_bytes=25)
+        for key in ['a', 'b', 'c']:
+            cache.put(key, '.bin', lambda outfile: outfile.write(b'x' * 10))
+            time.sleep(0.01)
+        self.assertEqual(cache.get('a'), None)
+        cache.get('b')
+        time.sleep(0.01)
+        cache.put('d', '.bin', lambda outfile: outfile.write(b'x' * 10))
+        self.assertNotEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), None)
+        self.assertNotEqual(cache.get('d'), None)
+        self.assertEqual(sorted(f for f in os.listdir(self.cache_dir) if f.endswith('.bin')),
+                         ['b.bin', 'd.bin'])
+
+
+if __name__ == "__main__":
+    unittest.main()
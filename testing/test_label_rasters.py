@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from src.label_rasters import WAY_CLASSES, PackedBitmap, class_mask, save_packed_bitmap, \
+    way_class_ids
+from src.way_index import WayIndex
+from src.ways import Ways
+
+
+class TestPackedBitmap(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'ways.packed.npy')
+        self.bitmap = (numpy.random.rand(123, 301) > 0.9).astype(numpy.uint8)
+        save_packed_bitmap(self.path, self.bitmap)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_packs_eight_pixels_per_byte(self):
+        self.assertEqual(numpy.load(self.path).shape, (123, 38))
+
+    def test_windows_match_bitmap(self):
+        bitmap = PackedBitmap(self.path, 301)
+        self.assertEqual(bitmap.shape, (123, 301))
+        for row, col, size in [(0, 0, 64), (3, 5, 17), (50, 237, 64), (100, 290, 30)]:
+            numpy.testing.assert_array_equal(bitmap[row:row + size, col:col + size],
+                                             self.bitmap[row:row + size, col:col + size])
+        numpy.testing.assert_array_equal(bitmap.to_array(), self.bitmap)
+
+
+class TestClassMask(unittest.TestCase):
+
+    def test_selects_classes(self):
+        labels = numpy.array([[0, 1, 2], [3, 8, 1]], dtype=numpy.uint8)
+        numpy.testing.assert_array_equal(class_mask(labels, [1, 8]), [[0, 1, 0], [0, 1, 1]])
+        numpy.testing.assert_array_equal(class_mask(labels, []), numpy.zeros((2, 3)))
+
+
+class TestWayClassIds(unittest.TestCase):
+
+    def setUp(self):
+        self.ways = Ways()
+        self.ways.append(1, 'primary', [(0.0, 0.0), (1.0, 0.0)])
+        self.ways.append(2, 'construction', [(0.0, 1.0), (1.0, 1.0)])
+        # a tennis court has no way_type
+        self.ways.append(3, None, [(0.0, 2.0), (1.0, 2.0)])
+
+    def test_unmapped_ways_get_other_class(self):
+        numpy.testing.assert_array_equal(WayIndex(self.ways).way_classes(WAY_CLASSES), [6, 1, 1])
+        numpy.testing.assert_array_equal(
+            way_class_ids({'primary': 2, 'other': 0}, ['primary', None]), [2, 0])
+
+    def test_unmapped_ways_without_other_class(self):
+        self.assertRaises(ValueError, WayIndex(self.ways).way_classes, {'primary': 6})
+        numpy.testing.assert_array_equal(way_class_ids({'primary': 6}, ['primary']), [6])
+
+
+if __name__ == "__main__":
+    unittest.main()
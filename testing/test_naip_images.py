@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import src.naip_images as naip_images
+from src.naip_images import NAIPDownloader, cached_keys
+
+
+class Paginator:
+
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, **kwargs):
+        self.client.listings.append(kwargs)
+        for i in range(0, len(self.client.keys), 2):
+            if i == self.client.fail_at:
+                raise IOError("connection reset")
+            yield {'Contents': [{'Key': key} for key in self.client.keys[i:i + 2]]}
+
+
+class S3Client:
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.listings = []
+        self.fail_at = None
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return Paginator(self)
+
+
+class TestListNAIPs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.listing_dir = os.path.join(self.tmp_dir, 'listings')
+        self.naip_data_dir = naip_images.NAIP_DATA_DIR
+        naip_images.NAIP_DATA_DIR = os.path.join(self.tmp_dir, 'naip')
+        prefix = 'de/2013/1m/rgbir/'
+        self.client = S3Client([prefix + '38075/',
+                                prefix + '38075/m_3807503_ne_18_1_20130907.tif',
+                                prefix + '38075/m_3807504_ne_18_1_20130924.tif',
+                                prefix + '38076/m_3807601_nw_18_1_20130924.tif',
+                                prefix + 'manifest.txt'])
+
+    def tearDown(self):
+        naip_images.NAIP_DATA_DIR = self.naip_data_dir
+        shutil.rmtree(self.tmp_dir)
+
+    def downloader(self, extents=None, ttl=60):
+        return NAIPDownloader(-1, False, 'de', '2013', extents, s3_client=self.client,
+                              listing_dir=self.listing_dir, listing_ttl=ttl)
+
+    def test_lists_bucket_once(self):
+        self.assertEqual(self.downloader().list_naips(),
+                         ['38075/m_3807503_ne_18_1_20130907.tif',
+                          '38075/m_3807504_ne_18_1_20130924.tif',
+                          '38076/m_3807601_nw_18_1_20130924.tif'])
+        self.assertEqual(self.client.listings, [{'Bucket': 'aws-naip',
+                                                 'Prefix': 'de/2013/1m/rgbir/',
+                                                 'RequestPayer': 'requester'}])
+        self.assertTrue(os.path.isdir(os.path.join(naip_images.NAIP_DATA_DIR, '38076')))
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['listings', 'naip'])
+        # a different extent is filtered from the saved listing
+        self.assertEqual(self.downloader((-75.7, 38.9, -75.6, 39.0)).list_naips(),
+                         ['38075/m_3807503_ne_18_1_20130907.tif'])
+        self.assertEqual(len(self.client.listings), 1)
+
+    def test_lists_again_when_stale(self):
+        self.downloader().list_naips()
+        listing_path = self.downloader().listing_path
+        old = time.time() - 120
+        os.utime(listing_path, (old, old))
+        self.downloader().list_naips()
+        self.assertEqual(len(self.client.listings), 2)
+
+    def test_failed_listing_not_saved(self):
+        self.client.fail_at = 2
+        self.assertRaises(IOError, self.downloader().list_naips)
+        self.assertEqual(os.listdir(self.listing_dir), [])
+
+    def test_cached_keys_unfinished(self):
+        listing_path = os.path.join(self.listing_dir, 'keys.txt')
+        keys = cached_keys(listing_path, 60, lambda: iter(['a', 'b']))
+        self.assertEqual(next(keys), 'a')
+        keys.close()
+        self.assertEqual(os.listdir(self.listing_dir), [])
+        self.assertEqual(list(cached_keys(listing_path, 60, lambda: iter(['a', 'b']))), ['a', 'b'])
+        self.assertEqual(list(cached_keys(listing_path, 60, lambda: iter([]))), ['a', 'b'])
+
+
+if __name__ == "__main__":
+    unittest.main()
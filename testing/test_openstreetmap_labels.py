@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import unittest
+from array import array
+
+import numpy
+
+from src.openstreetmap_labels import MultiWayExtracter, WayExtracter, WayMap, \
+    extract_all_types, extraction_cache_dir, extraction_cache_key, match_extract_type, \
+    prune_extractions, way_in_extents, way_lon_lats
+
+
+class Location:
+
+    def __init__(self, lon=None, lat=None):
+        self.lon, self.lat = lon, lat
+
+    def valid(self):
+        return self.lon is not None
+
+
+class Node:
+
+    def __init__(self, lon=None, lat=None, ref=0):
+        self.location = Location(lon, lat)
+        self.ref = ref
+
+
+class Tag:
+
+    def __init__(self, k, v):
+        self.k, self.v = k, v
+
+
+class Way:
+
+    def __init__(self, way_id, nodes, tags):
+        self.id = way_id
+        self.nodes = [Node(*node, ref=way_id * 100 + i) for i, node in enumerate(nodes)]
+        self.tags = [Tag(*tag) for tag in tags]
+        self.uid = 0
+        self.visible = True
+        self.deleted = False
+
+    def ends_have_same_id(self):
+        return False
+
+
+class TestWayExtracter(unittest.TestCase):
+
+    def test_way_lon_lats(self):
+        coords, node_ids = array('d', [9.0]), array('l', [9])
+        self.assertTrue(way_lon_lats(Way(1, [(1.0, 2.0), (1.0, 2.0), (3.0, 4.0)], []), coords,
+                                     node_ids))
+        self.assertEqual(list(coords), [1.0, 2.0, 3.0, 4.0])
+        self.assertEqual(list(node_ids), [100, 102])
+        self.assertFalse(way_lon_lats(Way(2, [(1.0, 2.0), ()], []), coords))
+
+    def test_extracts_lines_only(self):
+        extracter = WayExtracter('highway')
+        extracter.way(Way(1, [(1.0, 2.0), (3.0, 4.0)], [('highway', 'primary')]))
+        extracter.way(Way(2, [(1.0, 2.0)], [('highway', 'primary')]))
+        extracter.way(Way(3, [(1.0, 2.0), (1.0, 2.0)], [('highway', 'service')]))
+        extracter.way(Way(4, [(1.0, 2.0), ()], [('highway', 'service')]))
+        extracter.way(Way(5, [(1.0, 2.0), (5.0, 6.0)], [('building', 'yes')]))
+        extracter.way(Way(6, [(5.0, 6.0), (7.0, 8.0)],
+                          [('highway', 'service'), ('motor_vehicle', 'no')]))
+        self.assertEqual(list(extracter.ways), [{'id': 1, 'way_type': 'primary',
+                                                 'linestring': [(1.0, 2.0), (3.0, 4.0)],
+                                                 'tags': [('highway', 'primary')]}])
+
+    def test_way_in_extents(self):
+        extents = numpy.array([(0, 0, 1, 1), (5, 5, 6, 6)], dtype=numpy.float64)
+        self.assertTrue(way_in_extents(array('d', [0.5, 0.5, 2.0, 2.0]), extents))
+        # crosses an extent with no node in it
+        self.assertTrue(way_in_extents(array('d', [4.0, 5.5, 7.0, 5.5]), extents))
+        self.assertFalse(way_in_extents(array('d', [2.0, 2.0, 3.0, 3.0]), extents))
+
+    def test_extracts_ways_in_extents(self):
+        extracter = WayExtracter('highway', extents=[(0, 0, 1, 1)])
+        extracter.way(Way(1, [(0.5, 0.5), (3.0, 4.0)], [('highway', 'primary')]))
+        extracter.way(Way(2, [(2.0, 2.0), (3.0, 4.0)], [('highway', 'primary')]))
+        self.assertEqual([way['id'] for way in extracter.ways], [1])
+
+    def test_match_extract_type(self):
+        tags = [('highway', 'service'), ('motor_vehicle', 'no'), ('sport', 'tennis')]
+        self.assertEqual(match_extract_type('highway', tags), (False, None))
+        self.assertEqual(match_extract_type('footway', [('footway', 'sidewalk')] + tags),
+                         (True, 'sidewalk'))
+        self.assertEqual(match_extract_type('tennis', tags), (True, None))
+        self.assertEqual(match_extract_type('cycleway', tags), (False, None))
+
+    def test_multi_way_extracter(self):
+        extracter = MultiWayExtracter(['highway', 'footway', 'tennis'])
+        extracter.way(Way(1, [(1.0, 2.0), (3.0, 4.0)],
+                          [('highway', 'footway'), ('footway', 'sidewalk')]))
+        extracter.way(Way(2, [(1.0, 2.0), (3.0, 4.0)],
+                          [('highway', 'service'), ('motor_vehicle', 'no'), ('sport', 'tennis')]))
+        extracter.way(Way(3, [(1.0, 2.0)], [('highway', 'primary')]))
+        ways = extracter.ways
+        self.assertEqual([(way['id'], way['way_type']) for way in ways['highway']],
+                         [(1, 'footway')])
+        self.assertEqual([(way['id'], way['way_type']) for way in ways['footway']],
+                         [(1, 'sidewalk')])
+        self.assertEqual([(way['id'], way['way_type']) for way in ways['tennis']], [(2, None)])
+
+
+class TestExtractionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.pbf_path = os.path.join(self.tempdir, 'test.osm.pbf')
+        with open(self.pbf_path, 'wb') as outfile:
+            outfile.write(b'not really a pbf')
+        self.parsed = []
+
+        def apply_file(extracter, file_path, locations=False):
+            self.parsed.append(file_path)
+            extracter.way(Way(1, [(0.5, 0.5), (3.0, 4.0)], [('highway', 'primary')]))
+            extracter.way(Way(2, [(2.0, 2.0), (3.0, 4.0)], [('highway', 'service')]))
+
+        self.apply_file = getattr(WayExtracter, 'apply_file', None)
+        WayExtracter.apply_file = apply_file
+
+    def tearDown(self):
+        if self.apply_file is None:
+            del WayExtracter.apply_file
+        else:
+            WayExtracter.apply_file = self.apply_file
+        shutil.rmtree(self.tempdir)
+
+    def test_extracts_once(self):
+        first = WayMap('highway')
+        first.extract_files([self.pbf_path])
+        second = WayMap('highway')
+        second.extract_files([self.pbf_path])
+        self.assertEqual(len(self.parsed), 1)
+        self.assertTrue(isinstance(second.ways.coords, numpy.memmap))
+        self.assertEqual(list(second.ways), list(first.ways))
+
+    def test_keyed_by_filter(self):
+        WayMap('highway').extract_files([self.pbf_path])
+        filtered = WayMap('highway', extents=[(0, 0, 1, 1)])
+        filtered.extract_files([self.pbf_path])
+        self.assertEqual(len(self.parsed), 2)
+        self.assertEqual([way['id'] for way in filtered.ways], [1])
+        WayMap('highway', use_cache=False).extract_files([self.pbf_path])
+        self.assertEqual(len(self.parsed), 3)
+
+    def test_prunes_stale_extractions(self):
+        WayMap('highway').extract_files([self.pbf_path])
+        with open(self.pbf_path, 'wb') as outfile:
+            outfile.write(b'a newer pbf')
+        WayMap('highway').extract_files([self.pbf_path])
+        self.assertEqual(len(self.parsed), 2)
+        self.assertEqual(os.listdir(self.pbf_path + '.ways'),
+                         [os.path.basename(extraction_cache_dir(self.pbf_path, 'highway'))])
+
+    def test_keeps_recent_extractions(self):
+        cache_dirs = []
+        for i in range(4):
+            extents = [(0, 0, i + 1, i + 1)]
+            WayMap('highway', extents=extents).extract_files([self.pbf_path])
+            cache_dirs.append(extraction_cache_dir(self.pbf_path, 'highway', extents))
+            os.utime(cache_dirs[-1], (1000 + i, 1000 + i))
+        os.utime(cache_dirs[0], (2000, 2000))
+        prune_extractions(self.pbf_path + '.ways', extraction_cache_key(self.pbf_path, 'highway'),
+                          keep=cache_dirs[1], max_count=3)
+        self.assertEqual(sorted(os.listdir(self.pbf_path + '.ways')),
+                         sorted(os.path.basename(path) for path in cache_dirs[:2] + cache_dirs[3:]))
+
+    def test_extract_all_types_fills_cache(self):
+        extracted = extract_all_types(self.pbf_path, ['highway', 'tennis'])
+        self.assertEqual(len(self.parsed), 1)
+        self.assertEqual(len(extracted['highway']), 2)
+        waymap = WayMap('highway')
+        waymap.extract_files([self.pbf_path])
+        self.assertEqual(len(self.parsed), 1)
+        self.assertEqual(list(waymap.ways), list(extracted['highway']))
+        extract_all_types(self.pbf_path, ['highway', 'tennis'])
+        self.assertEqual(len(self.parsed), 1)
+
+    def test_also_extract(self):
+        waymap = WayMap('highway', also_extract=['highway', 'tennis'])
+        waymap.extract_files([self.pbf_path])
+        self.assertEqual([way['id'] for way in waymap.ways], [1, 2])
+        tennis = WayMap('tennis')
+        tennis.extract_files([self.pbf_path])
+        self.assertEqual(len(self.parsed), 1)
+        self.assertTrue(isinstance(tennis.ways.coords, numpy.memmap))
+        self.assertEqual(len(tennis.ways), 0)
+
+    def test_merges_files(self):
+        other_path = os.path.join(self.tempdir, 'other.osm.pbf')
+        shutil.copy(self.pbf_path, other_path)
+        waymap = WayMap('highway')
+        waymap.extract_files([self.pbf_path, other_path])
+        self.assertEqual([way['id'] for way in waymap.ways], [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
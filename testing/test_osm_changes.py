@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+import unittest
+
+from src.osm_changes import apply_changes, extracted_node_locations, line_points
+from src.ways import Ways
+
+
+class TestApplyChanges(unittest.TestCase):
+
+    def setUp(self):
+        self.ways = Ways()
+        self.ways.append(1, 'primary', [(0.0, 0.0), (1.0, 0.0)], [('highway', 'primary')],
+                         [10, 11])
+        self.ways.append(2, 'service', [(1.0, 0.0), (1.0, 1.0)], [('highway', 'service')],
+                         [11, 12])
+        self.ways.append(3, 'service', [(5.0, 5.0), (6.0, 5.0)], [('highway', 'service')],
+                         [13, 14])
+
+    def apply(self, nodes, changed_ways, **kwargs):
+        updated, touched = apply_changes(self.ways, nodes, changed_ways, 'highway', **kwargs)
+        return dict((way['id'], way) for way in updated), sorted(way['id'] for way in touched)
+
+    def test_no_changes(self):
+        updated, touched = self.apply({}, {})
+        self.assertEqual(sorted(updated.values()), sorted(self.ways))
+        self.assertEqual(touched, [])
+
+    def test_moved_node(self):
+        # node 11 moves, node 13 is only retagged
+        updated, touched = self.apply({11: (1.0, -1.0), 13: (5.0, 5.0)}, {})
+        self.assertEqual(updated[1]['linestring'], [(0.0, 0.0), (1.0, -1.0)])
+        self.assertEqual(updated[2]['linestring'], [(1.0, -1.0), (1.0, 1.0)])
+        self.assertEqual(updated[2]['tags'], [('highway', 'service')])
+        self.assertEqual(updated[3], self.ways[2])
+        self.assertEqual(touched, [1, 1, 2, 2])
+
+    def test_edited_ways(self):
+        updated, touched = self.apply({20: (9.0, 9.0)}, {
+            1: None,
+            # now a footway, and not a highway
+            2: ([('footway', 'sidewalk')], [11, 12]),
+            3: ([('highway', 'primary')], [13, 14, 20]),
+            4: ([('highway', 'residential')], [12, 20]),
+            # its node can't be found
+            5: ([('highway', 'residential')], [12, 99])})
+        self.assertEqual(sorted(updated), [3, 4])
+        self.assertEqual(updated[3]['way_type'], 'primary')
+        self.assertEqual(updated[3]['linestring'], [(5.0, 5.0), (6.0, 5.0), (9.0, 9.0)])
+        self.assertEqual(updated[4]['linestring'], [(1.0, 1.0), (9.0, 9.0)])
+        self.assertEqual(touched, [1, 2, 3, 3, 4])
+
+    def test_extents(self):
+        updated, touched = self.apply({14: (60.0, 5.0)}, {}, extents=[(0, 0, 2, 2)])
+        self.assertEqual(sorted(updated), [1, 2])
+        self.assertEqual(touched, [3])
+
+    def test_extracted_node_locations(self):
+        self.assertEqual(extracted_node_locations(self.ways, [11, 14, 99]),
+                         {11: (1.0, 0.0), 14: (6.0, 5.0)})
+        self.assertEqual(extracted_node_locations(Ways(), [11]), {})
+
+    def test_line_points(self):
+        locations = {1: (0.0, 0.0), 2: (0.0, 0.0), 3: (1.0, 1.0)}
+        self.assertEqual(line_points([1, 2, 3], locations), ([0.0, 0.0, 1.0, 1.0], [1, 3]))
+        self.assertEqual(line_points([1, 4], locations), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+import unittest
+
+import numpy
+
+from src.rasterize import distance_transform, rasterize_segments
+
+
+class TestRasterizeSegments(unittest.TestCase):
+
+    def test_draws_lines(self):
+        bitmap = numpy.zeros((10, 10), dtype=numpy.uint8)
+        rasterize_segments(bitmap, [1, 2, 0], [1, 0, 9], [8, 2, 9], [1, 5, 0])
+        self.assertTrue(bitmap[1, 1:9].all())
+        self.assertTrue(bitmap[0:6, 2].all())
+        self.assertTrue(all(bitmap[9 - i, i] for i in range(10)))
+        self.assertEqual(bitmap.sum(), 8 + 6 + 10 - 2)
+
+    def test_fattens_and_skips_border(self):
+        bitmap = numpy.zeros((20, 20), dtype=numpy.uint8)
+        rasterize_segments(bitmap, [0, 10], [10, 0], [19, 10], [10, 19],
+                           pixels_to_fatten_roads=2, border=3)
+        expected = numpy.zeros((20, 20), dtype=numpy.uint8)
+        expected[8:13, :] = 1
+        expected[:, 8:13] = 1
+        expected[:3, :] = expected[-3:, :] = expected[:, :3] = expected[:, -3:] = 0
+        numpy.testing.assert_array_equal(bitmap, expected)
+
+    def test_vertical_segments_fatten_sideways(self):
+        bitmap = numpy.zeros((10, 10), dtype=numpy.uint8)
+        rasterize_segments(bitmap, [5], [3], [5], [6], pixels_to_fatten_roads=1)
+        self.assertEqual(bitmap.sum(), 12)
+        self.assertTrue(bitmap[3:7, 4:7].all())
+
+    def test_no_segments(self):
+        bitmap = numpy.zeros((10, 10), dtype=numpy.uint8)
+        rasterize_segments(bitmap, [], [], [], [], pixels_to_fatten_roads=3)
+        self.assertFalse(bitmap.any())
+
+
+class TestDistanceTransform(unittest.TestCase):
+
+    def test_matches_brute_force(self):
+        bitmap = numpy.random.RandomState(0).rand(70, 90) > 0.995
+        distances = distance_transform(bitmap, 8)
+        self.assertEqual(distances.dtype, numpy.uint8)
+        rows, cols = numpy.indices(bitmap.shape)
+        way_rows, way_cols = numpy.nonzero(bitmap)
+        squared = ((rows[..., None] - way_rows) ** 2 + (cols[..., None] - way_cols) ** 2).min(-1)
+        expected = numpy.minimum(numpy.ceil(numpy.sqrt(squared)), 8)
+        numpy.testing.assert_array_equal(distances, expected)
+
+    def test_thresholds_to_fattened_lines(self):
+        bitmap = numpy.zeros((20, 20), dtype=numpy.uint8)
+        bitmap[10, :] = 1
+        distances = distance_transform(bitmap)
+        numpy.testing.assert_array_equal(distances[:, 5], numpy.abs(numpy.arange(20) - 10))
+        self.assertEqual((distances <= 3).sum(), 7 * 20)
+        self.assertFalse((distance_transform(numpy.zeros((5, 5))) < 32).any())
+
+
+if __name__ == "__main__":
+    unittest.main()
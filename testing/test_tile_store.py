@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from src.label_rasters import LABEL_BITMAP, LABEL_DISTANCE
+from src.rasterize import distance_transform, rasterize_segments
+from src.tile_store import TILE_AMBIGUOUS, TILE_OFF, TILE_ON, BalancedSampler, TileStoreWriter, \
+    TrainingDataset, indexed_shards, load_shard, load_tile_index
+
+
+class TestTileStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def make_tiles(self, count, seed):
+        images = numpy.random.RandomState(seed).randint(0, 256, size=(count, 8, 8, 3))
+        labels = numpy.random.RandomState(seed).randint(0, 2, size=(count, 8, 8))
+        origins = [(300 + i * 8, 300) for i in range(count)]
+        return zip(images.astype(numpy.uint8), labels.astype(numpy.uint8), origins)
+
+    def test_round_trip(self):
+        naips = {'a.tif': list(self.make_tiles(5, 0)), 'b.tif': list(self.make_tiles(7, 1))}
+        writer = TileStoreWriter(self.store_dir, 8, 3, tiles_per_shard=3)
+        for naip_path in sorted(naips):
+            writer.add_naip(naip_path, len(naips[naip_path]), naips[naip_path])
+        self.assertEqual(writer.close(), 12)
+
+        index = load_tile_index(self.store_dir)
+        self.assertEqual(index['naip_paths'], ['a.tif', 'b.tif'])
+        self.assertEqual(len(index['shards']), 5)
+
+        position = 0
+        for naip_number, naip_path in enumerate(index['naip_paths']):
+            for image, label, (col, row) in naips[naip_path]:
+                entry = index['tiles'][position]
+                images, labels = load_shard(self.store_dir, index['shards'][entry['shard']])
+                self.assertTrue(isinstance(images, numpy.memmap))
+                numpy.testing.assert_array_equal(images[entry['offset']], image)
+                numpy.testing.assert_array_equal(labels[entry['offset']], label)
+                self.assertEqual((entry['naip'], entry['col'], entry['row']),
+                                 (naip_number, col, row))
+                position += 1
+
+    def test_indexed_shards(self):
+        naips = {'a.tif': list(self.make_tiles(5, 0)), 'b.tif': list(self.make_tiles(7, 1))}
+        writer = TileStoreWriter(self.store_dir, 8, 3, tiles_per_shard=3)
+        for naip_path in sorted(naips):
+            writer.add_naip(naip_path, len(naips[naip_path]), naips[naip_path])
+        writer.close()
+        index = load_tile_index(self.store_dir)
+
+        # index the shards again, with b.tif first
+        writer = TileStoreWriter(self.store_dir, 8, 3)
+        writer.add_shards('b.tif', indexed_shards(index, 1))
+        writer.add_shards('a.tif', indexed_shards(index, 0))
+        writer.close()
+        reindexed = load_tile_index(self.store_dir)
+        self.assertEqual(reindexed['shards'], index['shards'][2:] + index['shards'][:2])
+        for field in ('offset', 'col', 'row', 'road_pixels', 'center_distance'):
+            numpy.testing.assert_array_equal(
+                reindexed['tiles'][field],
+                numpy.concatenate((index['tiles'][field][5:], index['tiles'][field][:5])))
+        self.assertEqual(list(reindexed['tiles']['naip']), [0] * 7 + [1] * 5)
+
+    def test_training_dataset_take(self):
+        tiles = list(self.make_tiles(5, 0)) + list(self.make_tiles(7, 1))
+        writer = TileStoreWriter(self.store_dir, 8, 3, tiles_per_shard=4)
+        writer.add_naip('a.tif', 5, tiles[:5])
+        writer.add_naip('b.tif', 7, tiles[5:])
+        writer.close()
+
+        dataset = TrainingDataset(self.store_dir)
+        self.assertEqual(len(dataset), 12)
+        image, label = dataset[6]
+        numpy.testing.assert_array_equal(image, tiles[6][0])
+        self.assertEqual(dataset.origin(6), (tiles[6][2], 'b.tif'))
+
+        indices = [11, 0, 6, 6, 3]
+        images, labels = dataset.take(indices)
+        self.assertEqual(images.shape, (5, 8, 8, 3))
+        self.assertTrue(images.flags['C_CONTIGUOUS'])
+        for i, tile_id in enumerate(indices):
+            numpy.testing.assert_array_equal(images[i], tiles[tile_id][0])
+            numpy.testing.assert_array_equal(labels[i], tiles[tile_id][1])
+
+    def test_label_summaries(self):
+        labels = numpy.zeros((3, 8, 8), dtype=numpy.uint8)
+        labels[0, 4, 4] = 1
+        labels[1, 0, 0] = 1
+        images = numpy.zeros((3, 8, 8, 3), dtype=numpy.uint8)
+        writer = TileStoreWriter(self.store_dir, 8, 3)
+        writer.add_naip('a.tif', 3, zip(images, labels, [(0, 0)] * 3))
+        writer.close()
+
+        dataset = TrainingDataset(self.store_dir)
+        numpy.testing.assert_array_equal(dataset.tiles['road_pixels'], [1, 1, 0])
+        numpy.testing.assert_array_equal(dataset.tiles['center_distance'][:2], [1, 4])
+        numpy.testing.assert_array_equal(dataset.tile_classes(),
+                                         [TILE_ON, TILE_AMBIGUOUS, TILE_OFF])
+        numpy.testing.assert_array_equal(dataset.tile_classes(1, 3), [TILE_ON, TILE_OFF, TILE_OFF])
+        self.assertEqual(list(dataset.class_ids(TILE_ON)), [0])
+        tile_ids = dataset.random_class_ids(4, 2)
+        self.assertEqual(sorted(tile_ids), [0, 0, 0, 0, 2, 2])
+
+    def test_distance_label_summaries(self):
+        bitmap = numpy.zeros((3, 8, 8), dtype=numpy.uint8)
+        bitmap[0, 4, 4] = 1
+        bitmap[1, 0, 0] = 1
+        labels = numpy.array([distance_transform(tile) for tile in bitmap])
+        images = numpy.zeros((3, 8, 8, 3), dtype=numpy.uint8)
+        writer = TileStoreWriter(self.store_dir, 8, 3, label_format=LABEL_DISTANCE)
+        writer.add_naip('a.tif', 3, zip(images, labels, [(0, 0)] * 3))
+        writer.close()
+
+        dataset = TrainingDataset(self.store_dir)
+        self.assertEqual(dataset.label_format, LABEL_DISTANCE)
+        numpy.testing.assert_array_equal(dataset.tiles['road_pixels'], [1, 1, 0])
+        numpy.testing.assert_array_equal(dataset.tile_classes(),
+                                         [TILE_ON, TILE_AMBIGUOUS, TILE_OFF])
+        _, stored = dataset.take([0])
+        numpy.testing.assert_array_equal(dataset.label_masks(stored)[0], bitmap[0])
+        self.assertEqual(dataset.label_masks(stored, 1).sum(), 5)
+
+    def test_distance_and_bitmap_classes_match(self):
+        # roads across each tile, further and further from the center, drawn as a fattened
+        # bitmap, and as distances to the unfattened road, as way_bitmap_for_naip draws them
+        roads = [(0, row, 63, row) for row in (32, 34, 35, 36, 40, 48, 52, 60)]
+        roads += [(col, 0, col, 63) for col in (30, 27, 26, 12)]
+        bitmaps = numpy.zeros((len(roads) + 1, 64, 64), dtype=numpy.uint8)
+        distances = numpy.zeros((len(roads) + 1, 64, 64), dtype=numpy.uint8)
+        for bitmap, distance, road in zip(bitmaps, distances, roads):
+            rasterize_segments(bitmap, *road, pixels_to_fatten_roads=3)
+            distance[...] = distance_transform(rasterize_segments(numpy.zeros((64, 64)), *road))
+        distances[-1] = distance_transform(bitmaps[-1])
+        images = numpy.zeros((len(bitmaps), 64, 64, 3), dtype=numpy.uint8)
+        tile_classes = []
+        for label_format, labels in [(LABEL_BITMAP, bitmaps), (LABEL_DISTANCE, distances)]:
+            store_dir = tempfile.mkdtemp(dir=self.store_dir)
+            writer = TileStoreWriter(store_dir, 64, 3, label_format=label_format,
+                                     pixels_to_fatten_roads=3)
+            writer.add_naip('a.tif', len(labels), zip(images, labels, [(0, 0)] * len(labels)))
+            writer.close()
+            tile_classes.append(TrainingDataset(store_dir).tile_classes())
+        numpy.testing.assert_array_equal(tile_classes[1], tile_classes[0])
+        self.assertEqual(sorted(set(tile_classes[0])), [TILE_OFF, TILE_ON, TILE_AMBIGUOUS])
+
+    def test_balanced_sampler(self):
+        labels = numpy.zeros((40, 8, 8), dtype=numpy.uint8)
+        labels[:10, 4, 4] = 1
+        labels[10:15, 1, 1] = 1
+        images = numpy.zeros((40, 8, 8, 3), dtype=numpy.uint8)
+        writer = TileStoreWriter(self.store_dir, 8, 3)
+        writer.add_naip('a.tif', 40, zip(images, labels, [(0, 0)] * 40))
+        writer.close()
+        dataset = TrainingDataset(self.store_dir)
+
+        sampler = BalancedSampler(dataset, 4, random_state=numpy.random.RandomState(0))
+        self.assertEqual(len(sampler), 5)
+        epoch = list(sampler.epoch())
+        self.assertEqual(len(epoch), 5)
+        tile_ids = numpy.concatenate(epoch)
+        self.assertEqual(len(set(tile_ids)), 20)
+        for batch in epoch:
+            self.assertEqual(sum(tile_id < 10 for tile_id in batch), 2)
+        self.assertFalse(set(tile_ids) & set(range(10, 15)))
+
+        sampler = BalancedSampler(dataset, 4, on_off_ratio=1 / 3.0)
+        self.assertEqual(len(sampler), 8)
+        self.assertEqual(sum(tile_id < 10 for tile_id in next(sampler.batches())), 1)
+        self.assertRaises(ValueError, BalancedSampler, dataset, 40)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+import filecmp
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from src.label_rasters import center_distances
+from src.tile_store import load_tile_index
+import src.training_data as training_data
+from src.training_data import NAIP_PIXEL_BUFFER, create_tiled_training_data, \
+    has_ways_in_center, has_ways_in_center_batch, iter_naip_tiles, naip_buffer, \
+    naip_window_buffer, naip_windows, read_naip_window, take_tiles, tile_grid, tile_naip, \
+    tile_view
+from src.ways import Ways
+
+
+class Band:
+
+    def __init__(self, band_data, block_size):
+        self.band_data = band_data
+        self.block_size = block_size
+
+    def ReadAsArray(self, xoff, yoff, win_xsize, win_ysize, buf_obj=None):
+        window = self.band_data[yoff:yoff + win_ysize, xoff:xoff + win_xsize]
+        if buf_obj is None:
+            return window.copy()
+        assert buf_obj.shape == window.shape
+        buf_obj[...] = window
+        return buf_obj
+
+    def GetBlockSize(self):
+        return self.block_size
+
+
+class Dataset:
+    """A NAIP in memory, with only the band reads of the GDAL bindings in the Docker image."""
+
+    def __init__(self, bands_data, block_size=(1000, 1)):
+        self.bands_data = bands_data
+        self.block_size = block_size
+        self.RasterYSize, self.RasterXSize, self.RasterCount = bands_data.shape
+        self.reads = []
+
+    def GetRasterBand(self, band_number):
+        self.reads.append(band_number)
+        return Band(self.bands_data[:, :, band_number - 1], self.block_size)
+
+    def GetProjection(self):
+        return ''
+
+
+class TestReadNAIPWindow(unittest.TestCase):
+
+    def setUp(self):
+        self.bands_data = numpy.random.randint(0, 256, size=(90, 100, 4)).astype(numpy.uint8)
+        self.dataset = Dataset(self.bands_data)
+
+    def test_reads_selected_bands(self):
+        window = read_naip_window(self.dataset, [1, 0, 1, 1], 10, 20, 30, 40)
+        self.assertEqual(window.shape, (40, 30, 3))
+        numpy.testing.assert_array_equal(window, self.bands_data[20:60, 10:40, [0, 2, 3]])
+        self.assertEqual(self.dataset.reads, [1, 3, 4])
+
+    def test_reads_into_buffer(self):
+        buf = naip_buffer(50, 50, 4)
+        window = read_naip_window(self.dataset, [0, 0, 0, 1], 5, 5, 10, 10, buf)
+        self.assertTrue(numpy.may_share_memory(window, buf))
+        numpy.testing.assert_array_equal(window[:, :, 0], self.bands_data[5:15, 5:15, 3])
+
+
+class TestTileView(unittest.TestCase):
+
+    def setUp(self):
+        self.bands_data = numpy.random.randint(0, 256, size=(900, 1000, 3)).astype(numpy.uint8)
+
+    def test_tile_grid_stays_inside_buffer(self):
+        tile_rows, tile_cols = tile_grid(900, 1000, 64, 2)
+        self.assertEqual(tile_rows[0], NAIP_PIXEL_BUFFER)
+        self.assertEqual(tile_cols[0], NAIP_PIXEL_BUFFER)
+        self.assertTrue(tile_rows[-1] + 64 < 900 - NAIP_PIXEL_BUFFER)
+        self.assertTrue(tile_cols[-1] + 64 < 1000 - NAIP_PIXEL_BUFFER)
+
+    def test_tile_view_shares_memory(self):
+        tiles, origins = tile_view(self.bands_data, 64, 1)
+        self.assertTrue(numpy.may_share_memory(tiles, self.bands_data))
+        self.assertEqual(tiles.shape[2:], (64, 64, 3))
+        self.assertEqual(origins.dtype, numpy.int32)
+        self.assertEqual(len(origins), tiles.shape[0] * tiles.shape[1])
+
+    def test_take_tiles_matches_slices(self):
+        for tile_overlap in [1, 2, 3]:
+            tiles, origins = tile_view(self.bands_data, 64, tile_overlap)
+            indices = numpy.arange(len(origins))[::-1]
+            batch = take_tiles(tiles, indices)
+            for tile, (col, row) in zip(batch, origins[indices]):
+                numpy.testing.assert_array_equal(
+                    tile, self.bands_data[row:row + 64, col:col + 64])
+
+    def test_tile_view_of_label_bitmap(self):
+        tiles, origins = tile_view(self.bands_data[:, :, 0], 64, 1)
+        self.assertEqual(tiles.shape[2:], (64, 64))
+
+
+class TestNAIPWindows(unittest.TestCase):
+
+    def setUp(self):
+        self.bands_data = numpy.random.randint(0, 256, size=(900, 1000, 4)).astype(numpy.uint8)
+        self.bounds_for_naip = training_data.bounds_for_naip
+        training_data.bounds_for_naip = lambda raster_dataset, rows, cols: {}
+
+    def tearDown(self):
+        training_data.bounds_for_naip = self.bounds_for_naip
+
+    def test_windowed_tiles_match_full_read(self):
+        bands_to_use = [1, 1, 0, 1]
+        selected = self.bands_data[:, :, [0, 1, 3]]
+        for tile_overlap in [1, 2, 3]:
+            tiles, origins = tile_view(selected, 64, tile_overlap)
+            windowed = list(iter_naip_tiles(Dataset(self.bands_data, (1000, 100)), bands_to_use,
+                                            64, tile_overlap))
+            self.assertEqual([origin for _, origin in windowed],
+                             [tuple(origin) for origin in origins.tolist()])
+            for (tile, _), full_tile in zip(windowed, take_tiles(tiles, range(len(origins)))):
+                numpy.testing.assert_array_equal(tile, full_tile)
+            # tile_naip streams the same tiles, without the NAIP in memory
+            streamed = tile_naip('naip.tif', Dataset(self.bands_data), None, bands_to_use, 64,
+                                 tile_overlap)
+            self.assertEqual(len(streamed), len(origins))
+            for (tile, origin, path), (full_tile, (col, row)) in zip(streamed, windowed):
+                self.assertEqual((origin, path), ((col, row), 'naip.tif'))
+                numpy.testing.assert_array_equal(tile, full_tile)
+
+    def test_windows_cover_block_rows(self):
+        tile_rows, tile_cols = tile_grid(900, 1000, 64, 1)
+        self.assertEqual(tile_rows, [300, 364, 428, 492])
+        # three tile rows cover a 192 pixel block, and the last window is what's left
+        cols, windows = naip_windows(Dataset(self.bands_data, (1000, 192)), 64, 1)
+        self.assertEqual(cols, tile_cols)
+        self.assertEqual(windows, [[300, 364, 428], [492]])
+        _, windows = naip_windows(Dataset(self.bands_data, (1000, 1)), 64, 2)
+        self.assertEqual(windows, [[row] for row in tile_grid(900, 1000, 64, 2)[0]])
+
+    def test_raster_smaller_than_a_tile(self):
+        dataset = Dataset(self.bands_data[:NAIP_PIXEL_BUFFER * 2 + 64])
+        self.assertEqual(naip_windows(dataset, 64, 1)[1], [])
+        self.assertEqual(list(iter_naip_tiles(dataset, [1, 1, 1, 1], 64, 1)), [])
+        buf = naip_buffer(10, 10, 4)
+        self.assertTrue(naip_window_buffer(dataset, [1, 1, 1, 1], 64, 1, buf) is buf)
+
+    def test_windows_reuse_buffer(self):
+        dataset = Dataset(self.bands_data, (1000, 128))
+        buf = naip_window_buffer(dataset, [0, 1, 1, 1], 64, 1)
+        self.assertEqual(buf.shape[2], 3)
+        count = 0
+        for tile, (col, row) in iter_naip_tiles(dataset, [0, 1, 1, 1], 64, 1, buf):
+            self.assertTrue(numpy.may_share_memory(tile, buf))
+            numpy.testing.assert_array_equal(tile, self.bands_data[row:row + 64, col:col + 64, 1:])
+            count += 1
+        self.assertEqual(count, 4 * 6)
+        # a buffer from a smaller NAIP is replaced, and a big enough one kept
+        self.assertFalse(naip_window_buffer(dataset, [1, 1, 1, 1], 64, 1, buf) is buf)
+        self.assertTrue(naip_window_buffer(dataset, [0, 0, 1, 1], 64, 1, buf).base is buf.base)
+
+
+# the NAIPs FakeGDAL opens, by path
+naips = {}
+
+
+class FakeGDAL:
+    GA_ReadOnly = 0
+
+    @staticmethod
+    def Open(path, access):
+        return Dataset(naips[path], (1000, 128))
+
+
+class FakeWayMap:
+
+    def __init__(self, extract_type, extents=None, also_extract=()):
+        self.ways = Ways()
+
+    def extract_files(self, file_list, workers=1):
+        pass
+
+
+def fake_way_bitmap(ways, raster_data_path, raster_dataset, rows, cols, params):
+    return (naips[raster_data_path][:, :, 0] > 200).astype(numpy.uint8)
+
+
+class TestCreateTiledTrainingData(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for naip_number in range(5):
+            random_state = numpy.random.RandomState(naip_number)
+            naips['{}.tif'.format(naip_number)] = random_state.randint(
+                0, 256, size=(900 + 10 * naip_number, 1000, 4)).astype(numpy.uint8)
+        self.patched = {'gdal': FakeGDAL, 'WayMap': FakeWayMap,
+                        'download_files': lambda label_data_files: [],
+                        'bounds_for_naip': lambda raster_dataset, rows, cols: {
+                            'sw': (0.0, 0.0), 'ne': (1.0, 1.0)},
+                        'way_bitmap_for_naip': fake_way_bitmap}
+        self.originals = dict((name, getattr(training_data, name)) for name in
+                              list(self.patched) + ['TILE_STORE_DIR', 'METADATA_FILE'])
+        for name, value in self.patched.items():
+            setattr(training_data, name, value)
+
+    def tearDown(self):
+        for name, value in self.originals.items():
+            setattr(training_data, name, value)
+        naips.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def create(self, workers):
+        store_dir = os.path.join(self.tmp_dir, 'tiles-{}'.format(workers))
+        os.mkdir(store_dir)
+        training_data.TILE_STORE_DIR = store_dir
+        training_data.METADATA_FILE = os.path.join(self.tmp_dir, 'metadata-{}'.format(workers))
+        create_tiled_training_data(sorted(naips), 'highway', [1, 1, 0, 1], 64, 3, [], 2, 'de',
+                                   workers)
+        return store_dir
+
+    def test_parallel_matches_serial(self):
+        serial_dir = self.create(1)
+        parallel_dir = self.create(3)
+        self.assertEqual(sorted(os.listdir(serial_dir)), sorted(os.listdir(parallel_dir)))
+        for filename in os.listdir(serial_dir):
+            if filename.endswith('.npy'):
+                self.assertTrue(filecmp.cmp(os.path.join(serial_dir, filename),
+                                            os.path.join(parallel_dir, filename), shallow=False))
+        serial, parallel = load_tile_index(serial_dir), load_tile_index(parallel_dir)
+        self.assertEqual(serial['naip_paths'], sorted(naips))
+        self.assertEqual(parallel['naip_paths'], serial['naip_paths'])
+        self.assertEqual(parallel['shards'], serial['shards'])
+        self.assertTrue(len(serial['tiles']) > 0)
+        numpy.testing.assert_array_equal(parallel['tiles'], serial['tiles'])
+
+
+class TestCenterDistances(unittest.TestCase):
+
+    def setUp(self):
+        self.labels = numpy.zeros((200, 64, 64), dtype=numpy.uint8)
+        random_state = numpy.random.RandomState(0)
+        for label in self.labels[1:]:
+            row, col = random_state.randint(0, 64, size=2)
+            label[row, col:col + 3] = 1
+
+    def test_matches_has_ways_in_center(self):
+        labels = self.labels
+        distances = center_distances(labels)
+        for label, distance in zip(labels, distances):
+            for tolerance in [1, 2, 16, 31]:
+                self.assertEqual(has_ways_in_center(label, tolerance), distance <= tolerance)
+
+    def test_batch_matches_has_ways_in_center(self):
+        on = has_ways_in_center_batch(self.labels, 1)
+        self.assertEqual(on.shape, (200,))
+        ways_in_center = has_ways_in_center_batch(self.labels, [1, 16])
+        self.assertEqual(ways_in_center.shape, (200, 2))
+        numpy.testing.assert_array_equal(ways_in_center[:, 0], on)
+        for label, (on_1, on_16) in zip(self.labels, ways_in_center):
+            self.assertEqual(has_ways_in_center(label, 1), on_1)
+            self.assertEqual(has_ways_in_center(label, 16), on_16)
+
+    def test_batch_tolerance_zero(self):
+        labels = numpy.ones((3, 64, 64), dtype=numpy.uint8)
+        self.assertFalse(has_ways_in_center(labels[0], 0))
+        numpy.testing.assert_array_equal(has_ways_in_center_batch(labels, 0), [False] * 3)
+        numpy.testing.assert_array_equal(has_ways_in_center_batch(labels, [0, 0]),
+                                         [[False, False]] * 3)
+        numpy.testing.assert_array_equal(has_ways_in_center_batch(labels, [0, 1]),
+                                         [[False, True]] * 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
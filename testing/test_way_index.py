@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+import unittest
+
+import numpy
+
+from src.way_index import WayIndex, clip_segments
+
+
+class TestWayIndex(unittest.TestCase):
+
+    def setUp(self):
+        random_state = numpy.random.RandomState(0)
+        self.ways = []
+        for _ in range(200):
+            start = random_state.uniform([-76, 38], [-75, 39])
+            points = start + numpy.cumsum(random_state.uniform(-0.02, 0.02, (8, 2)), axis=0)
+            self.ways.append({'linestring': [tuple(point) for point in points]})
+        self.ways.append({'linestring': [(-75.5, 38.5)]})
+        self.index = WayIndex(self.ways, cell_size=0.03)
+
+    def test_segments(self):
+        self.assertEqual(len(self.index), 200 * 7)
+        self.assertEqual(tuple(self.index.segments[7]), self.ways[1]['linestring'][0] +
+                         self.ways[1]['linestring'][1])
+        self.assertEqual(list(self.index.way_ids[6:8]), [0, 1])
+
+    def test_candidates_match_brute_force(self):
+        segments = self.index.segments
+        for box in [(-75.6, 38.4, -75.5, 38.45), (-80, 30, -70, 40), (-74, 38, -73, 39)]:
+            min_x, min_y, max_x, max_y = box
+            expected = numpy.flatnonzero(
+                (numpy.maximum(segments[:, 0], segments[:, 2]) >= min_x) &
+                (numpy.minimum(segments[:, 0], segments[:, 2]) <= max_x) &
+                (numpy.maximum(segments[:, 1], segments[:, 3]) >= min_y) &
+                (numpy.minimum(segments[:, 1], segments[:, 3]) <= max_y))
+            numpy.testing.assert_array_equal(self.index.candidates(*box), expected)
+
+    def test_clipped_segments_stay_in_bounds(self):
+        segments, way_ids = self.index.clipped_segments(-75.6, 38.4, -75.4, 38.6)
+        self.assertTrue(len(segments) > 0)
+        self.assertEqual(len(segments), len(way_ids))
+        self.assertTrue((segments[:, 0::2] >= -75.6 - 1e-9).all())
+        self.assertTrue((segments[:, 0::2] <= -75.4 + 1e-9).all())
+        self.assertTrue((segments[:, 1::2] >= 38.4 - 1e-9).all())
+        self.assertTrue((segments[:, 1::2] <= 38.6 + 1e-9).all())
+
+    def test_empty(self):
+        index = WayIndex([])
+        self.assertEqual(len(index.candidates(0, 0, 1, 1)), 0)
+        self.assertEqual(len(index.clipped_segments(0, 0, 1, 1)[0]), 0)
+
+
+class TestClipSegments(unittest.TestCase):
+
+    def test_clips_crossing_segments(self):
+        segments = [(-1, 0.5, 2, 0.5),   # crosses the box left to right
+                    (0.5, 0.5, 0.7, 0.8),  # inside
+                    (2, 2, 3, 3),          # outside
+                    (-1, 2, 2, -1),        # diagonal through a corner region
+                    (1.5, 0, 1.5, 1)]      # vertical, outside
+        clipped, inside = clip_segments(segments, 0, 0, 1, 1)
+        self.assertEqual(list(inside), [True, True, False, True, False])
+        numpy.testing.assert_allclose(clipped[0], [0, 0.5, 1, 0.5])
+        numpy.testing.assert_allclose(clipped[1], [0.5, 0.5, 0.7, 0.8])
+        numpy.testing.assert_allclose(clipped[3], [0, 1, 1, 0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from src.way_index import WayIndex
+from src.ways import Ways
+
+
+class TestWays(unittest.TestCase):
+
+    def setUp(self):
+        self.ways = Ways()
+        self.ways.append(11, 'primary', [(-75.0, 38.0), (-75.1, 38.1)], [('highway', 'primary')])
+        self.ways.append(12, None, [(-76.0, 39.0), (-76.1, 39.1), (-76.2, 39.0)],
+                         [('sport', 'tennis'), ('surface', 'clay')])
+        self.ways.append(13, 'primary', [(-77.0, 40.0), (-77.5, 40.5)])
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_sequence_api(self):
+        self.assertEqual(len(self.ways), 3)
+        self.assertEqual(self.ways[1], {'id': 12, 'way_type': None,
+                                        'linestring': [(-76.0, 39.0), (-76.1, 39.1),
+                                                       (-76.2, 39.0)],
+                                        'tags': [('sport', 'tennis'), ('surface', 'clay')]})
+        self.assertEqual([way['id'] for way in self.ways], [11, 12, 13])
+        self.assertEqual(self.ways[-1]['way_type'], 'primary')
+        self.assertRaises(IndexError, lambda: self.ways[3])
+
+    def test_columns(self):
+        self.assertEqual(self.ways.coords.shape, (7, 2))
+        numpy.testing.assert_array_equal(self.ways.offsets, [0, 2, 5, 7])
+        numpy.testing.assert_array_equal(self.ways.type_codes, [0, -1, 0])
+        self.assertEqual(self.ways.types, ['primary'])
+        # appending after reading the columns still works
+        self.ways.append(14, 'service', [(-78.0, 41.0), (-78.1, 41.0)])
+        numpy.testing.assert_array_equal(self.ways.offsets, [0, 2, 5, 7, 9])
+        self.assertEqual(self.ways[3]['way_type'], 'service')
+
+    def test_save_and_load(self):
+        self.ways.save(self.tempdir)
+        loaded = Ways.load(self.tempdir)
+        self.assertTrue(isinstance(loaded.coords, numpy.memmap))
+        self.assertEqual(list(loaded), list(self.ways))
+
+    def test_without_tags(self):
+        ways = Ways(keep_tags=False)
+        ways.append(1, 'primary', [(0.0, 0.0), (1.0, 1.0)], [('highway', 'primary')])
+        self.assertEqual(ways[0]['tags'], [])
+
+    def test_concatenate(self):
+        other = Ways()
+        other.append(21, 'service', [(-70.0, 30.0), (-70.1, 30.0)], [('highway', 'service')])
+        other.append(22, 'primary', [(-71.0, 31.0), (-71.1, 31.0)], [('surface', 'clay')])
+        self.ways.save(self.tempdir)
+        merged = Ways.concatenate([Ways.load(self.tempdir), other])
+        self.assertEqual(list(merged), list(self.ways) + list(other))
+        self.assertEqual(merged.types, ['primary', 'service'])
+        self.assertEqual(len(Ways.concatenate([])), 0)
+
+    def test_take(self):
+        taken = self.ways.take([2, 0])
+        self.assertEqual(list(taken), [self.ways[2], self.ways[0]])
+        self.assertEqual(len(self.ways.take([])), 0)
+
+    def test_merge_drops_repeated_ids(self):
+        other = Ways()
+        other.append(12, None, [(-76.0, 39.0), (-76.1, 39.1)])
+        other.append(21, 'service', [(-70.0, 30.0), (-70.1, 30.0)], [('highway', 'service')])
+        merged = Ways.merge([self.ways, other])
+        self.assertEqual([way['id'] for way in merged], [11, 12, 13, 21])
+        self.assertEqual(merged[1], self.ways[1])
+        self.assertTrue(Ways.merge([other]) is other)
+
+    def test_way_index_matches_way_dicts(self):
+        from_columns = WayIndex(self.ways, cell_size=0.5)
+        from_dicts = WayIndex(list(self.ways), cell_size=0.5)
+        numpy.testing.assert_array_equal(from_columns.segments, from_dicts.segments)
+        numpy.testing.assert_array_equal(from_columns.way_ids, from_dicts.way_ids)
+        self.assertEqual(from_columns.way_types, from_dicts.way_types)
+
+
+if __name__ == "__main__":
+    unittest.main()